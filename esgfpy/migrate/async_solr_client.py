@@ -0,0 +1,322 @@
+'''
+Python module to issue concurrent query and post requests to a Solr server
+from a single thread, with asyncio and a minimal HTTP/1.1 client
+built on asyncio streams.
+
+Example:
+    loop = asyncio.get_event_loop()
+    client = AsyncSolrClient('http://localhost:8983/solr')
+    responses = loop.run_until_complete(asyncio.gather(*[
+        client.query('datasets', '*:*', 0, 0, [fq]) for fq in fqs]))
+    loop.run_until_complete(client.close())
+'''
+
+import asyncio
+import gzip
+import http.client
+import json
+import logging
+import ssl
+from urllib import error, parse
+
+from esgfpy.migrate.solr_client import (
+    SolrQueryError, UNIQUE_KEY, update_error
+    )
+from esgfpy.migrate.utils import (
+    CircuitOpenError, WIRE_MODE, GZIP_MIN_BYTES, TIMEOUT_SECS,
+    _encode_params, get_circuit_breaker, retry_policy, serialize_json,
+    wire_stats
+    )
+
+# default maximum number of requests in flight for each client
+MAX_CONCURRENCY = 100
+
+
+class AsyncSolrClient(object):
+    '''
+    Class to issue query and post requests to a Solr server as coroutines,
+    with the same methods as SolrClient. At most 'concurrency' requests
+    are in flight at any time, each on its own keep-alive connection.
+    Requests are retried, and failures reported to the circuit breaker of
+    the host, as in esgfpy.migrate.utils.
+    A client must be used, and closed, within a single event loop.
+    '''
+
+    def __init__(self, solr_base_url='http://localhost:8983/solr',
+                 concurrency=MAX_CONCURRENCY):
+
+        self._solr_base_url = solr_base_url
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._idle = []
+        _url = parse.urlsplit(solr_base_url)
+        self._scheme = _url.scheme
+        self._host = _url.hostname
+        self._port = _url.port or (443 if _url.scheme == 'https' else 80)
+        self._netloc = _url.netloc
+
+    async def query(self, solr_core, query, start, rows, fq,
+                    cursorMark=None, sort=None):
+        '''Coroutine equivalent of SolrClient.query().'''
+
+        url = self._solr_base_url + "/" + solr_core + "/select"
+        params = {"q": query,
+                  "fq": fq,
+                  "wt": "json",
+                  "start": "%s" % start,
+                  "rows": "%s" % rows
+                  }
+        if cursorMark is not None:
+            params["start"] = "0"
+            params["cursorMark"] = cursorMark
+            params["sort"] = sort or "%s asc" % UNIQUE_KEY
+        elif sort is not None:
+            params["sort"] = sort
+
+        jdoc = await self.get_json(url, params)
+        if jdoc is None:
+            raise SolrQueryError("Error querying %s" % url)
+        response = jdoc['response']
+        if cursorMark is not None:
+            response['nextCursorMark'] = jdoc['nextCursorMark']
+        return response
+
+    async def stats(self, solr_core, query, fq, field):
+        '''
+        Coroutine that returns the full JSON response of a stats query
+        on 'field', or None if the request failed.
+        '''
+
+        url = self._solr_base_url + "/" + solr_core + "/select"
+        params = {"q": query,
+                  "fq": fq,
+                  "wt": "json",
+                  "stats": "true",
+                  "stats.field": field,
+                  "rows": "0"}
+        return await self.get_json(url, params)
+
+    async def post(self, metadata, solr_core):
+        '''Coroutine equivalent of SolrClient.post().'''
+
+        url = "%s/%s/update" % (self._solr_base_url, solr_core)
+        if isinstance(metadata, bytes):
+            body = metadata
+        else:
+            body = serialize_json(metadata)
+        try:
+            return await self.post_json(url, body, raise_errors=True)
+        except Exception as e:
+            raise update_error(url, e) from e
+
+    async def commit(self, solr_core):
+        url = "%s/%s/update" % (self._solr_base_url, solr_core)
+        return await self.get_json(url, {'commit': 'true'})
+
+    async def optimize(self, solr_core):
+        url = "%s/%s/update" % (self._solr_base_url, solr_core)
+        return await self.get_json(url, {'optimize': 'true'})
+
+    async def get_json(self, url, params):
+        '''
+        Coroutine that sends a GET request to retrieve a JSON response,
+        or a POST request if the parameters are too long
+        (see esgfpy.migrate.utils._encode_params()).
+        Returns None if the request failed.
+        '''
+
+        if params and WIRE_MODE['compact']:
+            params = dict((key, value) for key, value in params.items()
+                          if key != 'indent')
+        headers = {}
+        if WIRE_MODE['compact']:
+            headers['Accept-Encoding'] = 'gzip'
+        (url, body) = _encode_params(url, params, headers)
+        return await self._request_json('GET' if body is None else 'POST',
+                                        url, body, headers)
+
+    async def post_json(self, url, body, raise_errors=False):
+        '''
+        Coroutine that sends a POST request with a serialized JSON body.
+        Returns the JSON response, or None if the request failed
+        (see _request_json() for 'raise_errors').
+        '''
+
+        headers = {'Content-Type': 'application/json'}
+        if WIRE_MODE['compact']:
+            headers['Accept-Encoding'] = 'gzip'
+        payload = body
+        if WIRE_MODE['gzip_requests'] and len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        wire_stats.add('sent', len(payload), len(body))
+        return await self._request_json('POST', url, body, headers,
+                                        raise_errors=raise_errors)
+
+    async def close(self):
+        '''Closes the idle connections.'''
+
+        for (_, writer) in self._idle:
+            writer.close()
+        self._idle = []
+
+    async def _request_json(self, method, url, body, headers,
+                            raise_errors=False):
+        '''
+        Sends a request according to the retry policy
+        and the circuit breaker of the host. Returns None if the request
+        failed, or raises the error of the last try if 'raise_errors'
+        is True, as esgfpy.migrate.utils._send_json() does.
+        '''
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        breaker = get_circuit_breaker(url)
+        for attempt in range(0, retry_policy.maxTries):
+            try:
+                breaker.allow()
+                async with self._semaphore:
+                    (status, reason, _headers, data) = await asyncio.wait_for(
+                        self._send(method, url, body, headers), TIMEOUT_SECS)
+                if status >= 400:
+                    raise error.HTTPError(url, status, reason, _headers, None)
+                wire_bytes = len(data)
+                if _headers.get('Content-Encoding', None) == 'gzip':
+                    data = gzip.decompress(data)
+                wire_stats.add('received', len(data), wire_bytes)
+                jdoc = json.loads(data)
+                breaker.success()
+                return jdoc
+
+            except Exception as e:
+                logging.warning("%s: %s" % (url, str(e) or type(e).__name__))
+                if isinstance(e, CircuitOpenError):
+                    if raise_errors:
+                        raise
+                    return None
+                if retry_policy.retryable(e):
+                    breaker.failure()
+                else:
+                    breaker.success()
+                    if raise_errors:
+                        raise
+                    return None
+                if attempt + 1 >= retry_policy.maxTries:
+                    if raise_errors:
+                        raise
+                else:
+                    await asyncio.sleep(retry_policy.delay(attempt, e))
+
+        return None
+
+    async def _send(self, method, url, body, headers):
+        '''
+        Sends one HTTP/1.1 request on an idle or new connection, and reads
+        the full response: returns (status, reason, headers, body).
+        '''
+
+        _url = parse.urlsplit(url)
+        path = _url.path or '/'
+        if _url.query:
+            path += '?' + _url.query
+        lines = ["%s %s HTTP/1.1" % (method, path),
+                 "Host: %s" % self._netloc]
+        for (key, value) in headers.items():
+            lines.append("%s: %s" % (key, value))
+        if body is not None:
+            lines.append("Content-Length: %s" % len(body))
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+        if body is not None:
+            request += body
+
+        # a kept-alive connection may have been closed by the server
+        # since its last request: retry once on a new connection
+        while True:
+            (reader, writer, reused) = await self._checkout()
+            try:
+                writer.write(request)
+                await writer.drain()
+                statusLine = await reader.readline()
+                if not statusLine:
+                    raise ConnectionResetError("Connection closed by server")
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+            except BaseException:
+                writer.close()
+                raise
+
+        try:
+            (version, status, reason) = _parse_status_line(statusLine)
+            # case insensitive headers, as in http.client responses
+            _headers = http.client.HTTPMessage()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                (key, _, value) = line.decode('latin-1').partition(':')
+                _headers[key.strip()] = value.strip()
+
+            keepAlive = (version == 'HTTP/1.1' and
+                         _headers.get('Connection', '').lower() != 'close')
+            if method == 'HEAD' or status in (204, 304):
+                data = b''
+            elif _headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                data = await _read_chunked(reader)
+            elif 'Content-Length' in _headers:
+                data = await reader.readexactly(
+                    int(_headers['Content-Length']))
+            else:
+                data = await reader.read()
+                keepAlive = False
+        except BaseException:
+            writer.close()
+            raise
+
+        if keepAlive:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return (status, reason, _headers, data)
+
+    async def _checkout(self):
+        '''Returns an idle connection, or opens a new one.'''
+
+        while self._idle:
+            (reader, writer) = self._idle.pop()
+            if not reader.at_eof():
+                return (reader, writer, True)
+            writer.close()
+
+        sslContext = None
+        if self._scheme == 'https':
+            sslContext = ssl.create_default_context()
+        (reader, writer) = await asyncio.open_connection(
+            self._host, self._port, ssl=sslContext)
+        return (reader, writer, False)
+
+
+def _parse_status_line(line):
+
+    (version, status, reason) = (
+        line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    return (version, int(status), reason)
+
+
+async def _read_chunked(reader):
+    '''Reads the body of a response with chunked transfer encoding.'''
+
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0].strip(), 16)
+        if size == 0:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+    # skip the trailer
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+    return b''.join(chunks)
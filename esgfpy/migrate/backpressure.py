@@ -0,0 +1,188 @@
+'''
+Python module to adjust the load that a migration puts on a target Solr
+server to the latency of its update requests.
+'''
+
+import contextlib
+import logging
+import threading
+import time
+
+# initial and maximum number of concurrent update requests
+INITIAL_CONCURRENCY = 1
+MAX_CONCURRENCY = 16
+
+# initial, minimum and maximum number of update requests per second
+INITIAL_RATE = 10.
+MIN_RATE = 0.1
+MAX_RATE = 1000.
+
+# latency in seconds above which the target Solr is considered congested
+TARGET_SECONDS = 2.0
+
+# additive increase of the concurrency per round of requests, and of the
+# requests per second per request, multiplicative decrease of both
+ADDITIVE_INCREASE = 1.
+DECREASE_FACTOR = 0.5
+
+
+class RateController(object):
+    '''
+    Class that limits the number of concurrent update requests to a target
+    Solr, and the rate at which they start, with AIMD (additive increase,
+    multiplicative decrease): the concurrency grows by ADDITIVE_INCREASE
+    per round of requests completed within 'targetSeconds', and the rate
+    by ADDITIVE_INCREASE per such request; both are
+    multiplied by DECREASE_FACTOR when a request fails or is slower,
+    at most once per round so that concurrent requests that observed
+    the same congestion do not collapse the limits.
+    The same instance can be shared by concurrent writers.
+    '''
+
+    def __init__(self, concurrency=INITIAL_CONCURRENCY,
+                 maxConcurrency=MAX_CONCURRENCY,
+                 rate=INITIAL_RATE, minRate=MIN_RATE, maxRate=MAX_RATE,
+                 targetSeconds=TARGET_SECONDS):
+
+        self.maxConcurrency = maxConcurrency
+        self.minRate = minRate
+        self.maxRate = maxRate
+        self.targetSeconds = targetSeconds
+        self._concurrency = float(min(concurrency, maxConcurrency))
+        self._rate = float(max(minRate, min(rate, maxRate)))
+        self._init_state()
+
+    def _init_state(self):
+
+        self._condition = threading.Condition()
+        self._inFlight = 0
+        self._nextStart = 0.
+        self._lastDecrease = 0.
+
+    def __getstate__(self):
+        # worker processes receive a copy of the limits, not of the locks
+        state = dict(self.__dict__)
+        for key in ['_condition', '_inFlight', '_nextStart', '_lastDecrease']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def share(self, n):
+        '''
+        Returns a new controller with 1/n of the limits of this one,
+        for each of 'n' processes writing to the same target.
+        '''
+
+        return RateController(
+            concurrency=max(1, int(self._concurrency / n)),
+            maxConcurrency=max(1, self.maxConcurrency // n),
+            rate=self._rate / n, minRate=self.minRate / n,
+            maxRate=self.maxRate / n, targetSeconds=self.targetSeconds)
+
+    def limits(self):
+        '''Returns the current (concurrency, requests per second).'''
+
+        with self._condition:
+            return (int(self._concurrency), self._rate)
+
+    def acquire(self):
+        '''
+        Blocks until a new request can be started
+        within the concurrency and rate limits.
+        '''
+
+        with self._condition:
+            while self._inFlight >= int(self._concurrency):
+                self._condition.wait()
+            self._inFlight += 1
+            now = time.time()
+            start = max(now, self._nextStart)
+            self._nextStart = start + 1. / self._rate
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, seconds, success=True):
+        '''
+        Records the outcome of a request started with acquire(),
+        which lasted 'seconds' seconds, and adjusts the limits.
+        '''
+
+        with self._condition:
+            self._inFlight -= 1
+            if success and seconds <= self.targetSeconds:
+                # one round is about as many requests as the concurrency
+                self._concurrency = min(
+                    self._concurrency + ADDITIVE_INCREASE / self._concurrency,
+                    self.maxConcurrency)
+                self._rate = min(self._rate + ADDITIVE_INCREASE,
+                                 self.maxRate)
+            else:
+                now = time.time()
+                if now - self._lastDecrease >= max(seconds,
+                                                   self.targetSeconds):
+                    self._lastDecrease = now
+                    self._concurrency = max(
+                        self._concurrency * DECREASE_FACTOR, 1.)
+                    self._rate = max(self._rate * DECREASE_FACTOR,
+                                     self.minRate)
+                    logging.info("Target congested (%s request in %.2f "
+                                 "seconds): concurrency=%s requests per "
+                                 "second=%.2f" % (
+                                     'successful' if success else 'failed',
+                                     seconds, int(self._concurrency),
+                                     self._rate))
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def request(self):
+        '''
+        Context manager wrapping one update request:
+        waits for the limits, then records the latency of the request,
+        and whether it raised an error or was marked as failed
+        (see RequestOutcome).
+        '''
+
+        self.acquire()
+        outcome = RequestOutcome()
+        t1 = time.time()
+        try:
+            yield outcome
+        except BaseException:
+            outcome.success = False
+            raise
+        finally:
+            self.release(time.time() - t1, success=outcome.success)
+
+
+class RequestOutcome(object):
+    '''
+    Outcome of a throttled request, for requests that report
+    failures by their return value instead of raising an error.
+    '''
+
+    def __init__(self):
+        self.success = True
+
+
+class _Unthrottled(object):
+    '''Context manager that does not limit requests.'''
+
+    def __enter__(self):
+        return RequestOutcome()
+
+    def __exit__(self, *args):
+        return False
+
+
+def throttle(controller):
+    '''
+    Returns the context manager wrapping one update request:
+    the request() of 'controller', or a no-op if 'controller' is None.
+    '''
+
+    if controller is None:
+        return _Unthrottled()
+    return controller.request()
@@ -0,0 +1,89 @@
+'''
+Python module to size the batches of records posted to a Solr server.
+'''
+
+import logging
+import threading
+
+# initial and fixed number of records per request
+DEFAULT_ROWS = 100
+
+# bounds of the adaptive number of records per request
+MIN_ROWS = 1
+MAX_ROWS = 10000
+
+# size in bytes and duration in seconds targeted for each update request
+TARGET_BYTES = 1024 * 1024
+TARGET_SECONDS = 2.0
+
+# maximum growth of the batch size from one request to the next
+MAX_GROWTH = 2.0
+
+# weight of the latest request in the estimated bytes per record
+SMOOTHING = 0.3
+
+
+class AdaptiveBatcher(object):
+    '''
+    Class that adjusts the number of records per request so that
+    each update request approaches a target size in bytes and
+    a target latency: the batch grows at most by a factor MAX_GROWTH
+    after each successful request, and is halved after each failure.
+    The same instance can be shared by concurrent writers.
+    '''
+
+    def __init__(self, rows=DEFAULT_ROWS,
+                 targetBytes=TARGET_BYTES, targetSeconds=TARGET_SECONDS,
+                 minRows=MIN_ROWS, maxRows=MAX_ROWS):
+
+        self.targetBytes = targetBytes
+        self.targetSeconds = targetSeconds
+        self.minRows = minRows
+        self.maxRows = maxRows
+        self._rows = rows
+        self._bytesPerRecord = None
+        self._lock = threading.Lock()
+
+    def rows(self):
+        '''Returns the number of records for the next request.'''
+
+        with self._lock:
+            return self._rows
+
+    def success(self, numRecords, numBytes, seconds):
+        '''
+        Updates the batch size after 'numRecords' records totaling
+        'numBytes' bytes have been posted in 'seconds' seconds.
+        '''
+
+        if numRecords <= 0:
+            return
+
+        with self._lock:
+            bytesPerRecord = float(numBytes) / numRecords
+            if self._bytesPerRecord is None:
+                self._bytesPerRecord = bytesPerRecord
+            else:
+                self._bytesPerRecord = (
+                    SMOOTHING * bytesPerRecord +
+                    (1 - SMOOTHING) * self._bytesPerRecord)
+
+            rows = self.targetBytes / max(self._bytesPerRecord, 1.)
+            if seconds > 0:
+                rows = min(rows, numRecords * self.targetSeconds / seconds)
+            rows = min(rows, self._rows * MAX_GROWTH)
+            self._set(rows)
+
+    def failure(self):
+        '''Halves the batch size after a failed request.'''
+
+        with self._lock:
+            self._set(self._rows / 2.)
+
+    def _set(self, rows):
+
+        rows = int(max(self.minRows, min(self.maxRows, rows)))
+        if rows != self._rows:
+            logging.debug("Records per request: %s --> %s" % (
+                self._rows, rows))
+        self._rows = rows
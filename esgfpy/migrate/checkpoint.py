@@ -0,0 +1,125 @@
+'''
+Python module to persist the progress of a migration,
+so that an interrupted migration can be resumed where it stopped.
+'''
+
+import json
+import logging
+import os
+import threading
+
+
+class Checkpoint(object):
+    '''
+    Class that records the position of a migration in a local JSON file,
+    after each batch of records has been posted to the target Solr.
+    '''
+
+    def __init__(self, path, sourceSolrUrl, targetSolrUrl, core, query, fq):
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = {'source': sourceSolrUrl,
+                       'target': targetSolrUrl,
+                       'core': core,
+                       'query': query,
+                       'fq': fq,
+                       'cursorMark': None,
+                       'start': 0,
+                       'numRecords': 0,
+                       'complete': False}
+
+        # batches posted out of order, waiting for the previous ones
+        self._nextPage = 0
+        self._pendingPages = {}
+
+    def load(self):
+        '''
+        Loads the checkpoint file, if existing, and returns its state.
+        Raises ValueError if the checkpoint was saved for a different
+        migration (core, query or filter queries).
+        '''
+
+        if not os.path.exists(self.path):
+            logging.info("No checkpoint found at: %s" % self.path)
+            return None
+
+        with open(self.path) as checkpoint_file:
+            state = json.load(checkpoint_file)
+        for key in ['core', 'query', 'fq']:
+            if state.get(key, None) != self._state[key]:
+                raise ValueError("Checkpoint %s does not match the migration: "
+                                 "%s=%s instead of %s" % (
+                                     self.path, key, state.get(key, None),
+                                     self._state[key]))
+        self._state.update(state)
+        logging.info("Resuming from checkpoint: %s cursorMark=%s start=%s "
+                     "number of records=%s" % (
+                         self.path, state['cursorMark'], state['start'],
+                         state['numRecords']))
+        return dict(self._state)
+
+    def get(self, key):
+
+        with self._lock:
+            return self._state[key]
+
+    def set(self, key, value):
+
+        with self._lock:
+            self._state[key] = value
+            self._save()
+
+    def update(self, page, cursorMark, start, numRecords):
+        '''
+        Records that the batch number 'page' has been posted, ending at
+        ('cursorMark', 'start'). Batches may complete in any order, but
+        the checkpoint only advances over consecutive batches.
+        '''
+
+        with self._lock:
+            self._pendingPages[page] = (cursorMark, start, numRecords)
+            if self._nextPage not in self._pendingPages:
+                return
+            while self._nextPage in self._pendingPages:
+                (cursorMark, start, numRecords) = self._pendingPages.pop(
+                    self._nextPage)
+                self._state['cursorMark'] = cursorMark
+                self._state['start'] = start
+                self._state['numRecords'] += numRecords
+                self._nextPage += 1
+            self._save()
+
+    def complete(self):
+        '''
+        Marks the migration as complete, unless some batches were never
+        posted: the checkpoint then stays at the last consecutive batch.
+        Returns True if the migration was marked as complete.
+        '''
+
+        with self._lock:
+            if self._pendingPages:
+                logging.warning("Checkpoint %s not complete: batches not "
+                                "posted after batch #%s" % (
+                                    self.path, self._nextPage))
+                return False
+            self._state['complete'] = True
+            self._save()
+        return True
+
+    def _save(self):
+        '''Writes the checkpoint atomically, replacing the previous one.'''
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(self._state, checkpoint_file, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def is_complete(path):
+    '''Returns True if the checkpoint file records a complete migration.'''
+
+    if not os.path.exists(path):
+        return False
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file).get('complete', False)
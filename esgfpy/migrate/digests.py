@@ -0,0 +1,279 @@
+'''
+Python module to summarize the records of a Solr core as a tree of digests:
+one digest per hour of the sorted (id, _timestamp) pairs of its records,
+rolled up to days and months. Two trees are compared from the top down,
+so that only the branches that differ are searched.
+
+The tree of each Solr server is cached in a local JSON file between runs:
+an update only streams the records of the hours whose number of records,
+or latest _timestamp, has changed since the previous run.
+'''
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+from esgfpy.migrate.id_scan import MAX_IDS_PER_REQUEST
+from esgfpy.migrate.partitions import TIMESTAMP_FIELD, format_datetime
+from esgfpy.migrate.solr_client import (
+    SolrClient, SolrQueryError, CURSOR_MARK_START, UNIQUE_KEY
+    )
+from esgfpy.migrate.utils import http_get_json
+
+# bucket keys of each level of the tree, as prefixes of the hour keys
+HOUR_KEY_FORMAT = '%Y-%m-%dT%H'
+KEY_LENGTHS = [len('YYYY-MM'), len('YYYY-MM-DD'), len('YYYY-MM-DDTHH')]
+HOUR_KEY_LENGTH = KEY_LENGTHS[-1]
+
+DELTA_HOUR = datetime.timedelta(hours=1)
+
+
+class DigestTree(object):
+    '''
+    Class that holds the number of records and the digest of each hour
+    of a Solr core (for a given query), cached in 'cacheDir'.
+    '''
+
+    def __init__(self, solr_base_url, core, query, cacheDir):
+
+        self.solr_base_url = solr_base_url
+        self.core = core
+        self.query = query
+        key = "%s|%s|%s" % (solr_base_url, core, query)
+        self.path = os.path.join(
+            cacheDir, "digests-%s.json" % hashlib.sha1(
+                key.encode('utf8')).hexdigest())
+        # hour key --> [number of records, hex digest, latest _timestamp]
+        self.hours = {}
+        self._levels = None
+
+    def load(self):
+        '''Loads the cached digests, if existing.'''
+
+        if not os.path.exists(self.path):
+            logging.info("No digests found at: %s" % self.path)
+            return
+        with open(self.path) as cache_file:
+            state = json.load(cache_file)
+        if (state.get('solr_base_url', None) != self.solr_base_url or
+                state.get('core', None) != self.core or
+                state.get('query', None) != self.query):
+            logging.warning("Ignoring digests for a different core or query: "
+                            "%s" % self.path)
+            return
+        self.hours = state['hours']
+        self._levels = None
+
+    def save(self):
+        '''Writes the digests atomically, replacing the previous ones.'''
+
+        state = {'solr_base_url': self.solr_base_url,
+                 'core': self.core,
+                 'query': self.query,
+                 'hours': self.hours}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(state, cache_file, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def update(self, dt_min, dt_max):
+        '''
+        Updates the digests of the hours in [dt_min, dt_max):
+        only the records of the hours whose signature (the number of
+        records and the latest _timestamp) differs from the cached one
+        are streamed from Solr, so that a record re-published within
+        the same hour, or replaced by another one, is not missed.
+        Hours outside of the interval are discarded.
+        Raises SolrQueryError if Solr cannot be queried.
+        '''
+
+        signatures = self._query_hour_signatures(dt_min, dt_max)
+        key_min = _hour_key(dt_min)
+        key_max = _hour_key(dt_max)
+        for key in list(self.hours.keys()):
+            if not key_min <= key < key_max or key not in signatures:
+                del self.hours[key]
+        changed = sorted(key for (key, signature) in signatures.items()
+                         if key not in self.hours or
+                         _signature(self.hours[key]) != signature)
+        logging.info("Updating digests: %s core=%s hours=%s changed=%s" % (
+            self.solr_base_url, self.core, len(signatures), len(changed)))
+
+        for (key_start, key_stop) in _runs(sorted(signatures.keys()),
+                                           set(changed)):
+            self._update_hours(key_start, key_stop)
+        for key in changed:
+            if key in self.hours:
+                self.hours[key][2:] = [signatures[key][1]]
+        self._levels = None
+
+    def invalidate(self, keys):
+        '''
+        Discards the digests of the given hours, so that they are
+        recomputed by the next update.
+        '''
+
+        for key in keys:
+            self.hours.pop(key, None)
+        self._levels = None
+
+    def levels(self):
+        '''
+        Returns the buckets of each level of the tree (months, days, hours):
+        a list of dictionaries of bucket key --> [number of records, digest].
+        The digest of a month or day is computed from the digests
+        of its children, in chronological order.
+        '''
+
+        if self._levels is None:
+            levels = [dict((key, hour[:2])
+                           for (key, hour) in self.hours.items())]
+            for length in reversed(KEY_LENGTHS[:-1]):
+                children = sorted(levels[0].items())
+                parents = {}
+                hashes = {}
+                for (key, (count, digest)) in children:
+                    parent = key[:length]
+                    if parent not in parents:
+                        parents[parent] = [0, None]
+                        hashes[parent] = hashlib.sha256()
+                    parents[parent][0] += count
+                    hashes[parent].update(
+                        ("%s:%s:%s\n" % (key, count, digest)).encode('utf8'))
+                for (parent, _hash) in hashes.items():
+                    parents[parent][1] = _hash.hexdigest()
+                levels.insert(0, parents)
+            self._levels = levels
+        return self._levels
+
+    def _query_hour_signatures(self, dt_min, dt_max):
+        '''
+        Returns the signature of each hour that is not empty:
+        [number of records, latest _timestamp as returned by Solr],
+        with one request to the JSON Facet API.
+        '''
+
+        url = self.solr_base_url + "/" + self.core + "/select"
+        facets = {"hours": {"type": "range",
+                            "field": TIMESTAMP_FIELD,
+                            "start": format_datetime(dt_min),
+                            "end": format_datetime(dt_max),
+                            "gap": "+1HOUR",
+                            "facet": {"max": "max(%s)" % TIMESTAMP_FIELD}}}
+        params = {"q": self.query,
+                  "rows": "0",
+                  "wt": "json",
+                  "json.facet": json.dumps(facets, separators=(',', ':'))}
+        response = http_get_json(url, params)
+        if response is None:
+            raise SolrQueryError("Error querying %s" % url)
+        signatures = {}
+        for bucket in response.get('facets', {}).get('hours', {}).get(
+                'buckets', []):
+            if bucket['count'] > 0:
+                signatures[bucket['val'][:HOUR_KEY_LENGTH]] = [
+                    bucket['count'], bucket.get('max', None)]
+        return signatures
+
+    def _update_hours(self, key_start, key_stop):
+        '''
+        Recomputes the digests of the hours from 'key_start' to 'key_stop'
+        included, streaming their (id, _timestamp) pairs sorted by id.
+        '''
+
+        dt_start = _parse_hour_key(key_start)
+        dt_stop = _parse_hour_key(key_stop) + DELTA_HOUR
+        fq = ["%s:[%s TO %s}" % (TIMESTAMP_FIELD,
+                                 format_datetime(dt_start),
+                                 format_datetime(dt_stop))]
+
+        # the records of each hour are hashed in the order of their ids
+        hashes = {}
+        counts = {}
+        solr_client = SolrClient(self.solr_base_url)
+        cursorMark = CURSOR_MARK_START
+        while True:
+            response = solr_client.query(
+                self.core, self.query, 0, MAX_IDS_PER_REQUEST, fq,
+                cursorMark=cursorMark, fl=[UNIQUE_KEY, TIMESTAMP_FIELD])
+            for doc in response['docs']:
+                key = doc[TIMESTAMP_FIELD][:HOUR_KEY_LENGTH]
+                if key not in hashes:
+                    hashes[key] = hashlib.sha256()
+                    counts[key] = 0
+                hashes[key].update(("%s\t%s\n" % (
+                    doc[UNIQUE_KEY], doc[TIMESTAMP_FIELD])).encode('utf8'))
+                counts[key] += 1
+            if response['nextCursorMark'] == cursorMark:
+                break
+            cursorMark = response['nextCursorMark']
+
+        dt = dt_start
+        while dt < dt_stop:
+            self.hours.pop(_hour_key(dt), None)
+            dt = dt + DELTA_HOUR
+        for (key, _hash) in hashes.items():
+            self.hours[key] = [counts[key], _hash.hexdigest()]
+
+
+def diff_trees(tree1, tree2):
+    '''
+    Compares two DigestTrees from the top down, descending only into the
+    months and days whose digests differ. Returns the keys of the hours
+    that differ, in chronological order.
+    '''
+
+    levels1 = tree1.levels()
+    levels2 = tree2.levels()
+    differ = set([''])
+    for (level, length) in enumerate(KEY_LENGTHS):
+        parentLength = KEY_LENGTHS[level - 1] if level > 0 else 0
+        keys = set(levels1[level].keys()) | set(levels2[level].keys())
+        differ = set(key for key in keys
+                     if key[:parentLength] in differ and
+                     levels1[level].get(key, None) !=
+                     levels2[level].get(key, None))
+    return sorted(differ)
+
+
+def hour_interval(key):
+    '''Returns the (start, stop) datetimes of an hour key.'''
+
+    dt_start = _parse_hour_key(key)
+    return (dt_start, dt_start + DELTA_HOUR)
+
+
+def _signature(hour):
+    '''Returns the signature of a cached hour, as [count, latest].'''
+
+    return [hour[0], hour[2] if len(hour) > 2 else None]
+
+
+def _hour_key(dt):
+    return dt.strftime(HOUR_KEY_FORMAT)
+
+
+def _parse_hour_key(key):
+    return datetime.datetime.strptime(key, HOUR_KEY_FORMAT)
+
+
+def _runs(keys, changed):
+    '''
+    Groups the 'changed' hours into runs of hours that are not separated
+    by any unchanged hour of 'keys', the sorted keys of all hours
+    that are not empty: empty hours cost nothing to stream.
+    '''
+
+    runs = []
+    extend = False
+    for key in keys:
+        if key not in changed:
+            extend = False
+        elif extend:
+            runs[-1][1] = key
+        else:
+            runs.append([key, key])
+            extend = True
+    return runs
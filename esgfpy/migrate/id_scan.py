@@ -0,0 +1,258 @@
+'''
+Python module to scan the (id, _timestamp) pairs of the records of a Solr
+core that match a query, with no limit on their number: the records are
+paged with a Solr cursor sorted by id, and kept in a compact two-column
+store instead of a dictionary of strings, so that intervals with millions
+of records can be compared in memory.
+
+Example:
+    source = scan_ids('http://localhost:8983/solr', 'files', '*:*', [fq])
+    target = scan_ids('http://localhost:8984/solr', 'files', '*:*', [fq])
+    (changed, removed) = diff(source, target)
+
+Cores too large to be held in memory are compared as streams instead:
+    for (action, record_id) in merge_join(
+            stream_ids(source_url, 'files', '*:*', []),
+            stream_ids(target_url, 'files', '*:*', [])):
+        ...
+'''
+
+import datetime
+import logging
+from array import array
+
+from esgfpy.migrate.partitions import TIMESTAMP_FIELD
+from esgfpy.migrate.solr_client import (
+    SolrClient, CURSOR_MARK_START, UNIQUE_KEY
+    )
+
+# number of (id, _timestamp) pairs requested per page
+MAX_IDS_PER_REQUEST = 10000
+
+# records without a _timestamp cannot be compared, and are not scanned
+TIMESTAMP_FILTER = '%s:[* TO *]' % TIMESTAMP_FIELD
+
+# actions of the merge of a source and a target stream
+ADD = 'add'
+UPDATE = 'update'
+DELETE = 'delete'
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class IdTimestamps(object):
+    '''
+    Class that stores (id, _timestamp) pairs sorted by id, as Solr sorts
+    them (by their UTF-8 bytes): the ids are concatenated in a single
+    buffer indexed by an array of offsets, and the timestamps are stored
+    as milliseconds since the epoch in an array of integers.
+    Ids are looked up by binary search.
+    '''
+
+    def __init__(self):
+
+        self._ids = bytearray()
+        self._offsets = array('Q', [0])
+        self._timestamps = array('q')
+        self._last = None
+
+    def append(self, record_id, timestamp):
+        '''
+        Appends a record: its id must sort after the ids already stored,
+        its timestamp is a Solr datetime string or milliseconds.
+        '''
+
+        key = record_id.encode('utf8')
+        if self._last is not None and key <= self._last:
+            raise ValueError("Record ids not in ascending order: %s" %
+                             record_id)
+        if not isinstance(timestamp, int):
+            timestamp = parse_millis(timestamp)
+        self._ids += key
+        self._offsets.append(len(self._ids))
+        self._timestamps.append(timestamp)
+        self._last = key
+
+    def __len__(self):
+
+        return len(self._timestamps)
+
+    def __iter__(self):
+
+        for i in range(len(self)):
+            yield self.id(i)
+
+    def __contains__(self, record_id):
+
+        return self.find(record_id) >= 0
+
+    def id(self, i):
+
+        return self._key(i).decode('utf8')
+
+    def timestamp(self, i):
+        '''Returns the timestamp of the i-th record, in milliseconds.'''
+
+        return self._timestamps[i]
+
+    def items(self):
+        '''Yields the (id, milliseconds) pairs in the order of the ids.'''
+
+        for i in range(len(self)):
+            yield (self.id(i), self._timestamps[i])
+
+    def get(self, record_id, default=None):
+        '''Returns the timestamp of a record in milliseconds, or 'default'.'''
+
+        i = self.find(record_id)
+        return self._timestamps[i] if i >= 0 else default
+
+    def find(self, record_id):
+        '''Returns the index of a record, or -1 if it is not stored.'''
+
+        key = record_id.encode('utf8')
+        (lo, hi) = (0, len(self))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._key(lo) == key:
+            return lo
+        return -1
+
+    def nbytes(self):
+        '''Returns the number of bytes used by the buffers.'''
+
+        return (len(self._ids) +
+                self._offsets.itemsize * len(self._offsets) +
+                self._timestamps.itemsize * len(self._timestamps))
+
+    def _key(self, i):
+
+        return bytes(self._ids[self._offsets[i]:self._offsets[i + 1]])
+
+
+def stream_ids(solr_base_url, core, query, fq, solr_client=None):
+    '''
+    Yields the (id, milliseconds) pairs of all the records of a core that
+    match a query and filter queries, and have a _timestamp,
+    in the order of the ids, paged with a Solr cursor:
+    only one page is held in memory.
+    Raises SolrQueryError if Solr cannot be queried.
+    '''
+
+    if solr_client is None:
+        solr_client = SolrClient(solr_base_url)
+    fq = list(fq) + [TIMESTAMP_FILTER]
+    cursorMark = CURSOR_MARK_START
+    while True:
+        response = solr_client.query(
+            core, query, 0, MAX_IDS_PER_REQUEST, fq,
+            cursorMark=cursorMark, fl=[UNIQUE_KEY, TIMESTAMP_FIELD])
+        for doc in response['docs']:
+            yield (doc[UNIQUE_KEY], parse_millis(doc[TIMESTAMP_FIELD]))
+        if response['nextCursorMark'] == cursorMark:
+            break
+        cursorMark = response['nextCursorMark']
+
+
+def scan_ids(solr_base_url, core, query, fq, solr_client=None):
+    '''
+    Returns the IdTimestamps of all the records of a core that match
+    a query and filter queries, paged with a Solr cursor.
+    Raises SolrQueryError if Solr cannot be queried.
+    '''
+
+    records = IdTimestamps()
+    for (record_id, timestamp) in stream_ids(solr_base_url, core, query, fq,
+                                             solr_client=solr_client):
+        records.append(record_id, timestamp)
+
+    logging.debug("Scanned %s ids from %s/%s in %s bytes" % (
+        len(records), solr_base_url, core, records.nbytes()))
+    return records
+
+
+def diff(source, target):
+    '''
+    Compares two IdTimestamps with a single merge of their sorted ids.
+    Returns (changed, removed): the ids of the source records that are
+    missing from the target or have a different timestamp,
+    and the ids of the target records that are missing from the source.
+    Dictionaries of {id: milliseconds} are compared by lookup instead.
+    '''
+
+    if not (isinstance(source, IdTimestamps) and
+            isinstance(target, IdTimestamps)):
+        source = dict(source.items())
+        target = dict(target.items())
+        changed = [record_id for record_id in sorted(source)
+                   if source[record_id] != target.get(record_id)]
+        removed = [record_id for record_id in sorted(target)
+                   if record_id not in source]
+        return (changed, removed)
+
+    changed = []
+    removed = []
+    (i, j) = (0, 0)
+    while i < len(source) and j < len(target):
+        key1 = source._key(i)
+        key2 = target._key(j)
+        if key1 < key2:
+            changed.append(key1.decode('utf8'))
+            i += 1
+        elif key1 > key2:
+            removed.append(key2.decode('utf8'))
+            j += 1
+        else:
+            if source.timestamp(i) != target.timestamp(j):
+                changed.append(key1.decode('utf8'))
+            i += 1
+            j += 1
+    changed += [source.id(k) for k in range(i, len(source))]
+    removed += [target.id(k) for k in range(j, len(target))]
+    return (changed, removed)
+
+
+def merge_join(source, target):
+    '''
+    Merges two streams of (id, milliseconds) pairs sorted by id,
+    as returned by stream_ids(), in constant memory. Yields (action, id):
+    ADD for the source ids missing from the target, UPDATE for the ids
+    whose timestamps differ, DELETE for the target ids missing from
+    the source. Python compares strings by code point, in the same order
+    as the UTF-8 bytes that Solr sorts.
+    '''
+
+    _end = (None, None)
+    (id1, timestamp1) = next(source, _end)
+    (id2, timestamp2) = next(target, _end)
+    while id1 is not None or id2 is not None:
+        if id2 is None or (id1 is not None and id1 < id2):
+            yield (ADD, id1)
+            (id1, timestamp1) = next(source, _end)
+        elif id1 is None or id1 > id2:
+            yield (DELETE, id2)
+            (id2, timestamp2) = next(target, _end)
+        else:
+            if timestamp1 != timestamp2:
+                yield (UPDATE, id1)
+            (id1, timestamp1) = next(source, _end)
+            (id2, timestamp2) = next(target, _end)
+
+
+def parse_millis(value):
+    '''
+    Parses a Solr datetime (with or without milliseconds)
+    into milliseconds since the epoch.
+    '''
+
+    dt = datetime.datetime(int(value[0:4]), int(value[5:7]),
+                           int(value[8:10]), int(value[11:13]),
+                           int(value[14:16]), int(value[17:19]))
+    millis = 0
+    if value[19:20] == '.':
+        millis = int(value[20:-1].ljust(3, '0')[:3])
+    return (dt - _EPOCH) // datetime.timedelta(milliseconds=1) + millis
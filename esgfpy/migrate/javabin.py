@@ -0,0 +1,409 @@
+'''
+Pure Python encoder and decoder of the javabin format, the binary
+serialization of Solr (org.apache.solr.common.util.JavaBinCodec, version 2),
+for the responses of the /select handler (wt=javabin) and the bodies
+of the /update handler (Content-Type: application/javabin).
+
+Solr documents and named lists are decoded into dictionaries,
+document lists into the dictionary found in JSON responses
+({'numFound': ..., 'start': ..., 'docs': [...]}), and dates into
+the ISO 8601 strings returned by the JSON response writer,
+so that decoded responses can be used in place of JSON responses.
+'''
+
+import datetime
+import struct
+
+VERSION = 2
+
+CONTENT_TYPE = 'application/javabin'
+
+# tags of the values
+NULL = 0
+BOOL_TRUE = 1
+BOOL_FALSE = 2
+BYTE = 3
+SHORT = 4
+DOUBLE = 5
+INT = 6
+LONG = 7
+FLOAT = 8
+DATE = 9
+MAP = 10
+SOLRDOC = 11
+SOLRDOCLST = 12
+BYTEARR = 13
+ITERATOR = 14
+END = 15
+SOLRINPUTDOC = 16
+MAP_ENTRY_ITER = 17
+ENUM_FIELD_VALUE = 18
+MAP_ENTRY = 19
+
+# tags combined with a size or a value in the low 5 bits of the same byte
+STR = 1 << 5
+SINT = 2 << 5
+SLONG = 3 << 5
+ARR = 4 << 5
+ORDERED_MAP = 5 << 5
+NAMED_LST = 6 << 5
+EXTERN_STRING = 7 << 5
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class NamedList(list):
+    '''List of (name, value) pairs, encoded as a Solr NamedList.'''
+    pass
+
+
+class InputDocument(dict):
+    '''Record encoded as a SolrInputDocument, as posted to /update.'''
+    pass
+
+
+class _End(object):
+    '''Marker of the end of an iterator.'''
+    pass
+
+
+_END = _End()
+
+
+class JavabinEncoder(object):
+    '''Class that serializes Python values to javabin.'''
+
+    def __init__(self):
+
+        self._out = bytearray()
+        self._strings = {}
+
+    def encode(self, value):
+        '''Returns the javabin serialization of 'value'.'''
+
+        self._out.append(VERSION)
+        self.write_val(value)
+        return bytes(self._out)
+
+    def write_val(self, value):
+
+        if value is None:
+            self._out.append(NULL)
+        elif value is True:
+            self._out.append(BOOL_TRUE)
+        elif value is False:
+            self._out.append(BOOL_FALSE)
+        elif isinstance(value, int):
+            self._write_int(value)
+        elif isinstance(value, float):
+            self._out.append(DOUBLE)
+            self._out += struct.pack('>d', value)
+        elif isinstance(value, str):
+            self._write_str(value)
+        elif isinstance(value, datetime.datetime):
+            self._out.append(DATE)
+            millis = int((value - _EPOCH).total_seconds() * 1000)
+            self._out += struct.pack('>q', millis)
+        elif isinstance(value, (bytes, bytearray)):
+            self._out.append(BYTEARR)
+            self._write_vint(len(value))
+            self._out += value
+        elif isinstance(value, InputDocument):
+            self._write_tag(SOLRINPUTDOC, len(value))
+            # document boost, ignored by Solr
+            self._out.append(FLOAT)
+            self._out += struct.pack('>f', 1.)
+            for (name, _value) in value.items():
+                self._write_extern_string(name)
+                self.write_val(_value)
+        elif isinstance(value, NamedList):
+            self._write_tag(NAMED_LST, len(value))
+            for (name, _value) in value:
+                self._write_extern_string(name)
+                self.write_val(_value)
+        elif isinstance(value, dict):
+            self._write_tag(MAP, len(value))
+            for (key, _value) in value.items():
+                if isinstance(key, str):
+                    self._write_extern_string(key)
+                else:
+                    self.write_val(key)
+                self.write_val(_value)
+        elif isinstance(value, (list, tuple)):
+            self._write_tag(ARR, len(value))
+            for _value in value:
+                self.write_val(_value)
+        elif hasattr(value, '__iter__'):
+            self._out.append(ITERATOR)
+            for _value in value:
+                self.write_val(_value)
+            self._out.append(END)
+        else:
+            raise TypeError("Cannot encode type %s in javabin" % type(value))
+
+    def _write_tag(self, tag, size):
+
+        if tag & 0xe0:
+            if size < 0x1f:
+                self._out.append(tag | size)
+            else:
+                self._out.append(tag | 0x1f)
+                self._write_vint(size - 0x1f)
+        else:
+            self._out.append(tag)
+            self._write_vint(size)
+
+    def _write_int(self, value):
+
+        if 0 < value < 1 << 56:
+            # positive values are written with a variable length, in Solr
+            # as an Integer if they fit, as a Long otherwise
+            tag = SINT if value < 1 << 31 else SLONG
+            if value >= 0x0f:
+                self._out.append(tag | 0x10 | (value & 0x0f))
+                self._write_vint(value >> 4)
+            else:
+                self._out.append(tag | value)
+        elif -(1 << 31) <= value < 1 << 31:
+            self._out.append(INT)
+            self._out += struct.pack('>i', value)
+        else:
+            self._out.append(LONG)
+            self._out += struct.pack('>q', value)
+
+    def _write_str(self, value):
+
+        data = value.encode('utf8')
+        self._write_tag(STR, len(data))
+        self._out += data
+
+    def _write_extern_string(self, value):
+        '''Writes a string once, then a reference to it.'''
+
+        index = self._strings.get(value, None)
+        if index is not None:
+            self._write_tag(EXTERN_STRING, index)
+        else:
+            self._write_tag(EXTERN_STRING, 0)
+            self._write_str(value)
+            self._strings[value] = len(self._strings) + 1
+
+    def _write_vint(self, value):
+
+        while value & ~0x7f:
+            self._out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self._out.append(value)
+
+
+class JavabinDecoder(object):
+    '''Class that deserializes javabin into Python values.'''
+
+    def __init__(self, data):
+
+        self._data = data
+        self._pos = 0
+        self._strings = []
+
+    def decode(self):
+        '''Returns the value serialized in the data.'''
+
+        version = self._read_byte()
+        if version != VERSION:
+            raise ValueError("Unsupported javabin version: %s" % version)
+        return self.read_val()
+
+    def read_val(self):
+
+        tag = self._read_byte()
+        kind = tag >> 5
+
+        if kind:
+            if tag & 0xe0 == STR:
+                size = self._read_size(tag)
+                return self._read_bytes(size).decode('utf8')
+            elif tag & 0xe0 in (SINT, SLONG):
+                value = tag & 0x0f
+                if tag & 0x10:
+                    value |= self._read_vint() << 4
+                return value
+            elif tag & 0xe0 == ARR:
+                return [self.read_val() for _ in range(self._read_size(tag))]
+            elif tag & 0xe0 in (ORDERED_MAP, NAMED_LST):
+                values = {}
+                for _ in range(self._read_size(tag)):
+                    name = self.read_val()
+                    values[name] = self.read_val()
+                return values
+            else:
+                index = self._read_size(tag)
+                if index == 0:
+                    value = self.read_val()
+                    self._strings.append(value)
+                    return value
+                return self._strings[index - 1]
+
+        if tag == NULL:
+            return None
+        elif tag == BOOL_TRUE:
+            return True
+        elif tag == BOOL_FALSE:
+            return False
+        elif tag == BYTE:
+            return self._unpack('>b', 1)
+        elif tag == SHORT:
+            return self._unpack('>h', 2)
+        elif tag == DOUBLE:
+            return self._unpack('>d', 8)
+        elif tag == INT:
+            return self._unpack('>i', 4)
+        elif tag == LONG:
+            return self._unpack('>q', 8)
+        elif tag == FLOAT:
+            return self._unpack('>f', 4)
+        elif tag == DATE:
+            return format_date(self._unpack('>q', 8))
+        elif tag == MAP:
+            values = {}
+            for _ in range(self._read_vint()):
+                key = self.read_val()
+                values[key] = self.read_val()
+            return values
+        elif tag == SOLRDOC:
+            # the fields of a document are written as an ordered map
+            return self.read_val()
+        elif tag == SOLRDOCLST:
+            header = self.read_val()
+            docs = self.read_val()
+            docList = {'numFound': header[0], 'start': header[1],
+                       'docs': docs}
+            if header[2] is not None:
+                docList['maxScore'] = header[2]
+            if len(header) > 3:
+                docList['numFoundExact'] = header[3]
+            return docList
+        elif tag == BYTEARR:
+            return self._read_bytes(self._read_vint())
+        elif tag in (ITERATOR, MAP_ENTRY_ITER):
+            values = []
+            while True:
+                value = self.read_val()
+                if value is _END:
+                    return values
+                values.append(value)
+        elif tag == END:
+            return _END
+        elif tag == SOLRINPUTDOC:
+            return self._read_input_document()
+        elif tag == ENUM_FIELD_VALUE:
+            self.read_val()
+            return self.read_val()
+        elif tag == MAP_ENTRY:
+            key = self.read_val()
+            return (key, self.read_val())
+        raise ValueError("Unknown javabin tag: %s" % tag)
+
+    def _read_input_document(self):
+
+        size = self._read_vint()
+        # document boost
+        self.read_val()
+        doc = InputDocument()
+        for _ in range(size):
+            name = self.read_val()
+            # field boost, written by old clients
+            if isinstance(name, float):
+                name = self.read_val()
+            # child documents are not supported
+            if isinstance(name, InputDocument):
+                continue
+            doc[name] = self.read_val()
+        return doc
+
+    def _read_byte(self):
+
+        if self._pos >= len(self._data):
+            raise ValueError("Truncated javabin data")
+        value = self._data[self._pos]
+        self._pos += 1
+        return value
+
+    def _read_bytes(self, size):
+
+        value = bytes(self._data[self._pos:self._pos + size])
+        if len(value) < size:
+            raise ValueError("Truncated javabin data")
+        self._pos += size
+        return value
+
+    def _unpack(self, fmt, size):
+
+        return struct.unpack(fmt, self._read_bytes(size))[0]
+
+    def _read_size(self, tag):
+
+        size = tag & 0x1f
+        if size == 0x1f:
+            size += self._read_vint()
+        return size
+
+    def _read_vint(self):
+
+        value = 0
+        shift = 0
+        while True:
+            byte = self._read_byte()
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+            shift += 7
+
+
+def dumps(value):
+    '''Serializes a Python value to javabin.'''
+
+    return JavabinEncoder().encode(value)
+
+
+def loads(data):
+    '''Deserializes javabin data.'''
+
+    return JavabinDecoder(data).decode()
+
+
+def dumps_update(docs):
+    '''
+    Serializes records as the body of an update request,
+    as written by SolrJ (JavaBinUpdateRequestCodec).
+    '''
+
+    return dumps(NamedList([
+        ('params', NamedList()),
+        ('docs', iter([InputDocument(doc) for doc in docs]))]))
+
+
+def loads_update(data):
+    '''
+    Returns the records of an update request serialized by dumps_update().
+    '''
+
+    return [dict(doc) for doc in loads(data).get('docs', None) or []]
+
+
+def is_javabin(data):
+    '''Returns True if serialized data is javabin rather than JSON.'''
+
+    return data[:1] == bytes([VERSION])
+
+
+def format_date(millis):
+    '''
+    Formats milliseconds since the epoch as the JSON response writer
+    of Solr does: with milliseconds only if they are not zero.
+    '''
+
+    date = _EPOCH + datetime.timedelta(milliseconds=millis)
+    if date.microsecond:
+        return date.strftime('%Y-%m-%dT%H:%M:%S.') + (
+            '%03dZ' % (date.microsecond // 1000))
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
@@ -0,0 +1,141 @@
+'''
+Python module to split the records of a Solr core into disjoint partitions,
+each expressed as a filter query, so that they can be migrated in parallel.
+'''
+
+import datetime
+import logging
+import math
+
+import dateutil.parser
+
+from esgfpy.migrate.solr_client import UNIQUE_KEY, SolrQueryError
+from esgfpy.migrate.utils import http_get_json, to_filter_queries
+
+PARTITION_TIMESTAMP = 'timestamp'
+PARTITION_HASH = 'hash'
+PARTITIONS = [PARTITION_TIMESTAMP, PARTITION_HASH]
+
+TIMESTAMP_FIELD = '_timestamp'
+
+# number of facet buckets computed for each partition,
+# used to balance the number of records across partitions
+BUCKETS_PER_PARTITION = 20
+
+SOLR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def get_partitions(solr_base_url, core, query, fq, numPartitions,
+                   partition=PARTITION_TIMESTAMP):
+    '''
+    Returns a list of filter queries that split the records
+    matching (query, fq) into at most 'numPartitions' disjoint partitions.
+    '''
+
+    if partition == PARTITION_HASH:
+        return hash_partitions(numPartitions)
+    elif partition == PARTITION_TIMESTAMP:
+        return timestamp_partitions(solr_base_url, core, query, fq,
+                                    numPartitions)
+    else:
+        raise ValueError("Unknown partition type: %s" % partition)
+
+
+def hash_partitions(numPartitions):
+    '''
+    Partitions the records by hash ranges of their unique key.
+    Note: requires Solr 6+ and docValues on the unique key.
+    '''
+
+    return ["{!hash workers=%s worker=%s partitionKeys=%s}" % (
+            numPartitions, worker, UNIQUE_KEY)
+            for worker in range(numPartitions)]
+
+
+def timestamp_partitions(solr_base_url, core, query, fq, numPartitions):
+    '''
+    Partitions the records by contiguous _timestamp ranges holding
+    approximately the same number of records, as computed from
+    a stats query followed by a range facet query.
+    '''
+
+    url = solr_base_url + "/" + core + "/select"
+    fquery = to_filter_queries(fq)
+
+    # 1) full _timestamp range
+    params = {"q": query,
+              "fq": fquery,
+              "wt": "json",
+              "stats": "true",
+              "stats.field": TIMESTAMP_FIELD,
+              "rows": "0"}
+    response = http_get_json(url, params)
+    if response is None:
+        raise SolrQueryError("Error querying %s" % url)
+    stats = response['stats']['stats_fields'][TIMESTAMP_FIELD]
+    partitions = []
+    if stats.get('missing', 0):
+        partitions.append("-%s:[* TO *]" % TIMESTAMP_FIELD)
+    if not stats.get('min', None):
+        return partitions
+    dt_min = _parse_datetime(stats['min'])
+    dt_max = _parse_datetime(stats['max']) + datetime.timedelta(seconds=1)
+
+    # 2) number of records in equally spaced buckets
+    numBuckets = numPartitions * BUCKETS_PER_PARTITION
+    gap = int(math.ceil((dt_max - dt_min).total_seconds() / numBuckets))
+    gap = max(gap, 1)
+    params = {"q": query,
+              "fq": fquery,
+              "wt": "json",
+              "rows": "0",
+              "facet": "true",
+              "facet.range": TIMESTAMP_FIELD,
+              "facet.range.start": format_datetime(dt_min),
+              "facet.range.end": format_datetime(dt_max),
+              "facet.range.gap": "+%sSECONDS" % gap}
+    response = http_get_json(url, params)
+    if response is None:
+        raise SolrQueryError("Error querying %s" % url)
+    facet_counts = (
+        response['facet_counts']['facet_ranges'][TIMESTAMP_FIELD]['counts'])
+    counts = [int(count) for count in facet_counts[1::2]]
+    numRecords = sum(counts)
+    logging.info("Partitioning core=%s records=%s from %s to %s" % (
+        core, numRecords, dt_min, dt_max))
+
+    # 3) group consecutive buckets into partitions of similar size
+    dt_start = None
+    numRanges = 0
+    numRecordsSoFar = 0
+    for i, count in enumerate(counts):
+        numRecordsSoFar += count
+        target = numRecords * (numRanges + 1) / float(numPartitions)
+        last = (i == len(counts) - 1)
+        if numRecordsSoFar >= target or last:
+            dt_stop = dt_min + datetime.timedelta(seconds=gap*(i+1))
+            start = format_datetime(dt_start) if dt_start else '*'
+            stop = '*' if last else format_datetime(dt_stop)
+            partitions.append("%s:[%s TO %s}" % (TIMESTAMP_FIELD, start, stop))
+            numRanges += 1
+            dt_start = dt_stop
+
+    return partitions
+
+
+def parse_datetime(value):
+    '''Parses a Solr datetime, as a naive datetime in UTC.'''
+
+    return dateutil.parser.parse(value).replace(tzinfo=None)
+
+
+def _parse_datetime(value):
+    '''Parses a Solr datetime, truncated to the second.'''
+
+    return parse_datetime(value).replace(microsecond=0)
+
+
+def format_datetime(dt):
+    '''Formats a datetime as a Solr datetime, to the second.'''
+
+    return dt.strftime(SOLR_DATETIME_FORMAT)
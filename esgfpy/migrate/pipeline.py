@@ -0,0 +1,84 @@
+'''
+Bounded producer/consumer pipeline, used to overlap the queries
+to a source Solr with the processing and posting of the records
+to a target Solr.
+'''
+
+import logging
+import queue
+import threading
+
+# default maximum number of pages fetched ahead of the writers
+PREFETCH_PAGES = 4
+
+# seconds between checks that the writers are still running
+POLL_SECONDS = 1
+
+
+def run_pipeline(pages, consume, writers=1, prefetch=PREFETCH_PAGES):
+    '''
+    Iterates over 'pages' in the calling thread, while a pool of 'writers'
+    threads invokes 'consume(page)' on each page in turn.
+    At most 'prefetch' pages are queued between the two stages,
+    so that the producer blocks when the writers fall behind.
+    Returns the sum of the values returned by 'consume'.
+    Any error raised by a writer stops the pipeline and is re-raised.
+    '''
+
+    pageQueue = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+    lock = threading.Lock()
+    results = {'total': 0, 'error': None}
+
+    def _write():
+        while True:
+            page = pageQueue.get()
+            if page is None or stop.is_set():
+                return
+            try:
+                value = consume(page)
+                with lock:
+                    results['total'] += value
+            except Exception as e:
+                logging.error("ERROR in pipeline writer: %s" % e)
+                with lock:
+                    if results['error'] is None:
+                        results['error'] = e
+                stop.set()
+                return
+
+    threads = [threading.Thread(target=_write, name="writer-%s" % i)
+               for i in range(max(writers, 1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for page in pages:
+            # block while the queue is full, unless the writers have failed
+            while not stop.is_set():
+                try:
+                    pageQueue.put(page, timeout=POLL_SECONDS)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                break
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        # one end-of-stream marker per writer
+        for thread in threads:
+            while thread.is_alive():
+                try:
+                    pageQueue.put(None, timeout=POLL_SECONDS)
+                    break
+                except queue.Full:
+                    pass
+        for thread in threads:
+            thread.join()
+
+    if results['error'] is not None:
+        raise results['error']
+    return results['total']
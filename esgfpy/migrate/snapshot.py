@@ -0,0 +1,283 @@
+'''
+Python module to read and write offline snapshots of Solr records.
+
+A snapshot is a directory containing gzip compressed, newline delimited
+JSON files (one record per line), each holding at most a fixed number
+of records, and a 'manifest.json' file that lists the files with their
+number of records and SHA-256 checksums, and the _timestamp range
+of all records. A snapshot whose records could not all be read from
+the source is marked as incomplete in its manifest, and cannot be loaded.
+
+Example invocation:
+python esgfpy/migrate/snapshot.py dump https://esgf-node.jpl.nasa.gov/solr \
+    /data/snapshots/jpl-files --core files
+python esgfpy/migrate/snapshot.py load /data/snapshots/jpl-files \
+    http://localhost:8983/solr --posters 8
+'''
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import os
+
+from esgfpy.migrate.partitions import parse_datetime
+
+MANIFEST_FILE = 'manifest.json'
+
+# maximum number of records per snapshot file
+CHUNK_RECORDS = 100000
+
+TIMESTAMP_FIELD = '_timestamp'
+
+# size of the blocks read to compute checksums
+CHECKSUM_BLOCK_BYTES = 1024 * 1024
+
+
+class SnapshotWriter(object):
+    '''
+    Class that writes records to a snapshot directory,
+    starting a new file every 'chunkRecords' records.
+    '''
+
+    def __init__(self, directory, core, query=None, fq=None, source=None,
+                 chunkRecords=CHUNK_RECORDS):
+
+        self.directory = directory
+        self.chunkRecords = chunkRecords
+        self._manifest = {'core': core,
+                          'query': query,
+                          'fq': fq,
+                          'source': source,
+                          'created': datetime.datetime.utcnow().isoformat(),
+                          'numRecords': 0,
+                          'timestamp_min': None,
+                          'timestamp_max': None,
+                          'complete': False,
+                          'chunks': []}
+        self._file = None
+        self._numRecordsInChunk = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def write(self, docs):
+        '''Appends a list of records to the snapshot.'''
+
+        for doc in docs:
+            if self._file is None:
+                self._open_chunk()
+            line = json.dumps(doc, separators=(',', ':'), ensure_ascii=False)
+            self._file.write(line.encode('utf8') + b'\n')
+            self._numRecordsInChunk += 1
+            self._update_timestamps(doc.get(TIMESTAMP_FIELD, None))
+            if self._numRecordsInChunk >= self.chunkRecords:
+                self._close_chunk()
+
+    def close(self, complete=True):
+        '''
+        Closes the last file and writes the manifest, recording whether
+        all the records requested were written.
+        '''
+
+        if self._file is not None:
+            self._close_chunk()
+        self._manifest['complete'] = complete
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        with open(path, 'w') as manifest_file:
+            json.dump(self._manifest, manifest_file, indent=4, sort_keys=True)
+        logging.info("Snapshot written: %s number of records=%s files=%s "
+                     "complete=%s" % (
+                         self.directory, self._manifest['numRecords'],
+                         len(self._manifest['chunks']), complete))
+        return self._manifest
+
+    def _open_chunk(self):
+
+        filename = "%s-%05d.ndjson.gz" % (self._manifest['core'],
+                                          len(self._manifest['chunks']))
+        self._filename = filename
+        self._file = gzip.open(os.path.join(self.directory, filename), 'wb')
+        self._numRecordsInChunk = 0
+
+    def _close_chunk(self):
+
+        self._file.close()
+        self._file = None
+        path = os.path.join(self.directory, self._filename)
+        self._manifest['chunks'].append({
+            'file': self._filename,
+            'numRecords': self._numRecordsInChunk,
+            'bytes': os.path.getsize(path),
+            'sha256': _checksum(path)})
+        self._manifest['numRecords'] += self._numRecordsInChunk
+        logging.info("Snapshot file written: %s number of records=%s" % (
+            path, self._numRecordsInChunk))
+
+    def _update_timestamps(self, timestamp):
+
+        if timestamp is None:
+            return
+        if (self._manifest['timestamp_min'] is None or
+                _before(timestamp, self._manifest['timestamp_min'])):
+            self._manifest['timestamp_min'] = timestamp
+        if (self._manifest['timestamp_max'] is None or
+                _before(self._manifest['timestamp_max'], timestamp)):
+            self._manifest['timestamp_max'] = timestamp
+
+
+class SnapshotReader(object):
+    '''
+    Class that reads the records of a snapshot directory,
+    verifying the checksum of each file before reading it.
+    Raises ValueError if the snapshot is incomplete.
+    '''
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+            self.manifest = json.load(manifest_file)
+        # snapshots written before the flag was recorded are complete
+        if not self.manifest.get('complete', True):
+            raise ValueError("Snapshot %s is incomplete: the dump stopped "
+                             "after %s records" % (
+                                 directory, self.manifest['numRecords']))
+
+    def __iter__(self):
+        '''Iterates over all records of the snapshot.'''
+
+        for chunk in self.manifest['chunks']:
+            for doc in self.read_chunk(chunk):
+                yield doc
+
+    def read_chunk(self, chunk):
+        '''
+        Iterates over the records of one file of the snapshot.
+        The file is memory mapped, so that it is read from the page cache
+        without copying it in the process memory, and decompressed
+        one line at a time.
+        '''
+
+        path = os.path.join(self.directory, chunk['file'])
+        with open(path, 'rb') as chunk_file:
+            mapped = mmap.mmap(chunk_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if hashlib.sha256(mapped).hexdigest() != chunk['sha256']:
+                    raise ValueError("Checksum mismatch for snapshot file: "
+                                     "%s" % path)
+                numRecords = 0
+                with gzip.GzipFile(fileobj=mapped, mode='rb') as lines:
+                    for line in lines:
+                        numRecords += 1
+                        yield json.loads(line.decode('utf8'))
+                if numRecords != chunk['numRecords']:
+                    raise ValueError("Snapshot file %s contains %s records "
+                                     "instead of %s" % (
+                                         path, numRecords,
+                                         chunk['numRecords']))
+            finally:
+                mapped.close()
+
+
+def _before(timestamp1, timestamp2):
+    '''
+    Returns True if the Solr datetime 'timestamp1' is earlier than
+    'timestamp2'. ISO 8601 datetimes in UTC of the same length sort as
+    strings, but not those with a different number of fractional digits
+    (such as '2020-01-01T00:00:00.5Z' and '2020-01-01T00:00:01Z'),
+    which are parsed to be compared.
+    '''
+
+    if len(timestamp1) == len(timestamp2):
+        return timestamp1 < timestamp2
+    return parse_datetime(timestamp1) < parse_datetime(timestamp2)
+
+
+def _checksum(path):
+    '''Computes the SHA-256 checksum of a file.'''
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_BYTES), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+if __name__ == '__main__':
+
+    from esgfpy.migrate.solr2solr import (
+        dump, load, DEFAULT_QUERY, MAX_RECORDS_TOTAL
+        )
+
+    # parse command line arguments
+    parser = argparse.ArgumentParser(
+        description="Offline snapshots of Solr indexes")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parser_dump = subparsers.add_parser(
+        'dump', help="Write the records of a Solr core to a snapshot")
+    parser_dump.add_argument('sourceSolrUrl', type=str,
+                             help="URL of source Solr "
+                             "(example: http://localhost:8983/solr)")
+    parser_dump.add_argument('directory', type=str,
+                             help="Snapshot directory")
+    parser_dump.add_argument('--core', dest='core', type=str,
+                             help="Solr core to be dumped "
+                             "(example: --core datasets)",
+                             required=True)
+    parser_dump.add_argument('--query', dest='query', type=str,
+                             help="Optional query to sub-select records "
+                             "(example: --query project:xyz)",
+                             default=DEFAULT_QUERY)
+    parser_dump.add_argument('--max', dest='max', type=int,
+                             help="Optional maximum number of records "
+                             "(example: --max 1000)",
+                             default=MAX_RECORDS_TOTAL)
+    parser_dump.add_argument('--chunk', dest='chunk', type=int,
+                             help="Maximum number of records per file "
+                             "(example: --chunk 100000)",
+                             default=CHUNK_RECORDS)
+    parser_dump.add_argument('--export', dest='export', action='store_true',
+                             help="Stream the records from the /export "
+                             "handler (only fields with docValues)",
+                             default=False)
+
+    parser_load = subparsers.add_parser(
+        'load', help="Post the records of a snapshot to a Solr core")
+    parser_load.add_argument('directory', type=str,
+                             help="Snapshot directory")
+    parser_load.add_argument('targetSolrUrl', type=str,
+                             help="URL of target Solr "
+                             "(example: http://localhost:8984/solr)")
+    parser_load.add_argument('--core', dest='core', type=str,
+                             help="Optional target core, if different from "
+                             "the core of the snapshot",
+                             default=None)
+    parser_load.add_argument('--posters', dest='posters', type=int,
+                             help="Number of threads posting records "
+                             "(example: --posters 8)",
+                             default=4)
+    parser_load.add_argument('--replace', dest='replace', type=str,
+                             help="Optional string replacements for all "
+                             "values (example: --replace old_value_1:"
+                             "new_value_1,old_value_2:new_value_2)",
+                             default=None)
+    parser_load.add_argument('--suffix', dest='suffix', type=str,
+                             help="Optional suffix string to append to all "
+                             "record ids (example: --suffix abc)",
+                             default='')
+
+    args_dict = vars(parser.parse_args())
+    if args_dict['command'] == 'dump':
+        dump(args_dict['sourceSolrUrl'], args_dict['core'],
+             args_dict['directory'], query=args_dict['query'],
+             maxRecords=args_dict['max'], chunkRecords=args_dict['chunk'],
+             export=args_dict['export'])
+    else:
+        load(args_dict['directory'], args_dict['targetSolrUrl'],
+             core=args_dict['core'], posters=args_dict['posters'],
+             replace=args_dict['replace'], suffix=args_dict['suffix'])
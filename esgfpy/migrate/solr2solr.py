@@ -4,76 +4,202 @@ from a source Solr to a target Solr.
 '''
 
 import argparse
+import asyncio
 import datetime
 import logging
-
-from esgfpy.migrate.solr_client import SolrClient
+import multiprocessing
+import sys
+import threading
+import time
+
+from esgfpy.migrate.async_solr_client import AsyncSolrClient
+from esgfpy.migrate.backpressure import RateController, throttle
+from esgfpy.migrate.batching import AdaptiveBatcher
+from esgfpy.migrate.checkpoint import Checkpoint, is_complete
+from esgfpy.migrate.partitions import (
+    get_partitions, PARTITIONS, PARTITION_TIMESTAMP
+    )
+from esgfpy.migrate.pipeline import run_pipeline, PREFETCH_PAGES
+from esgfpy.migrate.snapshot import (
+    SnapshotReader, SnapshotWriter, CHUNK_RECORDS
+    )
+from esgfpy.migrate.solr_client import (
+    SolrClient, SolrQueryError, SolrUpdateError, SolrRejectedError,
+    CURSOR_MARK_START, ENDPOINT_SELECT, ENDPOINT_UPDATE
+    )
+from esgfpy.migrate.transforms import compile_transforms, parse_replacements
+from esgfpy.migrate.utils import (
+    to_filter_queries, set_wire_mode, wire_stats, serialize_json
+    )
 
 
 MAX_RECORDS_PER_REQUEST = 100
 
+# number of attempts to query a page of records from the source Solr,
+# waiting PAGE_RETRY_DELAY seconds more after each failed attempt
+MAX_PAGE_RETRIES = 3
+PAGE_RETRY_DELAY = 2
+
+# default number of pages posted concurrently by migrate_async()
+ASYNC_CONCURRENCY = 8
+
 # total number of records to be migrated
 MAX_RECORDS_TOTAL = 9999999
 DEFAULT_QUERY = '*:*'
 
 logging.basicConfig(level=logging.INFO)
 
+# queue used by worker processes to report progress to the parent process
+_progressQueue = None
+
 
 def migrate(sourceSolrUrl, targetSolrUrl, core,
             query=DEFAULT_QUERY, fq=None,
             start=0, maxRecords=MAX_RECORDS_TOTAL,
-            replace=None, suffix='', commit=True, optimize=True):
+            replace=None, suffix='', commit=True, optimize=True,
+            cursor=True, writers=0, prefetch=PREFETCH_PAGES,
+            workers=0, partition=PARTITION_TIMESTAMP, progress=None,
+            checkpoint=None, resume=False, adaptive=False, rules=None,
+            export=False, controller=None, javabin=False):
     '''
     By default, it commits the changes and optimizes the index
     when all records have been migrated,
     but note that these client directives
     will be disregarded by an ESGF SolrCloud cluster.
+
+    By default, records are paged with a Solr cursor sorted on the
+    unique key, so that the cost of each request does not grow with
+    the number of records already migrated. Cursor paging cannot
+    skip to an arbitrary offset, so start/rows paging is used instead
+    if 'start' > 0 or 'cursor' is False.
+
+    If 'writers' > 0, the migration is pipelined: up to 'prefetch' pages
+    are queried from the source Solr ahead of time, while 'writers' threads
+    transform and post the previous pages to the target Solr.
+
+    If 'workers' > 0, the records are split into disjoint partitions
+    (by '_timestamp' ranges or by hash ranges of the record id,
+    see esgfpy.migrate.partitions) which are migrated in parallel
+    by 'workers' processes. 'start' and 'maxRecords' then apply
+    to each partition separately.
+
+    'progress', if provided, is invoked with the number of records
+    of each page after it has been migrated.
+
+    If 'checkpoint' is the path of a local file, the position of the
+    migration is saved to that file after each batch of records has been
+    posted. With 'resume'=True, the migration continues from the position
+    saved in the checkpoint file, if existing.
+
+    By default, records are migrated MAX_RECORDS_PER_REQUEST at a time.
+    If 'adaptive' is True, the number of records per request is adjusted
+    towards a target request size and latency (see AdaptiveBatcher).
+    A batch rejected by the target Solr is bisected to isolate the bad
+    records, which are skipped. Any other failure to post (target Solr
+    unavailable, failing fast or returning server errors) stops
+    the migration with SolrUpdateError. A page of records that cannot be
+    queried from the source Solr with a cursor, after MAX_PAGE_RETRIES
+    attempts, stops the migration with SolrQueryError: in both cases,
+    the target index is neither committed nor optimized.
+
+    Records are transformed by a pipeline compiled once per migration
+    (see esgfpy.migrate.transforms) from the 'replace' patterns,
+    the 'suffix' and any additional transformation 'rules'.
+
+    If 'export' is True, the records are streamed from the /export handler
+    of the source Solr instead of being paged from /select: only the fields
+    with docValues are migrated, and the migration cannot start at
+    an offset or resume from a checkpoint.
+
+    If a 'controller' is provided (see esgfpy.migrate.backpressure),
+    update requests to the target Solr are throttled to the concurrency
+    and rate that it adjusts to their latency and errors.
+    The concurrency is also bounded by the number of 'writers'.
+    With 'workers' > 0, each worker process receives an equal share
+    of its limits.
+
+    If 'javabin' is True, records are queried from the source Solr and
+    posted to the target Solr in the javabin binary format instead of JSON
+    (see esgfpy.migrate.javabin). Each endpoint falls back to JSON
+    if it does not accept javabin.
     '''
 
-    # transform replacement string into a dictionary
-    replacements = {}
-    if replace is not None and len(replace) > 0:
-        replaces = replace.split(":\s+")
-        for _replace in replaces:
-            (oldValue, newValue) = _replace.split(':')
-            replacements[oldValue] = newValue
-            logging.debug("Replacing metadata: "
-                          "%s --> %s" % (oldValue, newValue))
+    if export and (start > 0 or checkpoint is not None):
+        raise ValueError("Export mode does not support start or checkpoint")
+
+    fq = to_filter_queries(fq)
+    if workers > 0:
+        return _migrate_partitions(
+            sourceSolrUrl, targetSolrUrl, core, query=query, fq=fq,
+            start=start, maxRecords=maxRecords, replace=replace,
+            suffix=suffix, commit=commit, optimize=optimize, cursor=cursor,
+            writers=writers, prefetch=prefetch, workers=workers,
+            partition=partition, checkpoint=checkpoint, resume=resume,
+            adaptive=adaptive, rules=rules, export=export,
+            controller=controller, javabin=javabin)
+
+    # transformation rules compiled once for all records
+    transform = compile_transforms(core, parse_replacements(replace),
+                                   suffix=suffix, rules=rules)
     t1 = datetime.datetime.now()
+    wireSnapshot = wire_stats.snapshot()
 
     # Solr clients
-    s1 = SolrClient(sourceSolrUrl)
-    s2 = SolrClient(targetSolrUrl)
+    s1 = SolrClient(sourceSolrUrl,
+                    javabin=[ENDPOINT_SELECT] if javabin else [])
+    s2 = SolrClient(targetSolrUrl,
+                    javabin=[ENDPOINT_UPDATE] if javabin else [])
+
+    # optional position to resume from
+    cursorMark = None
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint, sourceSolrUrl, targetSolrUrl,
+                                core, query, fq)
+        state = checkpoint.load() if resume else None
+        if state is not None:
+            if state['complete']:
+                logging.info("Migration already complete according to "
+                             "checkpoint: %s" % checkpoint.path)
+                return 0
+            (cursorMark, start) = (state['cursorMark'], state['start'])
+
+    # optional adaptive number of records per request
+    batcher = None
+    if adaptive:
+        batcher = AdaptiveBatcher(rows=MAX_RECORDS_PER_REQUEST)
+
+    # pages of records from source Solr
+    status = {'complete': False}
+    if export:
+        pages = enumerate(_export_pages(s1, core, query, fq, maxRecords,
+                                        status=status, batcher=batcher))
+    else:
+        pages = enumerate(_query_pages(s1, core, query, fq, start, maxRecords,
+                                       cursor, cursorMark=cursorMark,
+                                       status=status, batcher=batcher))
+
+    def _consume(page):
+        (i, (docs, nextCursorMark, nextStart)) = page
+        # raises unless every record was posted or rejected as a bad record,
+        # so that a page that failed is never checkpointed
+        _numRecords = _migrate_records(s2, core, docs, transform,
+                                       batcher=batcher, controller=controller)
+        if checkpoint is not None:
+            checkpoint.update(i, nextCursorMark, nextStart, _numRecords)
+        if progress is not None:
+            progress(_numRecords)
+        return _numRecords
 
     # number of records migrated so far <= maxRecords
     numRecords = 0
-    numFound = start+1
-    while start < numFound and numRecords < maxRecords:
-
-        # try migrating MAX_RECORDS_PER_REQUEST records at once
-        try:
-            # do NOT migrate more records than this number
-            _maxRecords = min(maxRecords-numRecords, MAX_RECORDS_PER_REQUEST)
-            (_numFound, _numRecords) = _migrate(s1, s2, core, query, fq,
-                                                start, _maxRecords,
-                                                replacements, suffix)
-            numFound = _numFound
-            start += _numRecords
-            numRecords += _numRecords
-
-        # in case of error, migrate 1 record at a time
-        except Exception as e:
-            print(e)
-            for i in range(MAX_RECORDS_PER_REQUEST):
-                if start < numFound and numRecords < maxRecords:
-                    try:
-                        (_numFound, _numRecords) = _migrate(
-                            s1, s2, core, query, fq, start, 1,
-                            replacements, suffix)
-                    except Exception as e:
-                        logging.warn('ERROR migrating record %s: %s' % (i, e))
-                    start += 1
-                    numRecords += 1
+    if writers > 0:
+        logging.info("Pipelined migration: writers=%s prefetch=%s" % (
+            writers, prefetch))
+        numRecords = run_pipeline(pages, _consume,
+                                  writers=writers, prefetch=prefetch)
+    else:
+        for page in pages:
+            numRecords += _consume(page)
 
     # optimize the full index (optimize=True implies commit=True)
     if optimize:
@@ -87,6 +213,292 @@ def migrate(sourceSolrUrl, targetSolrUrl, core,
         s2.commit(core)
         logging.debug("...done")
 
+    if checkpoint is not None and status['complete']:
+        checkpoint.complete()
+
+    t2 = datetime.datetime.now()
+    logging.info("Total number of records migrated: %s" % numRecords)
+    logging.info("Total elapsed time: %s" % (t2-t1))
+    logging.info("Total %s" % wire_stats.report(since=wireSnapshot))
+
+    return numRecords
+
+
+def dump(sourceSolrUrl, core, directory,
+         query=DEFAULT_QUERY, fq=None, maxRecords=MAX_RECORDS_TOTAL,
+         chunkRecords=CHUNK_RECORDS, export=False):
+    '''
+    Writes the records of a core, or of a query, to an offline snapshot
+    in 'directory': gzip compressed files of at most 'chunkRecords'
+    newline delimited JSON records, and a manifest with the number of
+    records, the _timestamp range and the checksum of each file
+    (see esgfpy.migrate.snapshot).
+
+    Records are paged with a Solr cursor, or streamed from the /export
+    handler if 'export' is True, and written unchanged.
+
+    If the source Solr fails before all records have been read,
+    the snapshot is marked as incomplete, so that load() refuses it,
+    and SolrQueryError is raised.
+    '''
+
+    fq = to_filter_queries(fq)
+    t1 = datetime.datetime.now()
+    s1 = SolrClient(sourceSolrUrl)
+    writer = SnapshotWriter(directory, core, query=query, fq=fq,
+                            source=sourceSolrUrl, chunkRecords=chunkRecords)
+
+    status = {'complete': False}
+    if export:
+        pages = _export_pages(s1, core, query, fq, maxRecords, status=status)
+    else:
+        pages = _query_pages(s1, core, query, fq, 0, maxRecords, True,
+                             status=status)
+    numRecords = 0
+    try:
+        for (docs, _, _) in pages:
+            writer.write(docs)
+            numRecords += len(docs)
+    except SolrQueryError:
+        writer.close(complete=False)
+        raise
+
+    # a snapshot limited to 'maxRecords' records is complete
+    complete = status['complete'] or numRecords >= maxRecords
+    manifest = writer.close(complete=complete)
+    if not complete:
+        raise SolrQueryError("Snapshot %s incomplete: the source Solr failed "
+                             "after %s records" % (directory, numRecords))
+
+    t2 = datetime.datetime.now()
+    logging.info("Total number of records dumped: %s" % manifest['numRecords'])
+    logging.info("Total elapsed time: %s" % (t2-t1))
+
+    return manifest['numRecords']
+
+
+def load(directory, targetSolrUrl, core=None, posters=1,
+         replace=None, suffix='', commit=True, optimize=True,
+         adaptive=False, rules=None, controller=None):
+    '''
+    Posts the records of an offline snapshot written by dump()
+    to a target Solr, into 'core' or by default into the core
+    the snapshot was taken from.
+
+    The snapshot files are memory mapped and decompressed in the
+    calling thread, after verifying their checksums, while 'posters'
+    threads transform and post batches of records in parallel.
+    Records are transformed, batched and throttled as in migrate().
+    '''
+
+    reader = SnapshotReader(directory)
+    core = core or reader.manifest['core']
+    transform = compile_transforms(core, parse_replacements(replace),
+                                   suffix=suffix, rules=rules)
+    t1 = datetime.datetime.now()
+    wireSnapshot = wire_stats.snapshot()
+    s2 = SolrClient(targetSolrUrl)
+    logging.info("Loading snapshot: %s number of records=%s into core=%s" % (
+        directory, reader.manifest['numRecords'], core))
+
+    batcher = None
+    if adaptive:
+        batcher = AdaptiveBatcher(rows=MAX_RECORDS_PER_REQUEST)
+
+    def _pages():
+        docs = []
+        for doc in reader:
+            docs.append(doc)
+            rows = MAX_RECORDS_PER_REQUEST
+            if batcher is not None:
+                rows = batcher.rows()
+            if len(docs) >= rows:
+                yield docs
+                docs = []
+        if len(docs) > 0:
+            yield docs
+
+    def _consume(docs):
+        return _migrate_records(s2, core, docs, transform, batcher=batcher,
+                                controller=controller)
+
+    numRecords = run_pipeline(_pages(), _consume, writers=posters)
+
+    if optimize:
+        s2.optimize(core)
+    elif commit:
+        s2.commit(core)
+
+    t2 = datetime.datetime.now()
+    logging.info("Total number of records loaded: %s" % numRecords)
+    logging.info("Total elapsed time: %s" % (t2-t1))
+    logging.info("Total %s" % wire_stats.report(since=wireSnapshot))
+
+    return numRecords
+
+
+async def migrate_async(sourceSolrUrl, targetSolrUrl, core,
+                        query=DEFAULT_QUERY, fq=None,
+                        maxRecords=MAX_RECORDS_TOTAL,
+                        replace=None, suffix='', commit=True, optimize=True,
+                        concurrency=ASYNC_CONCURRENCY, rules=None):
+    '''
+    Coroutine variant of migrate(), using AsyncSolrClient: pages of records
+    are queried with a Solr cursor, while up to 'concurrency' pages are
+    transformed and posted to the target Solr concurrently,
+    all from the calling thread.
+
+    Example:
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(migrate_async(sourceSolrUrl, targetSolrUrl,
+                                              'files', concurrency=16))
+    '''
+
+    fq = to_filter_queries(fq)
+    transform = compile_transforms(core, parse_replacements(replace),
+                                   suffix=suffix, rules=rules)
+    t1 = datetime.datetime.now()
+    s1 = AsyncSolrClient(sourceSolrUrl, concurrency=1)
+    s2 = AsyncSolrClient(targetSolrUrl, concurrency=concurrency)
+
+    # records queried from the source, and posted to the target
+    numRecords = 0
+    numPosted = 0
+    cursorMark = CURSOR_MARK_START
+    posts = set()
+    try:
+        while numRecords < maxRecords:
+            rows = min(MAX_RECORDS_PER_REQUEST, maxRecords-numRecords)
+            response = await s1.query(core, query, 0, rows, fq,
+                                      cursorMark=cursorMark)
+            docs = response['docs']
+            logging.info("Response: current number of records=%s total "
+                         "number of records=%s" % (
+                             numRecords + len(docs), response['numFound']))
+            if len(docs) == 0:
+                break
+            numRecords += len(docs)
+            posts.add(asyncio.ensure_future(
+                _migrate_records_async(s2, core, docs, transform)))
+
+            # at most 'concurrency' pages are held in memory
+            if len(posts) >= concurrency:
+                (done, posts) = await asyncio.wait(
+                    posts, return_when=asyncio.FIRST_COMPLETED)
+                for post in done:
+                    numPosted += post.result()
+
+            if response['nextCursorMark'] == cursorMark:
+                break
+            cursorMark = response['nextCursorMark']
+
+        if posts:
+            numPosted += sum(await asyncio.gather(*posts))
+            posts = set()
+
+        if optimize:
+            await s2.optimize(core)
+        elif commit:
+            await s2.commit(core)
+
+    finally:
+        for post in posts:
+            post.cancel()
+        await s1.close()
+        await s2.close()
+
+    t2 = datetime.datetime.now()
+    logging.info("Total number of records migrated: %s" % numPosted)
+    logging.info("Total elapsed time: %s" % (t2-t1))
+
+    return numPosted
+
+
+def _migrate_partitions(sourceSolrUrl, targetSolrUrl, core, query, fq,
+                        workers, partition, commit, optimize,
+                        checkpoint, resume, controller=None, **kwargs):
+    '''
+    Migrates disjoint partitions of the records in parallel worker processes,
+    then commits or optimizes the target index once.
+    With a checkpoint, the partitions are saved so that they are not
+    recomputed on resume, and each partition saves its own checkpoint.
+    '''
+
+    t1 = datetime.datetime.now()
+    partitions = None
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint, sourceSolrUrl, targetSolrUrl,
+                                core, query, fq)
+        state = checkpoint.load() if resume else None
+        if state is not None:
+            partitions = state.get('partitions', None)
+    if partitions is None:
+        partitions = get_partitions(sourceSolrUrl, core, query, fq,
+                                    workers, partition=partition)
+        if checkpoint is not None:
+            checkpoint.set('partitions', partitions)
+    logging.info("Migrating core=%s in %s partitions with %s workers" % (
+        core, len(partitions), workers))
+
+    # merge the progress reported by all workers
+    progressQueue = multiprocessing.Queue()
+    numRecordsByPartition = [0] * len(partitions)
+
+    def _report():
+        while True:
+            item = progressQueue.get()
+            if item is None:
+                return
+            (i, _numRecords) = item
+            numRecordsByPartition[i] += _numRecords
+            logging.info("Progress: total number of records migrated=%s "
+                         "records per partition=%s" % (
+                             sum(numRecordsByPartition),
+                             numRecordsByPartition))
+
+    reporter = threading.Thread(target=_report)
+    reporter.daemon = True
+    reporter.start()
+
+    # each worker throttles its own share of the target load
+    if controller is not None:
+        kwargs['controller'] = controller.share(workers)
+
+    tasks = []
+    for (i, partitionQuery) in enumerate(partitions):
+        _kwargs = dict(kwargs)
+        if checkpoint is not None:
+            _kwargs.update(checkpoint="%s.%s" % (checkpoint.path, i),
+                           resume=resume)
+        tasks.append((i, sourceSolrUrl, targetSolrUrl, core, query,
+                      fq + [partitionQuery], _kwargs))
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(progressQueue,))
+    try:
+        results = pool.map(_migrate_partition, tasks)
+    finally:
+        pool.close()
+        pool.join()
+        progressQueue.put(None)
+        reporter.join()
+
+    # commit or optimize once, after all workers are done
+    s2 = SolrClient(targetSolrUrl)
+    if optimize:
+        s2.optimize(core)
+    elif commit:
+        s2.commit(core)
+
+    numRecords = 0
+    for (i, _numRecords) in results:
+        logging.info("Partition #%s: %s number of records migrated=%s" % (
+            i, partitions[i], _numRecords))
+        numRecords += _numRecords
+
+    if checkpoint is not None and all(
+            is_complete(task[6]['checkpoint']) for task in tasks):
+        checkpoint.complete()
+
     t2 = datetime.datetime.now()
     logging.info("Total number of records migrated: %s" % numRecords)
     logging.info("Total elapsed time: %s" % (t2-t1))
@@ -94,85 +506,284 @@ def migrate(sourceSolrUrl, targetSolrUrl, core,
     return numRecords
 
 
-def _migrate(s1, s2, core, query, fq, start, howManyMax, replacements, suffix):
+def _init_worker(progressQueue):
+    '''Initializes a worker process for partitioned migration.'''
+
+    global _progressQueue
+    _progressQueue = progressQueue
+
+
+def _migrate_partition(task):
+    '''
+    Migrates one partition of records within a worker process,
+    without committing the changes.
+    '''
+
+    (i, sourceSolrUrl, targetSolrUrl, core, query, fq, kwargs) = task
+
+    def _progress(_numRecords):
+        _progressQueue.put((i, _numRecords))
+
+    numRecords = migrate(sourceSolrUrl, targetSolrUrl, core,
+                         query=query, fq=fq, commit=False, optimize=False,
+                         progress=_progress, **kwargs)
+    return (i, numRecords)
+
+
+def _query_pages(s1, core, query, fq, start, maxRecords, cursor,
+                 cursorMark=None, status=None, batcher=None):
     '''
-    Migrates 'howManyMax' records starting at 'start'.
+    Generator that queries the source Solr for pages of at most
+    MAX_RECORDS_PER_REQUEST records (or as many as the optional
+    'batcher' recommends), until 'maxRecords' records
+    have been returned. Each page is returned as a tuple
+    (records, cursor mark after the page, start after the page).
+    Raises SolrQueryError if a page cannot be queried with a cursor,
+    which cannot skip over it.
+    If provided, status['complete'] is set to True after all
+    the records matching the query have been returned.
     '''
 
-    logging.info("Migrating records: start record=%s max records per request="
-                 "%s" % (start, howManyMax))
+    # current position of the Solr cursor, None for start/rows paging
+    if cursorMark is not None:
+        logging.info("Resuming at cursorMark=%s" % cursorMark)
+    elif cursor:
+        if start == 0:
+            cursorMark = CURSOR_MARK_START
+        else:
+            logging.warning("Cursor paging requires start=0, using "
+                            "start/rows paging from start=%s" % start)
+
+    numRecords = 0
+    numFound = start+1
+    complete = False
+    while start < numFound and numRecords < maxRecords:
+
+        # do NOT query more records than this number
+        rows = MAX_RECORDS_PER_REQUEST
+        if batcher is not None:
+            rows = batcher.rows()
+        _maxRecords = min(maxRecords-numRecords, rows)
+
+        try:
+            response = _query_page(s1, core, query, fq, start, _maxRecords,
+                                   cursorMark)
+
+        except Exception as e:
+
+            # a cursor cannot skip over the page that failed
+            if cursorMark is not None:
+                raise SolrQueryError(
+                    "Error querying records at cursorMark=%s after %s "
+                    "attempts: %s" % (cursorMark, MAX_PAGE_RETRIES, e)) from e
+
+            # in case of error, query 1 record at a time
+            for i in range(_maxRecords):
+                if start < numFound:
+                    try:
+                        docs = _query_records(s1, core, query, fq, start, 1,
+                                              None)['docs']
+                        yield (docs, None, start+1)
+                    except Exception as e:
+                        logging.warn('ERROR migrating record %s: %s' % (i, e))
+                    start += 1
+                    numRecords += 1
+            continue
+
+        numFound = response['numFound']
+        docs = response['docs']
+        start += len(docs)
+        numRecords += len(docs)
+        logging.info("Response: current number of records=%s total number of "
+                     "records=%s" % (start, numFound))
+        if len(docs) == 0:
+            complete = True
+            break
+        nextCursorMark = response.get('nextCursorMark', None)
+        yield (docs, nextCursorMark, start)
+
+        # the cursor stops moving after the last page
+        if cursorMark is not None:
+            if nextCursorMark == cursorMark:
+                complete = True
+                break
+            cursorMark = nextCursorMark
+
+    if status is not None:
+        status['complete'] = complete or start >= numFound
+
+
+def _export_pages(s1, core, query, fq, maxRecords, status=None, batcher=None):
+    '''
+    Generator that streams the records from the /export handler of
+    the source Solr, grouped in pages of MAX_RECORDS_PER_REQUEST records
+    (or as many as the optional 'batcher' recommends),
+    with the same page format as _query_pages().
+    '''
 
-    # query records from source Solr
-    fquery = []
-    if fq is not None:
-        fquery = [fq]
+    logging.info("Exporting: query=%s fq=%s" % (query, fq))
+    docs = []
+    numRecords = 0
+    complete = True
+    for doc in s1.export(core, query, to_filter_queries(fq)):
+        if numRecords >= maxRecords:
+            complete = False
+            break
+        docs.append(doc)
+        numRecords += 1
+        rows = MAX_RECORDS_PER_REQUEST
+        if batcher is not None:
+            rows = batcher.rows()
+        if len(docs) >= rows:
+            logging.info("Exported records: %s" % numRecords)
+            yield (docs, None, numRecords)
+            docs = []
+
+    if len(docs) > 0:
+        logging.info("Exported records: %s" % numRecords)
+        yield (docs, None, numRecords)
+
+    if status is not None:
+        status['complete'] = complete
+
+
+def _query_page(s1, core, query, fq, start, howManyMax, cursorMark):
+    '''
+    Queries a page of records with _query_records(), up to
+    MAX_PAGE_RETRIES times if the source Solr fails.
+    '''
+
+    for attempt in range(1, MAX_PAGE_RETRIES + 1):
+        try:
+            return _query_records(s1, core, query, fq, start, howManyMax,
+                                  cursorMark)
+        except Exception as e:
+            if attempt == MAX_PAGE_RETRIES:
+                raise
+            logging.warning("ERROR querying records at start=%s "
+                            "cursorMark=%s, retrying: %s" % (
+                                start, cursorMark, e))
+            time.sleep(PAGE_RETRY_DELAY * attempt)
+
+
+def _query_records(s1, core, query, fq, start, howManyMax, cursorMark):
+    '''
+    Queries 'howManyMax' records from source Solr starting at 'start',
+    or at 'cursorMark' if a Solr cursor is used.
+    '''
+
+    fquery = to_filter_queries(fq)
     logging.info("Querying: query=%s start=%s rows=%s "
-                 "fq=%s" % (query, start, howManyMax, fquery))
-    response = s1.query(core, query, start=start, rows=howManyMax, fq=fquery)
-    _numFound = response['numFound']
-    _numRecords = len(response['docs'])
+                 "fq=%s cursorMark=%s" % (query, start, howManyMax, fquery,
+                                          cursorMark))
+    response = s1.query(core, query, start=start, rows=howManyMax, fq=fquery,
+                        cursorMark=cursorMark)
     logging.info("Query returned numFound=%s numRecords=%s" % (
-        _numFound, _numRecords))
-
-    # post records to target Solr
-    for result in response['docs']:
-
-        # remove "_version_" field otherwise Solr will return
-        # an HTTP 409 error (Conflict)
-        # by design, "_version_" > 0 will only insert the document
-        # if it exists already with the same _version_
-        if result.get("_version_", None):
-            del result['_version_']
-
-        # append suffix to all ID fields
-        if suffix:
-            result['id'] = result['id'] + suffix
-            result['master_id'] = result['master_id'] + suffix
-            result['instance_id'] = result['instance_id'] + suffix
-            if result.get("dataset_id", None):
-                result['dataset_id'] = result['dataset_id'] + suffix
-
-        # apply replacement patterns to all values
-        if len(replacements) > 0:
-            for key, value in result.items():
-                # multiple values
-                if hasattr(value, "__iter__"):
-                    result[key] = []
-                    for _value in value:
-                        result[key].append(_replaceValue(_value, replacements))
-                # single value
-                else:
-                    result[key] = _replaceValue(value, replacements)
-
-        # Fix broken dataset records
-        if core == 'datasets':
-            for field in ['height_bottom', 'height_top']:
-                value = result.get(field, None)
-                if value:
-                    try:
-                        result[field] = float(value)
-                    except ValueError:
-                        result[field] = 0.
+        response['numFound'], len(response['docs'])))
+    return response
 
-    logging.debug("Adding %s results..." % len(response['docs']))
-    # post all records at once
-    s2.post(response['docs'], core)
-    logging.debug("...done adding")
 
-    logging.info("Response: current number of records=%s total number of "
-                 "records=%s" % (start+_numRecords, _numFound))
+def _migrate_records(s2, core, docs, transform, batcher=None,
+                     controller=None):
+    '''
+    Transforms a page of records and posts them to target Solr.
+    Returns the number of records posted, without the records rejected
+    by the target Solr.
+    '''
 
-    return (_numFound, _numRecords)
+    results = transform(docs)
+    numRejected = _post_bisect(s2, core, results, batcher=batcher,
+                               controller=controller)
+    return len(results) - numRejected
 
 
-def _replaceValue(value, replacements):
-    '''Apply dictionary of 'replacements' patterns to the string 'value'.'''
+async def _migrate_records_async(s2, core, docs, transform):
+    '''
+    Coroutine variant of _migrate_records() for an AsyncSolrClient.
+    '''
 
-    if isinstance(value, str):
-        for oldValue, newValue in replacements.items():
-            value = value.replace(oldValue, newValue)
+    results = transform(docs)
+    numRejected = await _post_bisect_async(s2, core, results)
+    return len(results) - numRejected
 
-    return value
+
+def _post_bisect(s2, core, docs, batcher=None, controller=None):
+    '''
+    Posts records to target Solr. If the records are rejected by Solr,
+    the batch is split in two halves that are posted separately, so that
+    a bad record is isolated in O(log n) requests instead of posting
+    n single records. Any other error is raised, since splitting the batch
+    would not help an unavailable target Solr.
+    The outcome of the full request is reported to the optional 'batcher'.
+    Returns the number of records that were rejected.
+    '''
+
+    if len(docs) == 0:
+        return 0
+
+    try:
+        (numBytes, seconds) = _post_records(s2, core, docs,
+                                            controller=controller)
+        if batcher is not None:
+            batcher.success(len(docs), numBytes, seconds)
+        return 0
+
+    except Exception as e:
+        if batcher is not None:
+            batcher.failure()
+        if not isinstance(e, SolrRejectedError):
+            raise
+        if len(docs) == 1:
+            logging.warn('ERROR migrating record id=%s: %s' % (
+                docs[0].get('id', None), e))
+            return 1
+        logging.warning("Error posting %s records, splitting the batch: "
+                        "%s" % (len(docs), e))
+        half = len(docs) // 2
+        return (_post_bisect(s2, core, docs[:half], controller=controller) +
+                _post_bisect(s2, core, docs[half:], controller=controller))
+
+
+async def _post_bisect_async(s2, core, docs):
+    '''
+    Coroutine variant of _post_bisect() for an AsyncSolrClient.
+    Returns the number of records that were rejected.
+    '''
+
+    if len(docs) == 0:
+        return 0
+
+    try:
+        await s2.post(serialize_json(docs), core)
+        return 0
+
+    except SolrRejectedError as e:
+        if len(docs) == 1:
+            logging.warn('ERROR migrating record id=%s: %s' % (
+                docs[0].get('id', None), e))
+            return 1
+        logging.warning("Error posting %s records, splitting the batch: "
+                        "%s" % (len(docs), e))
+        half = len(docs) // 2
+        return (await _post_bisect_async(s2, core, docs[:half]) +
+                await _post_bisect_async(s2, core, docs[half:]))
+
+
+def _post_records(s2, core, docs, controller=None):
+    '''
+    Posts records to target Solr, within the limits of the optional
+    backpressure 'controller'.
+    Returns the size of the request body in bytes and its duration in seconds.
+    '''
+
+    body = s2.serialize(docs)
+    logging.debug("Adding %s results..." % len(docs))
+    with throttle(controller):
+        t1 = time.time()
+        s2.post(body, core)
+        seconds = time.time() - t1
+    logging.debug("...done adding")
+    return (len(body), seconds)
 
 
 if __name__ == '__main__':
@@ -211,14 +822,96 @@ if __name__ == '__main__':
                         help="Optional suffix string to append to all record "
                         "ids (example: --suffix abc)",
                         default='')
-    args_dict = vars(parser.parse_args())
+    parser.add_argument('--writers', dest='writers', type=int,
+                        help="Optional number of threads posting records to "
+                        "the target Solr while the next records are queried "
+                        "from the source Solr (example: --writers 4)",
+                        default=0)
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help="Optional number of processes migrating "
+                        "disjoint partitions of the records in parallel "
+                        "(example: --workers 8)",
+                        default=0)
+    parser.add_argument('--partition', dest='partition', type=str,
+                        choices=PARTITIONS,
+                        help="How records are partitioned across workers: "
+                        "by _timestamp ranges or by hash ranges of the "
+                        "record id (example: --partition hash)",
+                        default=PARTITION_TIMESTAMP)
+    parser.add_argument('--checkpoint', dest='checkpoint', type=str,
+                        help="Optional local file where the position of the "
+                        "migration is saved after each batch of records "
+                        "(example: --checkpoint /tmp/files.checkpoint)",
+                        default=None)
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help="Resume the migration from the position saved "
+                        "in the --checkpoint file",
+                        default=False)
+    parser.add_argument('--adaptive', dest='adaptive', action='store_true',
+                        help="Adjust the number of records per request "
+                        "to a target request size and latency",
+                        default=False)
+    parser.add_argument('--export', dest='export', action='store_true',
+                        help="Stream the records from the /export handler "
+                        "of the source Solr (only fields with docValues "
+                        "are migrated)",
+                        default=False)
+    parser.add_argument('--backpressure', dest='backpressure',
+                        action='store_true',
+                        help="Adjust the concurrency and rate of the update "
+                        "requests to the latency and errors of the target "
+                        "Solr (at most --writers concurrent requests "
+                        "per worker)",
+                        default=False)
+    parser.add_argument('--compact', dest='compact', action='store_true',
+                        help="Exchange compact JSON with the Solr servers, "
+                        "accepting gzip compressed responses",
+                        default=False)
+    parser.add_argument('--gzip-requests', dest='gzip_requests',
+                        action='store_true',
+                        help="Compress the update requests with gzip "
+                        "(the target Solr must be configured to inflate them)",
+                        default=False)
+    parser.add_argument('--javabin', dest='javabin', action='store_true',
+                        help="Exchange records with the Solr servers "
+                        "in the javabin binary format instead of JSON",
+                        default=False)
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error("--resume requires --checkpoint")
+    args_dict = vars(args)
+    set_wire_mode(compact=args_dict['compact'],
+                  gzip_requests=args_dict['gzip_requests'])
+
+    controller = None
+    if args_dict['backpressure']:
+        controller = RateController(
+            maxConcurrency=(max(args_dict['writers'], 1) *
+                            max(args_dict['workers'], 1)))
 
     # execute migration
-    migrate(args_dict['sourceSolrUrl'],
-            args_dict['targetSolrUrl'],
-            core=args_dict['core'],
-            query=args_dict['query'],
-            start=args_dict['start'],
-            replace=args_dict['replace'],
-            maxRecords=args_dict['max'],
-            suffix=args_dict['suffix'])
+    try:
+        migrate(args_dict['sourceSolrUrl'],
+                args_dict['targetSolrUrl'],
+                core=args_dict['core'],
+                query=args_dict['query'],
+                start=args_dict['start'],
+                replace=args_dict['replace'],
+                maxRecords=args_dict['max'],
+                suffix=args_dict['suffix'],
+                writers=args_dict['writers'],
+                workers=args_dict['workers'],
+                partition=args_dict['partition'],
+                checkpoint=args_dict['checkpoint'],
+                resume=args_dict['resume'],
+                adaptive=args_dict['adaptive'],
+                export=args_dict['export'],
+                controller=controller,
+                javabin=args_dict['javabin'])
+    except (SolrQueryError, SolrUpdateError) as e:
+        logging.error("Migration stopped: %s" % e)
+        sys.exit(1)
+
+    # exit with an error if the checkpointed migration did not complete
+    if args_dict['checkpoint'] and not is_complete(args_dict['checkpoint']):
+        sys.exit(1)
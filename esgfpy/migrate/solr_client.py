@@ -1,16 +1,87 @@
-from esgfpy.migrate.utils import http_get_json, http_post_json
+import logging
+import re
+import threading
+from urllib import error
+
+from esgfpy.migrate import javabin
+from esgfpy.migrate.utils import (
+    http_get_json, http_post_json, http_get_json_docs, http_get_javabin,
+    http_post_javabin, serialize_json, retry_policy
+    )
+
+# unique key of all ESGF cores, used to sort results for cursor paging
+UNIQUE_KEY = 'id'
+
+# initial value of the Solr cursor for deep paging
+CURSOR_MARK_START = '*'
+
+# internal field that is never exported
+VERSION_FIELD = '_version_'
+
+# endpoints that can exchange javabin instead of JSON
+ENDPOINT_SELECT = 'select'
+ENDPOINT_UPDATE = 'update'
+
+# message of the client error returned for a content type not supported
+UNSUPPORTED_CONTENT_TYPE = re.compile(r'unsupported\s*content-?type', re.I)
+
+
+class SolrQueryError(Exception):
+    '''Error raised when a Solr server cannot be queried.'''
+    pass
+
+
+class SolrUpdateError(Exception):
+    '''Error raised when records cannot be posted to a Solr server.'''
+    pass
+
+
+class SolrRejectedError(SolrUpdateError):
+    '''
+    Error raised when a Solr server rejects the records of a request
+    with a client error, as opposed to being unavailable:
+    the same request would fail again.
+    '''
+    pass
+
+
+class SolrExportError(Exception):
+    '''Error reported by the /export handler of a Solr server.'''
+    pass
 
 
 class SolrClient(object):
     '''
     Class to issue query and post requests to a Solr server.
+
+    'javabin' lists the endpoints (ENDPOINT_SELECT, ENDPOINT_UPDATE) that
+    exchange the javabin binary format instead of JSON, which is cheaper
+    to produce and parse for Solr. If an endpoint shows that it does not
+    support javabin before any javabin request to it has succeeded
+    (see _fall_back()), the request is sent again as JSON, and
+    the endpoint falls back to JSON for the lifetime of the client.
+    Any other failure is reported as for a JSON request.
     '''
 
-    def __init__(self, solr_base_url='http://localhost:8983/solr'):
+    def __init__(self, solr_base_url='http://localhost:8983/solr',
+                 javabin=()):
         self._solr_base_url = solr_base_url
+        self._javabin = set(javabin)
+        # endpoints that have accepted a javabin request
+        self._javabinConfirmed = set()
+        self._lock = threading.Lock()
+
+    def query(self, solr_core, query, start, rows, fq,
+              cursorMark=None, sort=None, fl=None):
+        '''
+        Method to execute a generic Solr query, return all fields,
+        or only the fields listed in 'fl'.
 
-    def query(self, solr_core, query, start, rows, fq):
-        '''Method to execute a generic Solr query, return all fields.'''
+        If 'cursorMark' is provided, results are paged with a Solr cursor
+        sorted on the unique key: 'start' is ignored, and the returned
+        response contains the 'nextCursorMark' to request the next page.
+        The cost of each page is then independent of its depth.
+        '''
 
         url = self._solr_base_url + "/" + solr_core + "/select"
 
@@ -23,13 +94,147 @@ class SolrClient(object):
                   "rows": "%s" % rows
                   }
 
-        jdoc = http_get_json(url, params)
-        return jdoc['response']
+        # cursor paging requires start=0 and a sort on the unique key
+        if cursorMark is not None:
+            params["start"] = "0"
+            params["cursorMark"] = cursorMark
+            params["sort"] = sort or "%s asc" % UNIQUE_KEY
+        elif sort is not None:
+            params["sort"] = sort
+        if fl is not None:
+            params["fl"] = ",".join(fl)
+
+        jdoc = None
+        if self._uses_javabin(ENDPOINT_SELECT):
+            try:
+                jdoc = http_get_javabin(url, params, raise_errors=True)
+                self._confirm(ENDPOINT_SELECT)
+            except Exception as e:
+                if not self._fall_back(ENDPOINT_SELECT, e):
+                    raise SolrQueryError("Error querying %s: %s" % (
+                        url, e)) from e
+        if jdoc is None:
+            jdoc = http_get_json(url, params)
+        if jdoc is None:
+            raise SolrQueryError("Error querying %s" % url)
+        response = jdoc['response']
+        if cursorMark is not None:
+            response['nextCursorMark'] = jdoc['nextCursorMark']
+        return response
+
+    def export(self, solr_core, query, fq, fl=None, sort=None):
+        '''
+        Method to stream all records matching a query from the /export
+        handler, sorted on the unique key. The response is parsed
+        incrementally and the records are returned by a generator.
+
+        The /export handler only returns fields with docValues:
+        if 'fl' is not provided, all docValues fields of the core
+        are requested (see docvalues_fields()).
+        '''
+
+        if fl is None:
+            fl = self.docvalues_fields(solr_core)
+
+        url = self._solr_base_url + "/" + solr_core + "/export"
+        params = {"q": query,
+                  "fq": fq,
+                  "fl": ",".join(fl),
+                  "sort": sort or "%s asc" % UNIQUE_KEY,
+                  "wt": "json"
+                  }
+
+        for doc in http_get_json_docs(url, params):
+            # errors that occur while streaming are returned as a record
+            if 'EXCEPTION' in doc:
+                raise SolrExportError(doc['EXCEPTION'])
+            yield doc
+
+    def docvalues_fields(self, solr_core):
+        '''
+        Method to list the fields of a core that can be exported,
+        i.e. the fields with docValues, as reported by the Schema API.
+        '''
+
+        url = self._solr_base_url + "/" + solr_core + "/schema/fields"
+        jdoc = http_get_json(url, {"showDefaults": "true", "wt": "json"})
+        if jdoc is None:
+            raise SolrQueryError("Error querying %s" % url)
+        fields = []
+        for field in jdoc['fields']:
+            if field['name'] == VERSION_FIELD:
+                continue
+            if field.get('docValues', False):
+                fields.append(field['name'])
+            elif field.get('stored', False):
+                logging.warning("Field without docValues will not be "
+                                "exported: %s" % field['name'])
+        return fields
+
+    def serialize(self, docs):
+        '''
+        Method to serialize a list of records for post(),
+        in the format of the update endpoint.
+        '''
+
+        if self._uses_javabin(ENDPOINT_UPDATE):
+            return javabin.dumps_update(docs)
+        return serialize_json(docs)
 
     def post(self, metadata, solr_core):
+        '''
+        Method to post a list of records, or a body serialized with
+        serialize(), to the update handler.
+        Raises SolrRejectedError if the records are rejected by Solr,
+        SolrUpdateError if the request fails for any other reason.
+        '''
 
         url = "%s/%s/update" % (self._solr_base_url, solr_core)
-        http_post_json(url, metadata)
+        if isinstance(metadata, bytes) and javabin.is_javabin(metadata):
+            try:
+                response = http_post_javabin(url, metadata, raise_errors=True)
+                self._confirm(ENDPOINT_UPDATE)
+                return response
+            except Exception as e:
+                if not self._fall_back(ENDPOINT_UPDATE, e):
+                    raise update_error(url, e) from e
+                metadata = javabin.loads_update(metadata)
+        try:
+            return http_post_json(url, metadata, raise_errors=True)
+        except Exception as e:
+            raise update_error(url, e) from e
+
+    def _uses_javabin(self, endpoint):
+
+        with self._lock:
+            return endpoint in self._javabin
+
+    def _confirm(self, endpoint):
+        '''Records that an endpoint has accepted a javabin request.'''
+
+        with self._lock:
+            self._javabinConfirmed.add(endpoint)
+
+    def _fall_back(self, endpoint, e):
+        '''
+        Uses JSON instead of javabin for an endpoint, if the error 'e'
+        of a javabin request shows that the endpoint does not support
+        javabin (see rejects_javabin()), and no javabin request to it
+        has succeeded yet. Returns True if the request must be sent
+        again as JSON.
+        '''
+
+        if not rejects_javabin(e):
+            return False
+        with self._lock:
+            if endpoint in self._javabinConfirmed:
+                return False
+            if endpoint in self._javabin:
+                logging.warning("javabin not supported by %s/%s (%s), "
+                                "falling back to JSON" % (
+                                    self._solr_base_url, endpoint, e))
+                self._javabin.discard(endpoint)
+        return True
 
     def commit(self, solr_core):
         url = "%s/%s/update" % (self._solr_base_url, solr_core)
@@ -39,3 +244,37 @@ class SolrClient(object):
 
         url = "%s/%s/update" % (self._solr_base_url, solr_core)
         return http_get_json(url, {'optimize': 'true'})
+
+
+def rejects_javabin(e):
+    '''
+    Returns True if the error 'e' of a javabin request shows that the
+    endpoint does not support javabin: an unsupported media type,
+    a client error about the content type, or a response that is
+    not javabin.
+    '''
+
+    if isinstance(e, error.HTTPError):
+        if e.code == 415:
+            return True
+        if e.code == 400:
+            try:
+                message = (e.read() or b'').decode('utf8', 'replace')
+            except Exception:
+                return False
+            return UNSUPPORTED_CONTENT_TYPE.search(message) is not None
+        return False
+    # raised by the javabin decoder
+    return isinstance(e, ValueError)
+
+
+def update_error(url, e):
+    '''
+    Returns the SolrUpdateError for the error 'e' of an update request:
+    a SolrRejectedError for a client error that is not worth retrying.
+    '''
+
+    if (isinstance(e, error.HTTPError) and 400 <= e.code < 500 and
+            not retry_policy.retryable(e)):
+        return SolrRejectedError("Records rejected by %s: %s" % (url, e))
+    return SolrUpdateError("Error posting to %s: %s" % (url, e))
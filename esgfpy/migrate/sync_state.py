@@ -0,0 +1,81 @@
+'''
+Python module to persist the state of the synchronizations between runs,
+in a local SQLite database: for each (source, target, core, query),
+the high-water mark, the latest _timestamp verified to be in sync.
+'''
+
+import logging
+import sqlite3
+import threading
+
+import dateutil.parser
+
+from esgfpy.migrate.partitions import format_datetime
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sync_state (
+           source TEXT, target TEXT, core TEXT, query TEXT,
+           high_water TEXT,
+           PRIMARY KEY (source, target, core, query))''',
+    # verified intervals written by previous versions, never read
+    '''DROP TABLE IF EXISTS sync_intervals''',
+]
+
+
+class SyncState(object):
+    '''
+    Class that stores the state of the synchronizations in the SQLite
+    database at 'path'. It can be shared by the threads of a process.
+    Datetimes are stored as Solr datetimes, to the second,
+    so that they can be compared as strings.
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            for statement in _SCHEMA:
+                self._connection.execute(statement)
+
+    def get_high_water(self, source, target, core, query):
+        '''
+        Returns the latest _timestamp verified to be in sync,
+        or None if the core was never verified.
+        '''
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT high_water FROM sync_state WHERE source=? "
+                "AND target=? AND core=? AND query=?",
+                (source, target, core, query)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return dateutil.parser.parse(row[0])
+
+    def advance_high_water(self, source, target, core, query, dt_stop):
+        '''
+        Records that the records up to 'dt_stop' were verified to be
+        in sync: advances the high-water mark to 'dt_stop',
+        unless it is already later.
+        '''
+
+        key = (source, target, core, query)
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT high_water FROM sync_state WHERE source=? "
+                "AND target=? AND core=? AND query=?", key).fetchone()
+            high_water = format_datetime(dt_stop)
+            if row is not None and row[0] is not None:
+                high_water = max(high_water, row[0])
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?, ?)",
+                key + (high_water,))
+        logging.info("Sync state: core=%s verified to %s, high-water=%s" % (
+            core, format_datetime(dt_stop), high_water))
+
+    def close(self):
+
+        with self._lock:
+            self._connection.close()
@@ -3,19 +3,43 @@ Python module to synchronize a source and target Sorl servers.
 Records are synchronized by splitting time in progressively smaller
 intervals (months, days, hours) and looping backward
 since the records most likely to have changed were the latest to be published.
-For each interval, the synchronization process checks the total number of records
-and the (min, max, mean) of the timestamp distribution.
+For each interval, the synchronization process checks the total number
+of records and the (min, max, mean) of the timestamp distribution.
+Alternatively, the intervals that differ can be searched with one range facet
+request per level and per server (see Synchronizer.find_divergent_intervals),
+and the cores and intervals can be synchronized concurrently.
+Changes that leave these statistics unchanged are found by comparing
+trees of digests of the record ids and timestamps
+(see esgfpy.migrate.digests).
+With a persistent state (see esgfpy.migrate.sync_state), each run only
+searches the records published since the last verified high-water mark,
+minus a look-back period.
+A full reconciliation (see Synchronizer.reconcile) compares instead
+all the record ids and timestamps of the two servers.
 '''
 
 import logging
 import argparse
+import json
+import asyncio
 import urllib
 import dateutil.parser
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from monthdelta import monthdelta
+from esgfpy.migrate.async_solr_client import AsyncSolrClient, MAX_CONCURRENCY
+from esgfpy.migrate.backpressure import RateController, throttle
+from esgfpy.migrate.digests import DigestTree, diff_trees, hour_interval
+from esgfpy.migrate.id_scan import (
+    scan_ids, stream_ids, diff, merge_join, ADD, UPDATE, DELETE
+    )
+from esgfpy.migrate.partitions import format_datetime
 from esgfpy.migrate.solr2solr import migrate
+from esgfpy.migrate.solr_client import SolrQueryError
+from esgfpy.migrate.sync_state import SyncState
 from esgfpy.migrate.utils import (
-    get_timestamp_query, http_post_json, http_get_json
+    get_timestamp_query, http_post_json, http_get_json,
+    set_wire_mode, wire_stats, open_circuits
     )
 
 logging.basicConfig(level=logging.INFO)
@@ -30,33 +54,227 @@ CORES = [CORE_DATASETS, CORE_FILES, CORE_AGGREGATIONS]
 DELTA_MONTH = monthdelta(1)
 DELTA_DAY = timedelta(days=1)
 DELTA_HOUR = timedelta(hours=1)
-MAX_DATASETS_PER_HOUR = 10000
+
+# period before the last high-water mark that is searched again
+LOOKBACK_DAYS = 7
+
+# number of datasets copied together by one terms query per core
+MAX_DATASETS_PER_BATCH = 500
+
+# number of records copied or deleted together by reconcile()
+MAX_IDS_PER_BATCH = 500
+
+# separator of the values of a terms query: ESGF ids may contain commas,
+# the default separator, but not control characters
+TERMS_SEPARATOR = '\x1f'
+
+# levels of the divergence search: Solr date math gap of the range facet,
+# and the corresponding length of its buckets
+SEARCH_LEVELS = [('+1MONTH', DELTA_MONTH),
+                 ('+1DAY', DELTA_DAY),
+                 ('+1HOUR', DELTA_HOUR)]
+
+# statistics of the _timestamp field computed for each range facet bucket
+TIMESTAMP_FACET_STATS = {'min': 'min(_timestamp)',
+                         'max': 'max(_timestamp)',
+                         'mean': 'avg(_timestamp)'}
 
 
 class Synchronizer(object):
     '''
     Class that synchronizes records from a source
     Solr server into a target Solr server.
+    If a backpressure 'controller' is provided, all updates to the
+    target Solr (migrations and deletions) are throttled by it.
+    If a SyncState 'state' is provided, the intervals to sync are searched
+    from the month including the last high-water mark of each core minus
+    the 'lookback' period, and the records verified to be in sync at the
+    end of each run are recorded. Records older than that which differ
+    are only synced by a run without state.
     '''
 
-    def __init__(self, source_solr_base_url, target_solr_base_url):
+    def __init__(self, source_solr_base_url, target_solr_base_url,
+                 controller=None, state=None,
+                 lookback=timedelta(days=LOOKBACK_DAYS)):
 
         self.source_solr_base_url = source_solr_base_url
         self.target_solr_base_url = target_solr_base_url
+        self.controller = controller
+        self.state = state
+        self.lookback = lookback
         logging.info("Synchronizing: %s --> %s" % (source_solr_base_url,
                                                    target_solr_base_url))
 
-    def sync(self, query=DEFAULT_QUERY):
-        '''Main method to sync from the source Solr to the target Solr.'''
+    def sync(self, query=DEFAULT_QUERY, facets=False, workers=0,
+             digests=None):
+        '''
+        Main method to sync from the source Solr to the target Solr.
+        By default, the months, days and hours are checked one at a time.
+        If 'facets' is True, the hours that differ are found first
+        with range facet requests (see find_divergent_intervals).
+        If 'digests' is the path of a local directory, the hours that differ
+        are found by comparing digest trees cached in that directory
+        (see find_divergent_intervals_by_digests), even if the statistics
+        of the two cores are the same.
+        If 'workers' > 0, the cores are synchronized concurrently
+        (see _sync_concurrent).
+        '''
 
         logging.info("\tQuery: %s" % query)
 
-        # flag to trigger commit/harvest
-        synced = False
         numRecordsSynced = {CORE_DATASETS: 0,
                             CORE_FILES: 0,
                             CORE_AGGREGATIONS: 0}
 
+        # flag to trigger commit/harvest
+        if workers > 0:
+            synced = self._sync_concurrent(query, facets, digests, workers,
+                                           numRecordsSynced)
+        else:
+            synced = self._sync_sequential(query, facets, digests,
+                                           numRecordsSynced)
+
+        # if any synchronization took place
+        if synced:
+
+            # commit changes and optimize the target index
+            # note that these instructions will be disregarded on Solr Cloud
+            self._commit_solr(self.target_solr_base_url)
+            self._optimize_solr(self.target_solr_base_url)
+
+            # check status before existing
+            for core in CORES:
+                logging.info("Core=%s number of records migrated=%s" % (
+                    core, numRecordsSynced[core]))
+                retDict = self._check_sync(core=core, query=query)
+                if retDict is None:
+                    logging.warning("Core=%s sync status unknown" % core)
+                    continue
+                logging.info("Core=%s sync status=%s number of source "
+                             "records=%s number of target records=%s" % (
+                                 core,
+                                 retDict['status'],
+                                 retDict['source']['counts'],
+                                 retDict['target']['counts']))
+
+        if self.state is not None:
+            self._save_sync_state(query)
+
+        logging.info("Synchronization %s" % wire_stats.report())
+        circuits = open_circuits()
+        if circuits:
+            logging.warning("Hosts failing fast at the end of the "
+                            "synchronization: %s" % circuits)
+
+    def reconcile(self, query=DEFAULT_QUERY):
+        '''
+        Method to fully reconcile the target Solr with the source Solr:
+        for each core, the ids and _timestamps of all the records are
+        streamed from both servers sorted by id, and merged in a single pass
+        (see esgfpy.migrate.id_scan.merge_join). The records to add or
+        update are copied, and those to delete are deleted, by batches
+        while the streams are read, and each core is committed once.
+        Unlike sync(), this finds every difference whatever the statistics
+        of the intervals, in time linear in the number of records and
+        in memory independent of it.
+        '''
+
+        logging.info("\tReconciling query: %s" % query)
+
+        for core in CORES:
+            counts = self._reconcile_core(core, query)
+            if counts[ADD] or counts[UPDATE] or counts[DELETE]:
+                self._commit_core(self.target_solr_base_url, core)
+            logging.info("Core=%s reconciled: records added=%s updated=%s "
+                         "deleted=%s" % (core, counts[ADD], counts[UPDATE],
+                                         counts[DELETE]))
+
+        logging.info("Reconciliation %s" % wire_stats.report())
+        circuits = open_circuits()
+        if circuits:
+            logging.warning("Hosts failing fast at the end of the "
+                            "reconciliation: %s" % circuits)
+
+    def _reconcile_core(self, core, query, fq=None):
+        '''
+        Method that reconciles the records of one core matching
+        the query and filter queries, without committing.
+        The records written to the target are not seen by its stream,
+        which has already read past their ids.
+        Returns the number of records of each action of the merge.
+        '''
+
+        fq = fq or []
+        counts = {ADD: 0, UPDATE: 0, DELETE: 0}
+        copy_ids = []
+        delete_ids = []
+        try:
+            for (action, record_id) in merge_join(
+                    stream_ids(self.source_solr_base_url, core, query, fq),
+                    stream_ids(self.target_solr_base_url, core, query, fq)):
+                counts[action] += 1
+                if action == DELETE:
+                    delete_ids.append(record_id)
+                    if len(delete_ids) >= MAX_IDS_PER_BATCH:
+                        counts[DELETE] -= self._delete_records(core,
+                                                               delete_ids)
+                        delete_ids = []
+                else:
+                    copy_ids.append(record_id)
+                    if len(copy_ids) >= MAX_IDS_PER_BATCH:
+                        self._copy_records(core, copy_ids)
+                        copy_ids = []
+        except SolrQueryError as e:
+            logging.warning("Error reconciling core=%s, the remaining "
+                            "records are skipped: %s" % (core, e))
+
+        if delete_ids:
+            counts[DELETE] -= self._delete_records(core, delete_ids)
+        if copy_ids:
+            self._copy_records(core, copy_ids)
+        return counts
+
+    def _delete_records(self, core, record_ids):
+        '''
+        Deletes from the target Solr the records that do not exist at the
+        source Solr, with one request without commit. The records that
+        still exist at the source, outside of the filter queries of the
+        merge, are synced with the records of their own interval.
+        Returns the number of records that were not deleted.
+        '''
+
+        existing_ids = self._check_records(self.source_solr_base_url, core,
+                                           record_ids)
+        record_ids = [record_id for record_id in record_ids
+                      if record_id not in existing_ids]
+        if record_ids:
+            logging.info("\t\t\t\tDeleting %s records: %s..." % (
+                len(record_ids), record_ids[0]))
+            self._delete_solr_records_by_id(self.target_solr_base_url, core,
+                                            record_ids)
+        return len(existing_ids)
+
+    def _copy_records(self, core, record_ids):
+        '''Copies records by id, with one terms query, without commit.'''
+
+        logging.info("\t\t\t\tCopying %s source records: %s..." % (
+            len(record_ids), record_ids[0]))
+        return migrate(self.source_solr_base_url,
+                       self.target_solr_base_url,
+                       core,
+                       query=_terms_query('id', record_ids),
+                       commit=False,
+                       optimize=False,
+                       controller=self.controller)
+
+    def _sync_sequential(self, query, facets, digests, numRecordsSynced):
+        '''
+        Method that synchronizes the cores one at a time.
+        Returns True if any synchronization took place.
+        '''
+
+        synced = False
+
         # loop over cores
         for core in CORES:
 
@@ -68,24 +286,45 @@ class Synchronizer(object):
                 # skip the rest of this iteration
                 continue
 
-            if retDict['status']:
+            if retDict['status'] and (
+                    digests is None or retDict['source']['counts'] == 0):
                 logging.info("Solr cores '%s' are in sync, "
                              "no further action necessary" % core)
 
             else:
 
-                # must issue commit/optimize before exiting
-                synced = True
-
                 # 0) full datetime interval to synchronize
                 # aka maximum time interval spanning the two Solrs
                 (dt_min,
                  dt_max) = self._get_sync_dt_interval(retDict)
+                dt_min = self._apply_sync_window(core, query, dt_min)
                 logging.info("SYNCING: core=%s start=%s stop=%s # records="
                              "%s --> %s" % (core, dt_min, dt_max,
                                             retDict['source']['counts'],
                                             retDict['target']['counts']))
 
+                if facets or digests is not None:
+                    intervals = self._search_divergent_intervals(
+                        core, query, dt_min, dt_max, facets, digests)
+                    if intervals is None:
+                        logging.warning("Error searching the intervals "
+                                        "to sync for core=%s, skipping "
+                                        "it" % core)
+                        continue
+                    # must issue commit/optimize before exiting
+                    synced = synced or len(intervals) > 0
+                    for (dt_start_hour, dt_stop_hour) in intervals:
+                        logging.info("\tHOUR sync=%s start=%s stop=%s" % (
+                            core, dt_start_hour, dt_stop_hour))
+                        self._sync_interval(
+                            core, query,
+                            get_timestamp_query(dt_start_hour, dt_stop_hour),
+                            numRecordsSynced)
+                    continue
+
+                # must issue commit/optimize before exiting
+                synced = True
+
                 # 1) loop over MONTHS - backward because it is more likely that
                 # the records that changed are the latest
                 dt_stop_month = dt_max
@@ -101,6 +340,11 @@ class Synchronizer(object):
 
                     retDict = self._check_sync(core=core, query=query,
                                                fq=timestamp_query_month)
+                    if retDict is None:
+                        logging.warning("\tMONTH check failed, skipping "
+                                        "start=%s stop=%s" % (
+                                            dt_start_month, dt_stop_month))
+                        continue
 
                     # migrate records source_solr --> target_solr
                     if not retDict['status']:
@@ -126,6 +370,11 @@ class Synchronizer(object):
 
                             retDict = self._check_sync(core=core, query=query,
                                                        fq=timestamp_query_day)
+                            if retDict is None:
+                                logging.warning("\t\tDAY check failed, "
+                                                "skipping start=%s stop=%s" % (
+                                                    dt_start_day, dt_stop_day))
+                                continue
 
                             # migrate records source_solr --> target_solr
                             if not retDict['status']:
@@ -139,7 +388,8 @@ class Synchronizer(object):
                                 # 3) loop over HOURS - backward
                                 dt_stop_hour = dt_stop_day
                                 dt_start_hour = dt_stop_day
-                                while dt_stop_hour >= (dt_start_day + DELTA_HOUR):
+                                while dt_stop_hour >= (
+                                        dt_start_day + DELTA_HOUR):
 
                                     dt_stop_hour = dt_start_hour
                                     dt_start_hour = (
@@ -151,9 +401,15 @@ class Synchronizer(object):
                                     timestamp_query_hour = get_timestamp_query(
                                         dt_start_hour, dt_stop_hour)
 
-                                    retDict = self._check_sync(core=core,
-                                                               query=query,
-                                                               fq=timestamp_query_hour)
+                                    retDict = self._check_sync(
+                                        core=core, query=query,
+                                        fq=timestamp_query_hour)
+                                    if retDict is None:
+                                        logging.warning(
+                                            "\t\t\tHOUR check failed, "
+                                            "skipping start=%s stop=%s" % (
+                                                dt_start_hour, dt_stop_hour))
+                                        continue
 
                                     # migrate records source_solr
                                     # --> target_solr
@@ -168,30 +424,16 @@ class Synchronizer(object):
                                                 retDict['source']['counts'],
                                                 retDict['target']['counts']))
 
-                                        # synchronize by dataset id
-                                        if core == CORE_DATASETS:
-                                            (numDatasets, numFiles,
-                                             numAggregations) = (
-                                                 self._sync_all_cores_by_dataset_id(
-                                                     query,
-                                                     timestamp_query_hour))
-                                            numRecordsSynced[CORE_DATASETS] += numDatasets
-                                            numRecordsSynced[CORE_FILES] += numFiles
-                                            numRecordsSynced[CORE_AGGREGATIONS] += numAggregations
-
-                                        # synchronize by datetime interval
-                                        else:
-                                            numRecordsSynced[core] += (
-                                                self._sync_records_by_time(
-                                                    core, query,
-                                                    timestamp_query_hour))
+                                        self._sync_interval(
+                                            core, query, timestamp_query_hour,
+                                            numRecordsSynced)
 
                                         # check DAY sync again to determine
                                         # whether the hour loop can be stopped
                                         retDict = self._check_sync(
                                             core=core, query=query,
                                             fq=timestamp_query_day)
-                                        if retDict['status']:
+                                        if retDict and retDict['status']:
                                             logging.info(
                                                 "\t\tSolr servers are now in "
                                                 "sync for DAY: "
@@ -204,7 +446,7 @@ class Synchronizer(object):
                                 retDict = self._check_sync(
                                     core=core, query=query,
                                     fq=timestamp_query_month)
-                                if retDict['status']:
+                                if retDict and retDict['status']:
                                     logging.info("\tSolr servers are now in "
                                                  "sync for MONTH: "
                                                  "%s" % timestamp_query_month)
@@ -214,31 +456,313 @@ class Synchronizer(object):
                             # check FULL sync again to determine whether
                             # the month loop can be stopped
                             retDict = self._check_sync(core=core, query=query)
-                            if retDict['status']:
+                            if retDict and retDict['status']:
                                 logging.info("Solr servers are now in sync "
                                              "for FULL DATETIME INTERVAL")
                                 # break out of the MONTH bin loop
                                 break
 
-        # if any synchronization took place
-        if synced:
+        return synced
 
-            # commit changes and optimize the target index
-            # note that these instructions will be disregarded on Solr Cloud
-            self._commit_solr(self.target_solr_base_url)
-            self._optimize_solr(self.target_solr_base_url)
+    def _sync_concurrent(self, query, facets, digests, workers,
+                         numRecordsSynced):
+        '''
+        Method that synchronizes the cores in parallel threads. The datasets
+        core is synchronized first, since it also reconciles the files and
+        aggregations of each dataset it migrates: only then are the other
+        cores synchronized in parallel, by time interval, so that the two
+        never migrate the same records at once. Within each core, all the
+        buckets of a level (months, days, hours) are checked
+        at once, with the source and target probes in flight together
+        (at most 'workers' per server, see check_sync_many), and only the
+        buckets that differ are split at the next level. The hours that
+        differ are synchronized by a pool of 'workers' threads shared by
+        all cores, so that the wall time is bounded by the slowest probes
+        rather than by their number.
+        Returns True if any synchronization took place.
+        '''
 
-            # check status before existing
-            for core in CORES:
-                logging.info("Core=%s number of records migrated=%s" % (
-                    core, numRecordsSynced[core]))
-                retDict = self._check_sync(core=core, query=query)
-                logging.info("Core=%s sync status=%s number of source "
-                             "records=%s number of target records=%s" % (
-                                 core,
-                                 retDict['status'],
-                                 retDict['source']['counts'],
-                                 retDict['target']['counts']))
+        otherCores = [core for core in CORES if core != CORE_DATASETS]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = [self._sync_core_concurrent(
+                CORE_DATASETS, query, facets, digests, workers, executor)]
+            with ThreadPoolExecutor(
+                    max_workers=len(otherCores)) as coreExecutor:
+                results += list(coreExecutor.map(
+                    lambda core: self._sync_core_concurrent(
+                        core, query, facets, digests, workers, executor),
+                    otherCores))
+
+        synced = False
+        for (_synced, _numRecordsSynced) in results:
+            synced = synced or _synced
+            for (core, numRecords) in _numRecordsSynced.items():
+                numRecordsSynced[core] += numRecords
+        return synced
+
+    def _sync_core_concurrent(self, core, query, facets, digests, concurrency,
+                              executor):
+        '''
+        Method that synchronizes one core for _sync_concurrent(),
+        submitting the hours to sync to 'executor'.
+        Returns (True if any synchronization took place,
+        dictionary of the number of records migrated for each core).
+        '''
+
+        retDict = self.check_sync_many(core, ["_timestamp:[* TO *]"],
+                                       query=query,
+                                       concurrency=concurrency)[0]
+        if not retDict:
+            logging.warning("Error synchronizing core=%s, "
+                            "skipping it" % core)
+            return (False, {})
+        if retDict['status'] and (
+                digests is None or retDict['source']['counts'] == 0):
+            logging.info("Solr cores '%s' are in sync, "
+                         "no further action necessary" % core)
+            return (False, {})
+
+        (dt_min, dt_max) = self._get_sync_dt_interval(retDict)
+        dt_min = self._apply_sync_window(core, query, dt_min)
+        logging.info("SYNCING: core=%s start=%s stop=%s # records="
+                     "%s --> %s" % (core, dt_min, dt_max,
+                                    retDict['source']['counts'],
+                                    retDict['target']['counts']))
+        intervals = self._search_divergent_intervals(
+            core, query, dt_min, dt_max, facets, digests,
+            concurrency=concurrency)
+        if intervals is None:
+            logging.warning("Error searching the intervals to sync "
+                            "for core=%s, skipping it" % core)
+            return (False, {})
+
+        futures = []
+        for (dt_start_hour, dt_stop_hour) in intervals:
+            logging.info("\tHOUR sync=%s start=%s stop=%s" % (
+                core, dt_start_hour, dt_stop_hour))
+            futures.append(executor.submit(
+                self._sync_interval, core, query,
+                get_timestamp_query(dt_start_hour, dt_stop_hour),
+                {CORE_DATASETS: 0, CORE_FILES: 0, CORE_AGGREGATIONS: 0}))
+
+        numRecordsSynced = {}
+        for future in futures:
+            for (_core, numRecords) in future.result().items():
+                numRecordsSynced[_core] = (
+                    numRecordsSynced.get(_core, 0) + numRecords)
+        return (len(futures) > 0, numRecordsSynced)
+
+    def _search_divergent_intervals(self, core, query, dt_min, dt_max,
+                                    facets, digests, concurrency=0):
+        '''
+        Method that searches the hours to sync with digest trees if a
+        'digests' directory is provided, else with range facets if 'facets'
+        is True, else with concurrent stats probes.
+        '''
+
+        if digests is not None:
+            return self.find_divergent_intervals_by_digests(
+                core, query, dt_min, dt_max, digests)
+        elif facets:
+            return self.find_divergent_intervals(core, query, dt_min, dt_max)
+        else:
+            return self._find_divergent_intervals_by_stats(
+                core, query, dt_min, dt_max, concurrency)
+
+    def find_divergent_intervals_by_digests(self, core, query, dt_min, dt_max,
+                                            cacheDir):
+        '''
+        Method that searches the hours of [dt_min, dt_max) in which the
+        source and target Solrs differ by comparing their digest trees,
+        cached in 'cacheDir' (see esgfpy.migrate.digests). Only the hours
+        whose number of records changed since the previous run are
+        recomputed. The target digests of the hours that differ are
+        discarded, since these hours are about to be synchronized.
+        Returns the list of (start, stop) datetimes of the hours that differ,
+        latest first, or None if a Solr server cannot be queried.
+        '''
+
+        trees = [DigestTree(solr_base_url, core, query, cacheDir)
+                 for solr_base_url in [self.source_solr_base_url,
+                                       self.target_solr_base_url]]
+
+        def _update(tree):
+            tree.load()
+            tree.update(dt_min, dt_max)
+            tree.save()
+
+        # update both trees at the same time
+        try:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(_update, trees))
+        except SolrQueryError as e:
+            logging.warning("Error updating the digests: %s" % e)
+            return None
+
+        keys = diff_trees(trees[0], trees[1])
+        trees[1].invalidate(keys)
+        trees[1].save()
+        logging.info("\tDigest comparison: core=%s number of hours "
+                     "that differ=%s" % (core, len(keys)))
+        return [hour_interval(key) for key in reversed(keys)]
+
+    def _find_divergent_intervals_by_stats(self, core, query, dt_min, dt_max,
+                                           concurrency):
+        '''
+        Method equivalent to find_divergent_intervals(), but checking the
+        buckets of each level with concurrent stats probes instead of
+        range facets. Buckets that cannot be checked are skipped,
+        as in the sequential synchronization.
+        '''
+
+        intervals = [(dt_min, dt_max)]
+        for (gap, delta) in SEARCH_LEVELS:
+            buckets = []
+            for (dt_start, dt_stop) in intervals:
+                dt = dt_start
+                while dt < dt_stop:
+                    buckets.append((dt, dt + delta))
+                    dt = dt + delta
+            if not buckets:
+                break
+
+            retDicts = self.check_sync_many(
+                core, [get_timestamp_query(dt_start, dt_stop)
+                       for (dt_start, dt_stop) in buckets],
+                query=query, concurrency=concurrency)
+            intervals = [bucket for (bucket, retDict)
+                         in zip(buckets, retDicts)
+                         if retDict is not None and not retDict['status']]
+            logging.info("\tDivergence search: core=%s gap=%s number of "
+                         "intervals=%s --> %s" % (core, gap, len(buckets),
+                                                  len(intervals)))
+
+        return sorted(intervals, reverse=True)
+
+    def _sync_interval(self, core, query, timestamp_query, numRecordsSynced):
+        '''
+        Method that synchronizes the records of a core within a time interval,
+        and adds the number of records migrated to 'numRecordsSynced',
+        which is returned.
+        '''
+
+        # synchronize by dataset id
+        if core == CORE_DATASETS:
+            (numDatasets, numFiles,
+             numAggregations) = self._sync_all_cores_by_dataset_id(
+                 query, timestamp_query)
+            numRecordsSynced[CORE_DATASETS] += numDatasets
+            numRecordsSynced[CORE_FILES] += numFiles
+            numRecordsSynced[CORE_AGGREGATIONS] += numAggregations
+
+        # synchronize by datetime interval
+        else:
+            numRecordsSynced[core] += self._sync_records_by_time(
+                core, query, timestamp_query)
+
+        return numRecordsSynced
+
+    def find_divergent_intervals(self, core, query, dt_min, dt_max):
+        '''
+        Method that searches the hours of [dt_min, dt_max] in which the
+        source and target Solrs differ. At each level (months, days, hours),
+        a single range facet request to each server returns the counts
+        and _timestamp stats of all the buckets within the intervals that
+        differ at the previous level, so that only those are searched further.
+        Returns the list of (start, stop) datetimes of the hours that differ,
+        latest first, or None if a Solr server cannot be queried.
+        '''
+
+        intervals = [(dt_min, dt_max)]
+        for (gap, delta) in SEARCH_LEVELS:
+            if not intervals:
+                break
+
+            # query both servers at the same time
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                (buckets1, buckets2) = executor.map(
+                    lambda solr_base_url: self._query_solr_facet_ranges(
+                        solr_base_url, core, query, intervals, gap),
+                    [self.source_solr_base_url, self.target_solr_base_url])
+            if buckets1 is None:
+                logging.warning("Error querying URL: %s" % (
+                    self.source_solr_base_url))
+                return None
+            if buckets2 is None:
+                logging.warning("Error querying URL: %s" % (
+                    self.target_solr_base_url))
+                return None
+
+            _intervals = []
+            for (i, (dt_start, dt_stop)) in enumerate(intervals):
+                dt = dt_start
+                while dt < dt_stop:
+                    key = format_datetime(dt)
+                    stats1 = buckets1[i].get(key, [0, None, None, None])
+                    stats2 = buckets2[i].get(key, [0, None, None, None])
+                    if not self._compare_stats(stats1, stats2)['status']:
+                        _intervals.append((dt, dt + delta))
+                    dt = dt + delta
+            logging.info("\tDivergence search: core=%s gap=%s number of "
+                         "intervals=%s --> %s" % (core, gap, len(intervals),
+                                                  len(_intervals)))
+            intervals = _intervals
+
+        return sorted(intervals, reverse=True)
+
+    def _get_sync_window_start(self, core, query):
+        '''
+        Method that returns the start of the month including the last
+        high-water mark of a core minus the look-back period,
+        or None if there is no state or the core was never verified.
+        '''
+
+        if self.state is None:
+            return None
+        high_water = self.state.get_high_water(
+            self.source_solr_base_url, self.target_solr_base_url,
+            core, query)
+        if high_water is None:
+            return None
+        return (high_water - self.lookback).replace(
+            day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    def _apply_sync_window(self, core, query, dt_min):
+        '''
+        Method that restricts the start of the interval to synchronize
+        to the window of the state, if any.
+        '''
+
+        window_start = self._get_sync_window_start(core, query)
+        if window_start is None or window_start <= dt_min:
+            return dt_min
+        logging.info("\tSearching core=%s from %s (high-water mark minus "
+                     "%s)" % (core, window_start, self.lookback))
+        return window_start
+
+    def _save_sync_state(self, query):
+        '''
+        Method that advances, for each core, the high-water mark to the
+        latest source _timestamp if the window of the run is verified
+        to be in sync at its end.
+        '''
+
+        for core in CORES:
+            window_start = self._get_sync_window_start(core, query)
+            fq = "_timestamp:[* TO *]"
+            if window_start is not None:
+                fq = "_timestamp:[%s TO *]" % format_datetime(window_start)
+            retDict = self._check_sync(core=core, query=query, fq=fq)
+            if retDict is None or retDict['source']['counts'] == 0:
+                continue
+            if not retDict['status']:
+                logging.warning("Core=%s is not in sync from %s, the "
+                                "high-water mark is not advanced" % (
+                                    core, window_start))
+                continue
+            self.state.advance_high_water(
+                self.source_solr_base_url, self.target_solr_base_url,
+                core, query, retDict['source']['timestamp_max'])
 
     def _get_sync_dt_interval(self, retDict):
         '''
@@ -279,16 +803,76 @@ class Synchronizer(object):
         minimum, maximum and mean of timestamp in the given interval.
         '''
 
-        [counts1, timestamp_min1, timestamp_max1, timestamp_mean1] = (
-            self._query_solr_stats(self.source_solr_base_url, core, query, fq))
-        if counts1 == -1:
-            logging.warning("Error querying URL: %s" % self.source_solr_base_url)
+        stats1 = self._query_solr_stats(self.source_solr_base_url,
+                                        core, query, fq)
+        if stats1[0] == -1:
+            logging.warning("Error querying URL: %s" %
+                            self.source_solr_base_url)
+            return None
+        stats2 = self._query_solr_stats(self.target_solr_base_url,
+                                        core, query, fq)
+        if stats2[0] == -1:
+            logging.warning("Error querying URL: %s" %
+                            self.target_solr_base_url)
+            return None
+        return self._compare_stats(stats1, stats2)
+
+    def check_sync_many(self, core, fqs, query=DEFAULT_QUERY,
+                        concurrency=MAX_CONCURRENCY):
+        '''
+        Method equivalent to calling _check_sync() for each filter query
+        in 'fqs', but with all the stats probes in flight concurrently
+        (at most 'concurrency' per Solr server).
+        Returns the list of results, in the same order as 'fqs'.
+        Each call runs its own event loop, so that it can be invoked
+        from any thread.
+        '''
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                self._check_sync_many_async(core, fqs, query, concurrency))
+        finally:
+            loop.close()
+
+    async def _check_sync_many_async(self, core, fqs, query, concurrency):
+
+        source = AsyncSolrClient(self.source_solr_base_url,
+                                 concurrency=concurrency)
+        target = AsyncSolrClient(self.target_solr_base_url,
+                                 concurrency=concurrency)
+        try:
+            return await asyncio.gather(*[
+                self._check_sync_async(source, target, core, query, fq)
+                for fq in fqs])
+        finally:
+            await source.close()
+            await target.close()
+
+    async def _check_sync_async(self, source, target, core, query, fq):
+        '''Coroutine variant of _check_sync() using AsyncSolrClients.'''
+
+        (stats1, stats2) = await asyncio.gather(
+            self._query_solr_stats_async(source, core, query, fq),
+            self._query_solr_stats_async(target, core, query, fq))
+        if stats1[0] == -1:
+            logging.warning("Error querying URL: %s" %
+                            self.source_solr_base_url)
             return None
-        [counts2, timestamp_min2, timestamp_max2, timestamp_mean2] = (
-            self._query_solr_stats(self.target_solr_base_url, core, query, fq))
-        if counts2 == -1:
-            logging.warning("Error querying URL: %s" % self.target_solr_base_url)
+        if stats2[0] == -1:
+            logging.warning("Error querying URL: %s" %
+                            self.target_solr_base_url)
             return None
+        return self._compare_stats(stats1, stats2)
+
+    def _compare_stats(self, stats1, stats2):
+        '''
+        Method that compares the stats of the source and target Solrs
+        returned by _query_solr_stats().
+        '''
+
+        [counts1, timestamp_min1, timestamp_max1, timestamp_mean1] = stats1
+        [counts2, timestamp_min2, timestamp_max2, timestamp_mean2] = stats2
         logging.debug("SOURCE: counts=%s time stamp min=%s max=%s mean=%s" % (
             counts1, timestamp_min1, timestamp_max1, timestamp_mean1))
         logging.debug("TARGET: counts=%s time stamp min=%s max=%s mean=%s" % (
@@ -330,12 +914,82 @@ class Synchronizer(object):
                   "stats.field": "_timestamp",
                   "rows": "0"}
 
+        try:
+            response = http_get_json(url, params)
+            if response is None:
+                logging.warning("Error querying stats: %s" % url)
+            return self._parse_solr_stats(response)
+
+        except urllib.error.URLError as e:
+            logging.warning(e)
+            return self._parse_solr_stats(None)
+
+    def _query_solr_facet_ranges(self, solr_base_url, core, query,
+                                 intervals, gap):
+        '''
+        Method to query the counts and _timestamp stats of the buckets
+        of size 'gap' within each of the (start, stop) 'intervals',
+        with one request to the JSON Facet API. The facets are sent as the
+        'json.facet' parameter, in a form encoded body if there are too many
+        for a URL: this read request is never compressed, unlike updates.
+        Returns, for each interval, a dictionary of the bucket stats
+        (as returned by _parse_solr_stats) keyed by the formatted
+        start of the bucket, or None if the request failed.
+        '''
+
+        url = solr_base_url + "/" + core + "/select"
+        facets = {}
+        for (i, (dt_start, dt_stop)) in enumerate(intervals):
+            facets["interval%s" % i] = {"type": "range",
+                                        "field": "_timestamp",
+                                        "start": format_datetime(dt_start),
+                                        "end": format_datetime(dt_stop),
+                                        "gap": gap,
+                                        "facet": TIMESTAMP_FACET_STATS}
+        params = {"q": query,
+                  "fq": "_timestamp:[* TO *]",
+                  "rows": "0",
+                  "wt": "json",
+                  "json.facet": json.dumps(facets, separators=(',', ':'))}
+
+        response = http_get_json(url, params)
+        if response is None:
+            return None
+
+        results = []
+        for i in range(len(intervals)):
+            buckets = {}
+            facet = response.get('facets', {}).get("interval%s" % i, {})
+            for bucket in facet.get('buckets', []):
+                buckets[format_datetime(_parse_facet_datetime(
+                    bucket['val']))] = [
+                        bucket['count'],
+                        _parse_facet_datetime(bucket.get('min', None)),
+                        _parse_facet_datetime(bucket.get('max', None)),
+                        _parse_facet_datetime(bucket.get('mean', None))]
+            results.append(buckets)
+        return results
+
+    async def _query_solr_stats_async(self, client, core, query, fq):
+        '''
+        Coroutine variant of _query_solr_stats() using an AsyncSolrClient.
+        '''
+
+        response = await client.stats(core, query, fq, "_timestamp")
+        return self._parse_solr_stats(response)
+
+    def _parse_solr_stats(self, response):
+        '''
+        Method to parse the response of a stats query into
+        [counts, timestamp min, timestamp max, timestamp mean],
+        or [-1, None, None, None] if the response is None.
+        '''
+
         # default values if HTTP response cannot be retrieved
         (counts, timestamp_min, timestamp_max,
          timestamp_mean) = (-1, None, None, None)
 
-        try:
-            response = http_get_json(url, params)
+        if response is not None:
 
             # parse response
             # logging.debug("Solr Response: %s" % response)
@@ -368,9 +1022,6 @@ class Synchronizer(object):
                 timestamp_mean = dateutil.parser.parse(timestamp_mean).replace(
                     microsecond=0)
 
-        except urllib.error.URLError as e:
-            logging.warning(e)
-
         # return output
         return [counts, timestamp_min, timestamp_max, timestamp_mean]
 
@@ -393,129 +1044,196 @@ class Synchronizer(object):
                                                      CORE_DATASETS, query,
                                                      timestamp_query)
 
+        # without both lists, datasets would be wrongly copied or deleted
+        if source_dataset_ids is None or target_dataset_ids is None:
+            logging.warning("\t\t\t\tError querying dataset ids, skipping "
+                            "interval: %s" % timestamp_query)
+            return (numDatasets, numFiles, numAggregations)
+
         # synchronize source Solr --> target Solr
-        # commit after every core query
-        for source_dataset_id in source_dataset_ids.keys():
-            #  compare dataset ids and their _timestamps
-            if ((source_dataset_id not in target_dataset_ids) or (
-              source_dataset_ids[source_dataset_id] != target_dataset_ids[
-                  source_dataset_id])):
-
-                logging.info("\t\t\t\tCopying source dataset="
-                             "%s" % source_dataset_id)
-
-                numDatasets += migrate(self.source_solr_base_url,
-                                       self.target_solr_base_url,
-                                       CORE_DATASETS,
-                                       query='id:%s' % source_dataset_id,
-                                       commit=True,
-                                       optimize=False)
-                numFiles += migrate(self.source_solr_base_url,
-                                    self.target_solr_base_url,
-                                    CORE_FILES,
-                                    query='dataset_id:%s' % source_dataset_id,
-                                    commit=True,
-                                    optimize=False)
-                numAggregations += migrate(
-                    self.source_solr_base_url,
-                    self.target_solr_base_url,
-                    CORE_AGGREGATIONS,
-                    query='dataset_id:%s' % source_dataset_id,
-                    commit=True, optimize=False)
+        # compare dataset ids and their _timestamps
+        (changed_dataset_ids, removed_dataset_ids) = diff(source_dataset_ids,
+                                                          target_dataset_ids)
+
+        # copy the changed datasets, and their files and aggregations,
+        # by batches with one terms query per core
+        # (or a delta of the files and aggregations of updated datasets)
+        for i in range(0, len(changed_dataset_ids), MAX_DATASETS_PER_BATCH):
+            dataset_ids = changed_dataset_ids[i:i + MAX_DATASETS_PER_BATCH]
+            logging.info("\t\t\t\tCopying %s source datasets: %s..." % (
+                len(dataset_ids), dataset_ids[0]))
+            numDatasets += migrate(self.source_solr_base_url,
+                                   self.target_solr_base_url,
+                                   CORE_DATASETS,
+                                   query=_terms_query('id', dataset_ids),
+                                   commit=False,
+                                   optimize=False,
+                                   controller=self.controller)
+            new_dataset_ids = [dataset_id for dataset_id in dataset_ids
+                               if dataset_id not in target_dataset_ids]
+            updated_dataset_ids = [dataset_id for dataset_id in dataset_ids
+                                   if dataset_id in target_dataset_ids]
+            numFiles += self._copy_child_records(
+                CORE_FILES, new_dataset_ids, updated_dataset_ids)
+            numAggregations += self._copy_child_records(
+                CORE_AGGREGATIONS, new_dataset_ids, updated_dataset_ids)
 
         # synchronize target Solr <-- source Solr
         # must delete datasets that do NOT longer exist at the source
-        for target_dataset_id in target_dataset_ids.keys():
-            if target_dataset_id not in source_dataset_ids:
-                # check whether dataset still exists at the source: 
-                # if yes, it has been updated in the previous loop; if not, delete it
-                exists = self._check_record(
-                    self.source_solr_base_url,
-                    CORE_DATASETS,
-                    target_dataset_id)
-                if not exists:
-                    logging.info("\t\t\t\tDeleting dataset="
-                                 "%s" % target_dataset_id)
-                    self._delete_solr_records(
-                        self.target_solr_base_url,
-                        core=CORE_DATASETS,
-                        query='id:%s' % target_dataset_id)
-                    self._delete_solr_records(
-                        self.target_solr_base_url,
-                        core=CORE_FILES,
-                        query='dataset_id:%s' % target_dataset_id)
-                    self._delete_solr_records(
-                        self.target_solr_base_url,
-                        core=CORE_AGGREGATIONS,
-                        query='dataset_id:%s' % target_dataset_id)
+        deleted_dataset_ids = self._delete_datasets(removed_dataset_ids)
+
+        # commit each core once for the whole interval
+        if changed_dataset_ids or deleted_dataset_ids:
+            for core in CORES:
+                self._commit_core(self.target_solr_base_url, core)
 
         return (numDatasets, numFiles, numAggregations)
 
-    def _check_record(self, solr_base_url, core, record_id):
-        '''Checks for the existence of a record with a given id.'''
+    def _copy_child_records(self, core, new_dataset_ids, updated_dataset_ids):
+        '''
+        Method that copies the files or aggregations of changed datasets,
+        without committing. Those of new datasets are copied in full;
+        those of updated datasets are merged by (id, _timestamp)
+        (see _reconcile_core), so that only the records that differ
+        are copied or deleted.
+        Returns the number of records copied.
+        '''
+
+        numRecords = 0
+        if new_dataset_ids:
+            numRecords += migrate(self.source_solr_base_url,
+                                  self.target_solr_base_url,
+                                  core,
+                                  query=_terms_query('dataset_id',
+                                                     new_dataset_ids),
+                                  commit=False,
+                                  optimize=False,
+                                  controller=self.controller)
+        if updated_dataset_ids:
+            counts = self._reconcile_core(
+                core, DEFAULT_QUERY,
+                [_terms_query('dataset_id', updated_dataset_ids)])
+            numRecords += counts[ADD] + counts[UPDATE]
+        return numRecords
+
+    def _delete_datasets(self, dataset_ids):
+        '''
+        Method that deletes from the target Solr the datasets, and their
+        files and aggregations, that do not exist at the source Solr.
+        The datasets that still exist at the source (updated since their ids
+        were queried) are found with one terms query per batch, then each
+        batch is deleted with one request per core, without committing.
+        Returns the ids of the datasets that were deleted.
+        '''
+
+        deleted_dataset_ids = []
+        for i in range(0, len(dataset_ids), MAX_DATASETS_PER_BATCH):
+            batch = dataset_ids[i:i + MAX_DATASETS_PER_BATCH]
+            existing_ids = self._check_records(self.source_solr_base_url,
+                                               CORE_DATASETS, batch)
+            batch = [dataset_id for dataset_id in batch
+                     if dataset_id not in existing_ids]
+            if not batch:
+                continue
+
+            logging.info("\t\t\t\tDeleting %s datasets: %s..." % (
+                len(batch), batch[0]))
+            self._delete_solr_records_by_id(self.target_solr_base_url,
+                                            CORE_DATASETS, batch)
+            for core in [CORE_FILES, CORE_AGGREGATIONS]:
+                self._delete_solr_records(
+                    self.target_solr_base_url, core,
+                    query=_terms_query('dataset_id', batch), commit=False)
+            deleted_dataset_ids += batch
+
+        return deleted_dataset_ids
+
+    def _check_records(self, solr_base_url, core, record_ids):
+        '''
+        Checks for the existence of records with the given ids,
+        with a single terms query, and returns the set of those that exist.
+        If the Solr server cannot be queried, the records are assumed
+        to exist, so that they are not deleted.
+        '''
 
         solr_url = solr_base_url + "/" + core + "/select"
-        response = http_get_json(solr_url, {'q': 'id:%s' % record_id,
+        response = http_get_json(solr_url, {'q': _terms_query('id',
+                                                              record_ids),
+                                            'fl': 'id',
+                                            'rows': "%s" % len(record_ids),
                                             'wt': 'json'})
+        if response is None:
+            logging.warning("Error checking %s records, assuming they "
+                            "exist" % len(record_ids))
+            return set(record_ids)
 
-        if int(response["response"]['numFound']) > 0:
-            return True
-        else:
-            return False
+        return set(doc['id'] for doc in response['response']['docs'])
 
     def _sync_records_by_time(self, core, query, timestamp_query):
         '''
         Method that executes synchronization of all records
         for a given core within given time interval.
+        The (id, _timestamp) pairs of the interval are merged
+        (see _reconcile_core), so that only the records that are missing
+        or changed are copied, and only the stale ones deleted.
         '''
 
-        # first delete all records in timestamp bin from target solr
-        # will NOT commit the changes yet
-        delete_query = "(%s)AND(%s)" % (query, timestamp_query)
-        self._delete_solr_records(self.target_solr_base_url,
-                                  core,
-                                  delete_query)
+        counts = self._reconcile_core(core, query, [timestamp_query])
 
-        # then migrate records from source solr
         # commit but do NOT optimize the index yet
-        numRecords = migrate(self.source_solr_base_url,
-                             self.target_solr_base_url,
-                             core, query=query, fq=timestamp_query,
-                             commit=True, optimize=False)
-        logging.info("\t\t\tNumber or records migrated=%s" % numRecords)
+        if counts[ADD] or counts[UPDATE] or counts[DELETE]:
+            self._commit_core(self.target_solr_base_url, core)
+        numRecords = counts[ADD] + counts[UPDATE]
+        logging.info("\t\t\tNumber or records migrated=%s deleted=%s" % (
+            numRecords, counts[DELETE]))
         return numRecords
 
-    def _delete_solr_records(self, solr_base_url, core, query=DEFAULT_QUERY):
+    def _delete_solr_records(self, solr_base_url, core, query=DEFAULT_QUERY,
+                             commit=True):
 
-        solr_url = solr_base_url + "/" + core + "/update?commit=true"
+        solr_url = solr_base_url + "/" + core + "/update"
+        if commit:
+            solr_url += "?commit=true"
         post_dict = {"delete": {"query": query}}
-        response = http_post_json(solr_url, post_dict)
+        with throttle(self.controller) as outcome:
+            response = http_post_json(solr_url, post_dict)
+            outcome.success = response is not None
+        logging.debug("Solr delete response=%s" % response)
+
+    def _delete_solr_records_by_id(self, solr_base_url, core, record_ids):
+        '''Deletes records by id, with a single request without commit.'''
+
+        solr_url = solr_base_url + "/" + core + "/update"
+        post_dict = {"delete": record_ids}
+        with throttle(self.controller) as outcome:
+            response = http_post_json(solr_url, post_dict)
+            outcome.success = response is not None
         logging.debug("Solr delete response=%s" % response)
 
     def _query_dataset_ids(self, solr_base_url, core, query, timestamp_query):
         '''
         Method to query for dataset ids within a given datetime interval.
+        All the ids are paged with a Solr cursor, and kept with their
+        timestamps in a compact IdTimestamps store sorted by id.
+        If Solr returns duplicate or unsorted ids (for example when records
+        are updated while the cursor is paged), the interval is scanned
+        again into a dictionary instead of the compact store.
+        Returns None if the Solr server cannot be queried.
         '''
 
-        datasets = {}
-        url = solr_base_url + "/" + core + "/select"
-
-        # send request
-        params = {"q": query,
-                  "fq": timestamp_query,
-                  "wt": "json",
-                  "indent": "true",
-                  "start": "0",
-                  "rows": "%s" % MAX_DATASETS_PER_HOUR,
-                  "fl": ["id", "_timestamp"]
-                  }
-
-        response = http_get_json(url, params)
-        if int(response['response']['numFound']) > 0:
-            for doc in response['response']['docs']:
-                datasets[doc['id']] = doc['_timestamp']
-
-        return datasets
+        try:
+            try:
+                return scan_ids(solr_base_url, core, query, [timestamp_query])
+            except ValueError as e:
+                logging.warning("Error storing dataset ids: %s/%s %s, "
+                                "comparing them without the compact store" % (
+                                    solr_base_url, core, e))
+                return dict(stream_ids(solr_base_url, core, query,
+                                       [timestamp_query]))
+        except SolrQueryError as e:
+            logging.warning("Error querying dataset ids: %s/%s %s" % (
+                solr_base_url, core, e))
+            return None
 
     def _optimize_solr(self, solr_base_url):
 
@@ -530,12 +1248,42 @@ class Synchronizer(object):
     def _commit_solr(self, solr_base_url):
 
         for core in CORES:
+            self._commit_core(solr_base_url, core)
 
-            solr_url = solr_base_url + "/" + core + "/update"
-            params = {"commit": "true", "wt": "json"}
-            logging.info("Committing the Solr index: %s" % solr_url)
-            response = http_get_json(solr_url, params)
-            logging.debug(response)
+    def _commit_core(self, solr_base_url, core):
+
+        solr_url = solr_base_url + "/" + core + "/update"
+        params = {"commit": "true", "wt": "json"}
+        logging.info("Committing the Solr index: %s" % solr_url)
+        response = http_get_json(solr_url, params)
+        logging.debug(response)
+
+
+def _terms_query(field, values):
+    '''
+    Builds a Solr terms query matching any of the values of a field,
+    separated by TERMS_SEPARATOR (quoted, since Solr parses it as
+    whitespace in the local parameters).
+    '''
+
+    return "{!terms f=%s separator='%s'}%s" % (
+        field, TERMS_SEPARATOR, TERMS_SEPARATOR.join(values))
+
+
+def _parse_facet_datetime(value):
+    '''
+    Parses the value of a facet function on _timestamp, returned either as
+    a date string or as a number of milliseconds since the epoch depending on
+    the Solr version, into a naive UTC datetime without microseconds.
+    '''
+
+    if value is None:
+        return None
+    if isinstance(value, str):
+        dt = dateutil.parser.parse(value).replace(tzinfo=None)
+    else:
+        dt = datetime(1970, 1, 1) + timedelta(milliseconds=value)
+    return dt.replace(microsecond=0)
 
 
 if __name__ == '__main__':
@@ -564,7 +1312,67 @@ if __name__ == '__main__':
                              "the source and targer Solrs"
                              "(example: 'index_node:esgf-node.jpl.nasa.gov'",
                              default=DEFAULT_QUERY)
+    parser.add_argument('--compact', dest='compact', action='store_true',
+                        help="Exchange compact JSON with the Solr servers, "
+                        "accepting gzip compressed responses",
+                        default=False)
+    parser.add_argument('--gzip-requests', dest='gzip_requests',
+                        action='store_true',
+                        help="Compress the update requests with gzip "
+                        "(the target Solr must be configured to inflate them)",
+                        default=False)
+    parser.add_argument('--backpressure', dest='backpressure',
+                        action='store_true',
+                        help="Adjust the rate of the updates to the latency "
+                        "and errors of the target Solr",
+                        default=False)
+    parser.add_argument('--facets', dest='facets', action='store_true',
+                        help="Search the hours to sync with one range facet "
+                        "request per level (months, days, hours) instead "
+                        "of checking them one at a time",
+                        default=False)
+    parser.add_argument('--workers', dest='workers', type=int,
+                        help="Synchronize the cores concurrently, checking "
+                        "the buckets of each level at the same time and "
+                        "syncing up to this number of hours in parallel "
+                        "(default: 0, sequential)",
+                        default=0)
+    parser.add_argument('--digests', dest='digests', type=str,
+                        help="Local directory where the digest trees of "
+                        "the records are cached between runs: the hours to "
+                        "sync are found by comparing these trees",
+                        default=None)
+    parser.add_argument('--state', dest='state', type=str,
+                        help="Local SQLite database where the intervals "
+                        "verified to be in sync are recorded: later runs only "
+                        "search the records since the last verified one",
+                        default=None)
+    parser.add_argument('--lookback', dest='lookback', type=int,
+                        help="Number of days before the last verified record "
+                        "that are searched again with --state "
+                        "(default: %s)" % LOOKBACK_DAYS,
+                        default=LOOKBACK_DAYS)
+    parser.add_argument('--reconcile', dest='reconcile', action='store_true',
+                        help="Compare all the record ids and timestamps "
+                        "of the two Solrs with a merge of their sorted ids, "
+                        "instead of searching the intervals that differ",
+                        default=False)
 
     args_dict = vars(parser.parse_args())
-    harvester = Synchronizer(args_dict['source'], args_dict['target'])
-    harvester.sync(query=args_dict['query'])
+    set_wire_mode(compact=args_dict['compact'],
+                  gzip_requests=args_dict['gzip_requests'])
+    controller = None
+    if args_dict['backpressure']:
+        controller = RateController()
+    state = None
+    if args_dict['state']:
+        state = SyncState(args_dict['state'])
+    harvester = Synchronizer(args_dict['source'], args_dict['target'],
+                             controller=controller, state=state,
+                             lookback=timedelta(days=args_dict['lookback']))
+    if args_dict['reconcile']:
+        harvester.reconcile(query=args_dict['query'])
+    else:
+        harvester.sync(query=args_dict['query'], facets=args_dict['facets'],
+                       workers=args_dict['workers'],
+                       digests=args_dict['digests'])
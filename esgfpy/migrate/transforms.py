@@ -0,0 +1,247 @@
+'''
+Python module to transform the records migrated from a source Solr
+to a target Solr. The transformation rules are compiled once per migration
+into a pipeline that is then applied to each batch of records.
+'''
+
+import logging
+import re
+
+# field that must not be copied, otherwise Solr will return
+# an HTTP 409 error (Conflict): by design, "_version_" > 0
+# will only insert the document if it exists already with the same _version_
+VERSION_FIELD = '_version_'
+
+# fields holding record identifiers
+ID_FIELDS = ['id', 'master_id', 'instance_id', 'dataset_id']
+
+# numeric fields broken in some records, for each core
+FLOAT_FIELDS = {'datasets': ['height_bottom', 'height_top']}
+
+
+class DropFieldsRule(object):
+    '''Removes the given fields from each record.'''
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+
+    def apply(self, doc):
+        for field in self.fields:
+            doc.pop(field, None)
+
+
+class SuffixRule(object):
+    '''Appends a suffix to the values of the given fields.'''
+
+    def __init__(self, suffix, fields=ID_FIELDS):
+        self.suffix = suffix
+        self.fields = list(fields)
+
+    def apply(self, doc):
+        for field in self.fields:
+            value = doc.get(field, None)
+            if value:
+                doc[field] = _map_values(value, lambda v: v + self.suffix)
+
+
+class ReplaceRule(object):
+    '''
+    Replaces the keys of 'replacements' with their values, in all string
+    values of the given fields (of all fields if 'fields' is None).
+    '''
+
+    def __init__(self, replacements, fields=None):
+        self.replacements = dict(replacements)
+        self.fields = list(fields) if fields is not None else None
+
+
+class CoerceFloatRule(object):
+    '''
+    Converts the values of the given fields to floats,
+    replacing the values that cannot be converted with 'default'.
+    '''
+
+    def __init__(self, fields, default=0.):
+        self.fields = list(fields)
+        self.default = default
+
+    def apply(self, doc):
+        for field in self.fields:
+            value = doc.get(field, None)
+            if value:
+                try:
+                    doc[field] = float(value)
+                except (TypeError, ValueError):
+                    doc[field] = self.default
+
+
+class _ReplaceStep(object):
+    '''
+    All ReplaceRule instances of a pipeline merged into a single step:
+    for each field, all its replacement patterns are matched in one pass
+    by one compiled regular expression, so that the cost of a value
+    does not grow with the number of rules.
+    '''
+
+    def __init__(self, rules):
+
+        # replacements applied to all fields, then to specific fields
+        globalTable = {}
+        fieldTables = {}
+        for rule in rules:
+            if rule.fields is None:
+                globalTable.update(rule.replacements)
+            else:
+                for field in rule.fields:
+                    fieldTables.setdefault(field, {}).update(
+                        rule.replacements)
+
+        self._default = _Matcher(globalTable)
+        self._matchers = {}
+        for field, table in fieldTables.items():
+            merged = dict(globalTable)
+            merged.update(table)
+            self._matchers[field] = _Matcher(merged)
+
+    def apply(self, doc):
+        for field, value in doc.items():
+            matcher = self._matchers.get(field, self._default)
+            if matcher:
+                doc[field] = _map_values(value, matcher.replace)
+
+
+class _Matcher(object):
+    '''Replaces many literal strings in a single pass.'''
+
+    def __init__(self, table):
+        self._table = dict((k, v) for k, v in table.items() if k)
+        self._pattern = None
+        if self._table:
+            self._pattern = re.compile(_trie_regex(_build_trie(self._table)))
+
+    def __bool__(self):
+        return self._pattern is not None
+
+    def replace(self, value):
+        if isinstance(value, str):
+            return self._pattern.sub(self._lookup, value)
+        return value
+
+    def _lookup(self, match):
+        return self._table[match.group(0)]
+
+
+class TransformPipeline(object):
+    '''
+    Ordered list of transformation rules applied to batches of records.
+    '''
+
+    def __init__(self, rules):
+
+        self.steps = []
+        replaceRules = []
+        for rule in rules:
+            if isinstance(rule, ReplaceRule):
+                # all replacements are merged at the position of the first one
+                if not replaceRules:
+                    self.steps.append(None)
+                replaceRules.append(rule)
+            else:
+                self.steps.append(rule)
+        if replaceRules:
+            self.steps[self.steps.index(None)] = _ReplaceStep(replaceRules)
+
+    def __call__(self, docs):
+        '''
+        Transforms a batch of records in place,
+        skipping the records that cannot be transformed.
+        '''
+
+        results = []
+        for i, doc in enumerate(docs):
+            try:
+                for step in self.steps:
+                    step.apply(doc)
+                results.append(doc)
+            except Exception as e:
+                logging.warn('ERROR transforming record %s: %s' % (i, e))
+        return results
+
+
+def compile_transforms(core, replacements=None, suffix='', rules=None):
+    '''
+    Builds the transformation pipeline for records of the given core:
+    removes the _version_ field, appends 'suffix' to all ID fields,
+    applies the 'replacements' dictionary to all string values,
+    fixes broken numeric fields, then applies any additional 'rules'.
+    All replacements are applied simultaneously, the longest match first.
+    '''
+
+    _rules = [DropFieldsRule([VERSION_FIELD])]
+    if suffix:
+        _rules.append(SuffixRule(suffix))
+    if replacements:
+        _rules.append(ReplaceRule(replacements))
+    if core in FLOAT_FIELDS:
+        _rules.append(CoerceFloatRule(FLOAT_FIELDS[core]))
+    if rules:
+        _rules += list(rules)
+    return TransformPipeline(_rules)
+
+
+def parse_replacements(replace):
+    '''
+    Parses replacement patterns of the form
+    'old_value_1:new_value_1,old_value_2:new_value_2' into a dictionary.
+    '''
+
+    replacements = {}
+    if replace is not None and len(replace) > 0:
+        for _replace in replace.split(','):
+            (oldValue, newValue) = _replace.strip().split(':')
+            replacements[oldValue] = newValue
+            logging.debug("Replacing metadata: "
+                          "%s --> %s" % (oldValue, newValue))
+    return replacements
+
+
+def _map_values(value, function):
+    '''Applies 'function' to a single value, or to each of multiple values.'''
+
+    if isinstance(value, list):
+        return [function(_value) for _value in value]
+    return function(value)
+
+
+def _build_trie(literals):
+
+    trie = {}
+    for literal in literals:
+        node = trie
+        for char in literal:
+            node = node.setdefault(char, {})
+        node[''] = True
+    return trie
+
+
+def _trie_regex(node):
+    '''
+    Converts a trie of literal strings into a regular expression
+    where common prefixes are factored out, which matches the longest
+    literal without trying each alternative in turn.
+    '''
+
+    # chains of single characters need no group
+    pattern = ''
+    while len(node) == 1 and '' not in node:
+        (char, node) = next(iter(node.items()))
+        pattern += re.escape(char)
+
+    branches = [re.escape(char) + _trie_regex(child)
+                for (char, child) in sorted(node.items()) if char]
+    if not branches:
+        return pattern
+    pattern += '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        pattern += '?'
+    return pattern
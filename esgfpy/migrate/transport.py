@@ -0,0 +1,280 @@
+'''
+Pooled HTTP transport: keeps connections to each Solr host alive
+between requests, so that consecutive requests do not pay for
+a new TCP (and TLS) handshake.
+'''
+
+import http.client
+import logging
+import os
+import ssl
+import threading
+from urllib import error, parse, request
+
+# maximum number of connections to each host
+MAX_CONNECTIONS_PER_HOST = 8
+
+# maximum number of redirects followed by a request
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# redirects that repeat a POST request with the same method and body
+POST_REDIRECT_CODES = (307, 308)
+
+# errors raised when sending a request on a connection closed by the server
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                           http.client.BadStatusLine,
+                           ConnectionResetError,
+                           BrokenPipeError)
+
+
+class ConnectionPool(object):
+    '''
+    Class that holds at most 'maxConnections' keep-alive connections
+    to one host. A connection is checked out for the duration of one
+    request, and returned to the pool when its response has been read;
+    threads wait for a free connection when all are in use.
+    '''
+
+    def __init__(self, scheme, host, port,
+                 maxConnections=MAX_CONNECTIONS_PER_HOST, sslContext=None):
+
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxConnections = maxConnections
+        self.sslContext = sslContext
+        # requests to hosts reached through a proxy are not pooled
+        self.proxied = (scheme in request.getproxies() and
+                        not request.proxy_bypass(host))
+        self._condition = threading.Condition()
+        self._idle = []
+        self._numConnections = 0
+
+    def checkout(self, timeout):
+        '''
+        Returns an idle connection, or a new one if the pool is not full,
+        and a flag telling whether the connection was used before.
+        '''
+
+        with self._condition:
+            while (not self._idle and
+                   self._numConnections >= self.maxConnections):
+                self._condition.wait()
+            if self._idle:
+                connection = self._idle.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return (connection, True)
+            self._numConnections += 1
+
+        logging.debug("New connection: %s://%s:%s" % (
+            self.scheme, self.host, self.port))
+        if self.scheme == 'https':
+            connection = http.client.HTTPSConnection(
+                self.host, self.port, timeout=timeout,
+                context=self.sslContext or ssl.create_default_context())
+        else:
+            connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=timeout)
+        return (connection, False)
+
+    def checkin(self, connection, reusable=True):
+        '''
+        Returns a connection to the pool,
+        or closes it if it cannot be reused.
+        '''
+
+        with self._condition:
+            if reusable:
+                self._idle.append(connection)
+            else:
+                connection.close()
+                self._numConnections -= 1
+            self._condition.notify()
+
+    def close(self):
+        '''Closes the idle connections.'''
+
+        with self._condition:
+            for connection in self._idle:
+                connection.close()
+            self._numConnections -= len(self._idle)
+            self._idle = []
+
+
+class PooledResponse(object):
+    '''
+    HTTP response read from a pooled connection, with the interface of the
+    responses of urllib.request.urlopen(): read(), 'headers', 'status'.
+    The connection is returned to the pool when the response is closed.
+    '''
+
+    def __init__(self, pool, connection, response, url):
+
+        self._pool = pool
+        self._connection = connection
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def close(self):
+
+        if self._connection is None:
+            return
+        # a connection can only be reused after its response is fully read
+        reusable = (self._response.isclosed() and
+                    not self._response.will_close)
+        if not reusable:
+            self._response.close()
+        self._pool.checkin(self._connection, reusable=reusable)
+        self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+
+class Transport(object):
+    '''
+    Class that sends HTTP requests through one ConnectionPool per host.
+    The pools are not shared with child processes:
+    a process that was forked creates its own connections.
+    '''
+
+    def __init__(self, maxConnections=MAX_CONNECTIONS_PER_HOST,
+                 sslContext=None):
+
+        self.maxConnections = maxConnections
+        self.sslContext = sslContext
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._pid = os.getpid()
+
+    def urlopen(self, url, data=None, headers=None, timeout=None):
+        '''
+        Sends a GET request, or a POST request if 'data' is not None,
+        and returns a PooledResponse to be closed by the caller.
+        Raises urllib.error.HTTPError if the response has an error status,
+        as urllib.request.urlopen() does.
+
+        Redirects are followed up to MAX_REDIRECTS times, except that
+        a POST request only follows the redirects that repeat it with
+        the same body (307 and 308): other redirects raise HTTPError.
+        Hosts reached through a proxy (see the 'http_proxy', 'https_proxy'
+        and 'no_proxy' environment variables) are requested with
+        urllib.request.urlopen() instead, without pooling.
+        '''
+
+        for _ in range(MAX_REDIRECTS + 1):
+            _url = parse.urlsplit(url)
+            pool = self._get_pool(_url.scheme, _url.hostname, _url.port)
+            if pool.proxied:
+                context = self.sslContext if _url.scheme == 'https' else None
+                return request.urlopen(
+                    request.Request(url, data=data, headers=headers or {}),
+                    timeout=timeout, context=context)
+
+            response = self._send(pool, _url, data, headers, timeout)
+            if response.status not in REDIRECT_CODES:
+                return response
+            location = response.headers.get('Location')
+            response.read()
+            response.close()
+            if location is None or (data is not None and
+                                    response.status not in
+                                    POST_REDIRECT_CODES):
+                raise error.HTTPError(url, response.status,
+                                      "Redirect not followed: %s" % location,
+                                      response.headers, _BodyReader(b''))
+            logging.debug("Redirect: %s --> %s" % (url, location))
+            url = parse.urljoin(url, location)
+
+        raise error.HTTPError(url, response.status, "Too many redirects",
+                              response.headers, _BodyReader(b''))
+
+    def _send(self, pool, _url, data, headers, timeout):
+        '''
+        Sends one request on a pooled connection, without following
+        redirects, and returns a PooledResponse.
+        '''
+
+        url = _url.geturl()
+        path = _url.path or '/'
+        if _url.query:
+            path += '?' + _url.query
+        method = 'GET' if data is None else 'POST'
+
+        # a kept-alive connection may have been closed by the server
+        # since its last request: retry once on a new connection
+        while True:
+            (connection, reused) = pool.checkout(timeout)
+            try:
+                connection.request(method, path, body=data,
+                                   headers=headers or {})
+                response = connection.getresponse()
+                break
+            except STALE_CONNECTION_ERRORS:
+                pool.checkin(connection, reusable=False)
+                if not reused:
+                    raise
+            except Exception:
+                pool.checkin(connection, reusable=False)
+                raise
+
+        pooled = PooledResponse(pool, connection, response, url)
+        if response.status >= 400:
+            body = pooled.read()
+            pooled.close()
+            raise error.HTTPError(url, response.status, response.reason,
+                                  response.headers, _BodyReader(body))
+        return pooled
+
+    def close(self):
+        '''Closes all idle connections.'''
+
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+
+    def _get_pool(self, scheme, host, port):
+
+        if port is None:
+            port = 443 if scheme == 'https' else 80
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pools = {}
+                self._pid = os.getpid()
+            key = (scheme, host, port)
+            if key not in self._pools:
+                self._pools[key] = ConnectionPool(
+                    scheme, host, port, maxConnections=self.maxConnections,
+                    sslContext=self.sslContext)
+            return self._pools[key]
+
+
+class _BodyReader(object):
+    '''File-like access to the body of an error response.'''
+
+    def __init__(self, body):
+        self._body = body
+
+    def read(self, amt=None):
+        body = self._body
+        self._body = b''
+        return body
+
+    def close(self):
+        pass
+
+
+# transport shared by all Solr clients of this process
+transport = Transport()
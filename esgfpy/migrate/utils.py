@@ -1,77 +1,622 @@
 '''
 Common Solr utilities.
+All HTTP requests are sent through the keep-alive connection pools
+of esgfpy.migrate.transport.
 '''
+import codecs
+import email.utils
+import gzip
 import logging
 import json
-from urllib import parse, request
+import random
+import re
+import threading
+import time
+from urllib import error, parse
+
+from esgfpy.migrate import javabin
+from esgfpy.migrate.transport import transport
 
 # timeout for all HTTP requests
 TIMEOUT_SECS = 10
 MAX_TRIES = 3
 
+# exponential backoff between tries: the delay before try #n+1 is drawn
+# uniformly in [0, min(BACKOFF_MAX_SECS, BACKOFF_BASE_SECS * 2**n)]
+BACKOFF_BASE_SECS = 0.5
+BACKOFF_MAX_SECS = 30
+
+# HTTP errors worth retrying, all other client errors fail immediately
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+# consecutive failures after which requests to a host fail fast,
+# and seconds before a new request is let through
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECS = 60
+
+# wire efficiency mode, see set_wire_mode()
+WIRE_MODE = {'compact': False, 'gzip_requests': False}
+
+# request bodies smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+# size of the chunks read from streamed HTTP responses
+STREAM_CHUNK_BYTES = 64 * 1024
+
+# query strings longer than this (such as terms queries on many ids)
+# are sent as the form encoded body of a POST request, since the size
+# of the request headers is limited by Solr (8 KB by default)
+MAX_QUERY_STRING_BYTES = 4096
+
+
+class WireStats(object):
+    '''
+    Thread-safe counters of the bytes exchanged with Solr servers:
+    the size of the payloads before compression and on the wire.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'sent_payload': 0, 'sent_wire': 0,
+                        'received_payload': 0, 'received_wire': 0}
+
+    def add(self, key, payload_bytes, wire_bytes):
+        with self._lock:
+            self._counts[key + '_payload'] += payload_bytes
+            self._counts[key + '_wire'] += wire_bytes
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def report(self, since=None):
+        '''
+        Returns a summary of the bytes sent and received,
+        optionally since a previous snapshot.
+        '''
+
+        counts = self.snapshot()
+        if since is not None:
+            counts = dict((key, value - since[key])
+                          for key, value in counts.items())
+        saved = (counts['sent_payload'] - counts['sent_wire'] +
+                 counts['received_payload'] - counts['received_wire'])
+        return ("bytes sent=%s (%s uncompressed) bytes received=%s "
+                "(%s uncompressed) bytes saved by compression=%s" % (
+                    counts['sent_wire'], counts['sent_payload'],
+                    counts['received_wire'], counts['received_payload'],
+                    saved))
+
+
+wire_stats = WireStats()
+
+
+class CircuitOpenError(Exception):
+    '''Error raised when requests to a host are failing fast.'''
+    pass
+
+
+class RetryPolicy(object):
+    '''
+    Class that decides whether a failed request is retried,
+    and how long to wait before the next try: exponential backoff
+    with full jitter, or the delay requested by the server
+    in a 'Retry-After' header if longer.
+    '''
+
+    def __init__(self, maxTries=MAX_TRIES, base=BACKOFF_BASE_SECS,
+                 cap=BACKOFF_MAX_SECS, retryStatusCodes=RETRY_STATUS_CODES):
+
+        self.maxTries = maxTries
+        self.base = base
+        self.cap = cap
+        self.retryStatusCodes = retryStatusCodes
+
+    def retryable(self, e):
+        '''Returns True if a request that raised 'e' may succeed later.'''
+
+        if isinstance(e, CircuitOpenError):
+            return False
+        if isinstance(e, error.HTTPError):
+            return e.code in self.retryStatusCodes
+        return True
+
+    def delay(self, attempt, e=None):
+        '''Returns the seconds to wait after the failed try #'attempt'.'''
+
+        seconds = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        if isinstance(e, error.HTTPError) and e.headers is not None:
+            retryAfter = _parse_retry_after(e.headers.get('Retry-After', None))
+            if retryAfter is not None:
+                seconds = max(seconds, min(retryAfter, self.cap))
+        return seconds
+
+
+class CircuitBreaker(object):
+    '''
+    Class that stops sending requests to a host after
+    'threshold' consecutive failures: the circuit is then open and requests
+    fail fast with CircuitOpenError, until 'resetSeconds' have elapsed and
+    a single trial request is let through (half-open circuit).
+    The circuit closes again when a request succeeds.
+    '''
+
+    def __init__(self, host, threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 resetSeconds=CIRCUIT_RESET_SECS):
+
+        self.host = host
+        self.threshold = threshold
+        self.resetSeconds = resetSeconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._openedAt = None
+        self._trial = False
+
+    def is_open(self):
+
+        with self._lock:
+            return self._openedAt is not None
+
+    def allow(self):
+        '''Raises CircuitOpenError if a request must not be sent now.'''
+
+        with self._lock:
+            if self._openedAt is None:
+                return
+            if (not self._trial and
+                    time.time() - self._openedAt >= self.resetSeconds):
+                self._trial = True
+                logging.info("Circuit half-open, trying host: %s" % self.host)
+                return
+            raise CircuitOpenError("Circuit open for host: %s" % self.host)
+
+    def success(self):
+
+        with self._lock:
+            if self._openedAt is not None:
+                logging.info("Circuit closed for host: %s" % self.host)
+            self._failures = 0
+            self._openedAt = None
+            self._trial = False
+
+    def failure(self):
+
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self._openedAt is None and
+                               self._failures >= self.threshold):
+                logging.warning("Circuit open for host: %s after %s "
+                                "consecutive failures, failing fast for %s "
+                                "seconds" % (self.host, self._failures,
+                                             self.resetSeconds))
+                self._openedAt = time.time()
+                self._trial = False
+
+
+retry_policy = RetryPolicy()
+
+# circuit breakers by host
+_circuitBreakers = {}
+_circuitBreakersLock = threading.Lock()
+
+
+def get_circuit_breaker(url):
+    '''Returns the circuit breaker of the host of 'url'.'''
+
+    host = parse.urlsplit(url).netloc
+    with _circuitBreakersLock:
+        if host not in _circuitBreakers:
+            _circuitBreakers[host] = CircuitBreaker(host)
+        return _circuitBreakers[host]
+
+
+def open_circuits():
+    '''Returns the hosts to which requests are currently failing fast.'''
+
+    with _circuitBreakersLock:
+        breakers = list(_circuitBreakers.values())
+    return sorted(breaker.host for breaker in breakers if breaker.is_open())
+
+
+def set_wire_mode(compact=False, gzip_requests=False):
+    '''
+    Configures the format of all HTTP requests to Solr:
+    compact=True serializes JSON bodies without indentation or key sorting,
+    does not request indented responses, and accepts gzip responses;
+    gzip_requests=True also compresses the request bodies
+    (the Solr server must be configured to inflate them).
+    '''
+
+    WIRE_MODE['compact'] = compact
+    WIRE_MODE['gzip_requests'] = gzip_requests
+
 
 def http_get_json(url, params):
     '''
-    Sends a GET request to the URL to retrieve a JSON response.
+    Sends a GET request to the URL to retrieve a JSON response,
+    or a POST request if the parameters are too long (see _encode_params()).
+    Returns None if the request failed (see _send_json()).
     '''
 
-    if params:
-        query_string = parse.urlencode(params, doseq=True)
-        url = url + "?" + query_string
+    # do not ask Solr to waste bytes on indentation
+    if params and WIRE_MODE['compact']:
+        params = dict((key, value) for key, value in params.items()
+                      if key != 'indent')
+
+    headers = {}
+    if WIRE_MODE['compact']:
+        headers['Accept-Encoding'] = 'gzip'
+    (url, body) = _encode_params(url, params, headers)
+
+    return _send_json(url, body, headers)
+
+
+def http_get_json_docs(url, params, header=None, opener=None):
+    '''
+    Sends a GET (or POST, see _encode_params()) request to the URL and
+    yields the documents of the 'response.docs' array of the JSON response
+    one at a time, as they are read from the network, so that the whole
+    response is never held in memory.
+    If provided, the dictionary 'header' is filled with the values
+    that precede the documents in the response (such as 'numFound').
+    Like http_get_json(), the request is retried according to the retry
+    policy, but only until the first document has been yielded: later
+    errors are raised. Raises CircuitOpenError if the host is failing fast,
+    or the error of the last try.
+    The request is sent by the Transport 'opener' if provided (for example
+    with its own SSL context), by the shared transport otherwise.
+    '''
+
+    if params and WIRE_MODE['compact']:
+        params = dict((key, value) for key, value in params.items()
+                      if key != 'indent')
 
-    logging.info("HTTP GET request: %s" % url)
+    headers = {}
+    if WIRE_MODE['compact']:
+        headers['Accept-Encoding'] = 'gzip'
+    (url, body) = _encode_params(url, params, headers, streaming=True)
 
-    # try at most MAX_TRIES times
-    for _ in range(0, MAX_TRIES):
+    opener = opener or transport
+    breaker = get_circuit_breaker(url)
+    for attempt in range(0, retry_policy.maxTries):
+        numDocs = 0
+        wire = None
         try:
-            with request.urlopen(url, timeout=TIMEOUT_SECS) as response:
-                response_text = response.read().decode("UTF-8")
-                response = json.loads(response_text)
-                return response
+            breaker.allow()
+            with opener.urlopen(url, body, headers=headers,
+                                timeout=TIMEOUT_SECS) as response:
+                wire = payload = _CountingReader(response)
+                if response.headers.get('Content-Encoding', None) == 'gzip':
+                    payload = _CountingReader(gzip.GzipFile(fileobj=wire))
+                for doc in iter_json_docs(payload, header=header):
+                    numDocs += 1
+                    yield doc
+            breaker.success()
+            return
 
         except Exception as e:
+            # documents already yielded cannot be taken back
+            if numDocs > 0 or isinstance(e, CircuitOpenError):
+                raise
             logging.warning(e)
+            if not retry_policy.retryable(e):
+                breaker.success()
+                raise
+            breaker.failure()
+            if attempt + 1 >= retry_policy.maxTries:
+                raise
+            time.sleep(retry_policy.delay(attempt, e))
 
-    return None
+        finally:
+            if wire is not None:
+                wire_stats.add('received', payload.numBytes, wire.numBytes)
+
+
+def iter_json_docs(stream, header=None):
+    '''
+    Incrementally parses a Solr JSON response read from the binary
+    'stream', yielding the documents of 'response.docs' one at a time.
+    Only the document being parsed, and the current chunk, are in memory.
+    '''
 
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    state = {'buffer': '', 'pos': 0, 'eof': False}
+
+    def _read():
+        # discard the text already parsed, then append the next chunk
+        state['buffer'] = state['buffer'][state['pos']:]
+        state['pos'] = 0
+        chunk = stream.read(STREAM_CHUNK_BYTES)
+        if chunk:
+            state['buffer'] += utf8.decode(chunk)
+        else:
+            state['buffer'] += utf8.decode(b'', final=True)
+            state['eof'] = True
+
+    # 1) skip to the start of the documents array
+    while True:
+        start = state['buffer'].find('"docs"')
+        if start >= 0 and state['buffer'].find('[', start) >= 0:
+            break
+        if state['eof']:
+            return
+        _read()
+    if header is not None:
+        for (key, value) in re.findall(r'"(\w+)"\s*:\s*(\d+)',
+                                       state['buffer'][:start]):
+            header[key] = int(value)
+    state['pos'] = state['buffer'].find('[', start) + 1
+
+    # 2) decode one document at a time
+    while True:
+        buffer = state['buffer']
+        pos = state['pos']
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        state['pos'] = pos
+        if pos >= len(buffer):
+            if state['eof']:
+                raise ValueError("Truncated JSON response")
+            _read()
+            continue
+        if buffer[pos] == ']':
+            return
+        try:
+            (doc, end) = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if state['eof']:
+                raise
+            _read()
+            continue
+        state['pos'] = end
+        yield doc
 
-def to_json(data):
+
+class _CountingReader(object):
+    '''File-like wrapper that counts the bytes read from a stream.'''
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.numBytes = 0
+
+    def read(self, amt=None):
+        data = self._stream.read(amt)
+        self.numBytes += len(data)
+        return data
+
+
+def to_json(data, compact=False):
 
     '''
     Converts a Python dictionary or list to json format
     (with unicode encoding).
+    If compact=True, the output is neither indented nor sorted.
     '''
-    datastr = json.dumps(
-        data,
-        indent=4,
-        sort_keys=True,
-        separators=(',', ': '),
-        ensure_ascii=False
-    )
+    if compact:
+        datastr = json.dumps(
+            data,
+            separators=(',', ':'),
+            ensure_ascii=False
+        )
+    else:
+        datastr = json.dumps(
+            data,
+            indent=4,
+            sort_keys=True,
+            separators=(',', ': '),
+            ensure_ascii=False
+        )
     return datastr.encode('utf8')
 
 
-def http_post_json(url, data_dict):
+def serialize_json(data):
+    '''
+    Serializes a Python dictionary or list for an HTTP request body,
+    in the format selected by the current wire mode.
+    '''
+
+    return to_json(data, compact=WIRE_MODE['compact'])
+
 
-    json_data_str = to_json(data_dict)
+def http_post_json(url, data_dict, raise_errors=False):
+    '''
+    Sends a POST request with a JSON body to the URL.
+    'data_dict' is a Python dictionary or list, or a body
+    already serialized with serialize_json().
+    Returns the JSON response, or None if the request failed
+    (see _send_json() for 'raise_errors').
+    '''
+
+    if isinstance(data_dict, bytes):
+        json_data_str = data_dict
+    else:
+        json_data_str = serialize_json(data_dict)
     logging.debug("Publishing JSON data: %s" % json_data_str)
 
-    req = request.Request(url)
-    req.add_header('Content-Type', 'application/json')
+    headers = {'Content-Type': 'application/json'}
+    if WIRE_MODE['compact']:
+        headers['Accept-Encoding'] = 'gzip'
+
+    # compress the request body
+    body = json_data_str
+    if WIRE_MODE['gzip_requests'] and len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    wire_stats.add('sent', len(json_data_str), len(body))
+
+    return _send_json(url, body, headers, raise_errors=raise_errors)
+
+
+def http_get_javabin(url, params, raise_errors=False):
+    '''
+    Sends a GET request to the URL to retrieve a javabin response
+    (see esgfpy.migrate.javabin), with 'wt=javabin'.
+    Returns the decoded response, or None if the request failed
+    (see _send_json() for 'raise_errors').
+    '''
+
+    params = dict((key, value) for key, value in params.items()
+                  if key != 'indent')
+    params['wt'] = 'javabin'
+
+    headers = {}
+    if WIRE_MODE['compact']:
+        headers['Accept-Encoding'] = 'gzip'
+    (url, body) = _encode_params(url, params, headers)
+    return _send_json(url, body, headers, read=_read_javabin,
+                      raise_errors=raise_errors)
+
+
+def http_post_javabin(url, body, raise_errors=False):
+    '''
+    Sends a POST request with a javabin body to the URL
+    (see esgfpy.migrate.javabin.dumps_update()).
+    Returns the JSON response, or None if the request failed
+    (see _send_json() for 'raise_errors').
+    '''
+
+    url = url + "?" + parse.urlencode({'wt': 'json'})
+    headers = {'Content-Type': javabin.CONTENT_TYPE}
+    if WIRE_MODE['compact']:
+        headers['Accept-Encoding'] = 'gzip'
+    payload = body
+    if WIRE_MODE['gzip_requests'] and len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    wire_stats.add('sent', len(payload), len(body))
 
-    # try at most MAX_TRIES times
-    for _ in range(0, MAX_TRIES):
+    return _send_json(url, body, headers, raise_errors=raise_errors)
+
+
+def _encode_params(url, params, headers, streaming=False):
+    '''
+    Encodes the request parameters in the URL of a GET request,
+    or in the body of a POST request if they are too long: returns
+    (url, body), with a None body for a GET request, and sets
+    the content type of the body in 'headers'.
+    '''
+
+    if not params:
+        logging.info("HTTP GET %srequest: %s" % (
+            "streaming " if streaming else "", url))
+        return (url, None)
+
+    query_string = parse.urlencode(params, doseq=True)
+    if len(query_string) <= MAX_QUERY_STRING_BYTES:
+        url = url + "?" + query_string
+        logging.info("HTTP GET %srequest: %s" % (
+            "streaming " if streaming else "", url))
+        return (url, None)
+
+    logging.info("HTTP POST %srequest: %s (%s bytes of parameters)" % (
+        "streaming " if streaming else "", url, len(query_string)))
+    headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    return (url, query_string.encode('utf8'))
+
+
+def _send_json(url, body, headers, read=None, raise_errors=False):
+    '''
+    Sends a GET request, or a POST request if 'body' is not None,
+    according to the retry policy and the circuit breaker of the host.
+    Returns the JSON response (or the response decoded by 'read'),
+    or None if the request failed. If 'raise_errors' is True,
+    the error of the last try is raised instead (CircuitOpenError,
+    urllib.error.HTTPError or any other transport error), so that
+    the caller can tell a rejected request from an unavailable host.
+    '''
+
+    read = read or _read_json
+
+    breaker = get_circuit_breaker(url)
+    for attempt in range(0, retry_policy.maxTries):
         try:
-            with request.urlopen(req, json_data_str, timeout=TIMEOUT_SECS) as response:
-                response_text = response.read().decode("UTF-8")
-                response = json.loads(response_text)
-                return response
+            breaker.allow()
+            with transport.urlopen(url, body, headers=headers,
+                                   timeout=TIMEOUT_SECS) as response:
+                jdoc = read(response)
+            breaker.success()
+            return jdoc
+
         except Exception as e:
             logging.warning(e)
+            if isinstance(e, CircuitOpenError):
+                if raise_errors:
+                    raise
+                return None
+            # client errors are the fault of the request, not of the host
+            if retry_policy.retryable(e):
+                breaker.failure()
+            else:
+                breaker.success()
+                if raise_errors:
+                    raise
+                return None
+            if attempt + 1 >= retry_policy.maxTries:
+                if raise_errors:
+                    raise
+            else:
+                time.sleep(retry_policy.delay(attempt, e))
 
     return None
 
 
+def _read_json(response):
+    '''
+    Reads and parses a JSON HTTP response, decompressing it if necessary.
+    '''
+
+    body = response.read()
+    wire_bytes = len(body)
+    if response.headers.get('Content-Encoding', None) == 'gzip':
+        body = gzip.decompress(body)
+    wire_stats.add('received', len(body), wire_bytes)
+    return json.loads(body)
+
+
+def _read_javabin(response):
+    '''
+    Reads and decodes a javabin HTTP response, decompressing it if necessary.
+    '''
+
+    body = response.read()
+    wire_bytes = len(body)
+    if response.headers.get('Content-Encoding', None) == 'gzip':
+        body = gzip.decompress(body)
+    wire_stats.add('received', len(body), wire_bytes)
+    return javabin.loads(body)
+
+
+def _parse_retry_after(value):
+    '''
+    Parses the value of a 'Retry-After' header, either a number of seconds
+    or an HTTP date, into seconds from now.
+    '''
+
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    try:
+        timestamp = email.utils.mktime_tz(email.utils.parsedate_tz(value))
+        return max(timestamp - time.time(), 0.)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def to_filter_queries(fq):
+    '''Converts an optional filter query, or list of queries, into a list.'''
+
+    if fq is None:
+        return []
+    elif isinstance(fq, (list, tuple)):
+        return list(fq)
+    else:
+        return [fq]
+
+
 def get_timestamp_query(datetime_start, datetime_stop):
     '''Builds the Solr timestamp query between a start and stop datetimes.'''
 
@@ -75,7 +75,8 @@ def check_replicas(project, dry_run, start, end, ndays):
         query += '&mip_era:{}'.format(project)
     else:
         query += '&project:{}'.format(project)
-    replicas = query_solr(query, fields, solr_url=local_master_solr_url, solr_core='datasets')
+    # the replicas are compared with the primaries of each index node
+    replicas = list(query_solr(query, fields, solr_url=local_master_solr_url, solr_core='datasets'))
     logging.info('{} replicas found at {}'.format(len(replicas), local_master_solr_url))
     replicas_ids = [(i['master_id'], i['version']) for i in replicas]
 
@@ -100,7 +101,7 @@ def check_replicas(project, dry_run, start, end, ndays):
                 query += '&project:{}'.format(project)
             if start_datetime and stop_datetime:
                 query += '&_timestamp:[{} TO {}]'.format(start_datetime, stop_datetime)
-            primaries = query_solr(query, fields, solr_url=remote_slave_solr_url, solr_core='datasets')
+            primaries = list(query_solr(query, fields, solr_url=remote_slave_solr_url, solr_core='datasets'))
             logging.info('{} primaries found at {}'.format(len(primaries), remote_slave_solr_url))
         except:
             logging.error('Error querying {}'.format(remote_slave_solr_url))
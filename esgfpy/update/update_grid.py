@@ -14,9 +14,8 @@ query = 'replica:true'
 query += '&mip_era:CMIP6'
 query += '&institution_id:CNRM-CERFACS'
 query += '&grid:regular*1/2*lat-lon*grid'
-res = query_solr(query, fields, solr_url=local_master_solr_url, solr_core='datasets')
-logging.info('{} datasets found at {}'.format(len(res), local_master_solr_url))
-affected_ids = [i['id'] for i in res]
+affected_ids = [i['id'] for i in query_solr(query, fields, solr_url=local_master_solr_url, solr_core='datasets')]
+logging.info('{} datasets found at {}'.format(len(affected_ids), local_master_solr_url))
 
 # Update grid attribute
 for d in affected_ids:
@@ -1,28 +1,32 @@
 import json
 import logging
-# from urllib.parse import urlencode
-# from urllib.request import urlopen, Request
 import ssl
-from urllib import urlencode
-from urllib2 import Request, urlopen
+from urllib.parse import urlencode
 from xml.etree.ElementTree import Element, SubElement, tostring
 
+from esgfpy.migrate.transport import Transport, transport
+from esgfpy.migrate.utils import http_get_json_docs
+
 # logging.basicConfig(level=logging.DEBUG)
 
 # Maximum number of records returned by a Solr query
 MAX_ROWS = 1000
 
-# NOTE: PROTOCOL_TLSv1_2 support requires Python 2.7.13+
+# NOTE: this context does NOT verify the certificates of the servers,
+# so that ESGF index nodes with self-signed certificates can be queried
 ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
 
+# connections used by query_esgf() and query_solr(), with the context above
+esgf_transport = Transport(sslContext=ssl_context)
+
 
 def query_esgf(query_params, url='http://localhost/esg-search/search/'):
     ''' Method to query an ESGF index node. '''
 
     esgf_url = url + "?" + urlencode(query_params)
     logging.debug('Executing ESGF query URL=%s' % esgf_url)
-    fh = urlopen(esgf_url, context=ssl_context)
-    response = fh.read().decode("UTF-8")
+    with esgf_transport.urlopen(esgf_url) as fh:
+        response = fh.read().decode("UTF-8")
     jobj = json.loads(response)
     return jobj
 
@@ -36,15 +40,16 @@ def query_solr(query, fields,
     query: query constraints, separated by '&'
     fields: list of fields to be returned in matching documents
 
-    returns a list of result documents, each list item is a dictionary of
-    the requested fields
+    yields the result documents, each a dictionary of the requested fields
+
+    Each page of results is parsed as it is read, and its documents are
+    yielded one at a time, so that at most one document is held in memory.
     '''
 
     solr_core_url = solr_url + "/" + solr_core
     queries = query.split('&')
     start = 0
     numFound = start + 1
-    results = []
 
     # 1) query for all matching records
     while start < numFound:
@@ -54,33 +59,26 @@ def query_solr(query, fields,
         #          &fl=version&fl=latest&fl=replica
         #          &fl=master_id&wt=json&indent=true&start=0&rows=5&fq=replica%3Dfalse&fq=latest%3Dtrue
         url = solr_core_url + "/select"
-        params = [('q', '*:*'),
-                  ('wt', 'json'), ('indent', 'true'),
-                  ('start', start), ('rows', MAX_ROWS)]
-        for fq in queries:
-            params.append(('fq', fq))
-        for fl in fields:
-            params.append(('fl', fl))
-
-        # execute query to Solr
-        url = url + "?" + urlencode(params)
+        params = {'q': '*:*', 'wt': 'json',
+                  'start': start, 'rows': MAX_ROWS,
+                  'fq': queries, 'fl': fields}
+
+        # execute query to Solr, yield the result documents
         logging.debug('Executing Solr search URL=%s' % url)
-        fh = urlopen(url, context=ssl_context)
-        response = fh.read().decode("UTF-8")
-        jobj = json.loads(response)
+        header = {}
+        numRecords = 0
+        for doc in http_get_json_docs(url, params, header=header,
+                                      opener=esgf_transport):
+            numRecords += 1
+            yield doc
 
         # summary information
-        numFound = jobj['response']['numFound']
-        numRecords = len(jobj['response']['docs'])
+        numFound = header.get('numFound', 0)
         start += numRecords
         logging.debug("\t\tTotal number of records found: %s number of records "
                       "returned: %s" % (numFound, numRecords))
-
-        # loop over result documents, add to the list
-        for doc in jobj['response']['docs']:
-            results.append(doc)
-
-    return results
+        if numRecords == 0:
+            break
 
 
 def update_solr(update_dict, update='set',
@@ -179,8 +177,8 @@ def _buildSolrXml(solr_core_url, queries, fieldDict, update='set', start=0):
     # execute query to Solr
     url = url + "?" + urlencode(params)
     logging.debug('Executing Solr search URL=%s' % url)
-    fh = urlopen(url)
-    response = fh.read().decode("UTF-8")
+    with transport.urlopen(url) as fh:
+        response = fh.read().decode("UTF-8")
     jobj = json.loads(response)
 
     numFound = jobj['response']['numFound']
@@ -266,10 +264,9 @@ def _sendSolrXml(solr_core_url, xmlDoc):
     url = solr_core_url + '/update'
 
     # send XML document
-    r = Request(url, data=xmlDoc,
-                headers={'Content-Type': 'application/xml'})
-    u = urlopen(r)
-    response = u.read()
+    with transport.urlopen(url, data=xmlDoc,
+                           headers={'Content-Type': 'application/xml'}) as u:
+        response = u.read()
     logging.debug(response)
 
 
@@ -280,7 +277,6 @@ def _commit(solr_core_url):
     url = solr_core_url + '/update?commit=true'
 
     # send XML document
-    r = Request(url)
-    u = urlopen(r)
-    response = u.read()
+    with transport.urlopen(url) as u:
+        response = u.read()
     logging.debug(response)
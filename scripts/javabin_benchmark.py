@@ -0,0 +1,114 @@
+'''
+Script to benchmark the javabin and JSON serializations of Solr records:
+bytes on the wire (raw and gzip compressed) and client CPU time
+to encode and decode batches of records, reported per 10k records.
+
+Example invocation:
+python scripts/javabin_benchmark.py --records 10000 --batch 100
+'''
+
+import argparse
+import gzip
+import json
+import logging
+import time
+
+from esgfpy.migrate import javabin
+from esgfpy.migrate.utils import serialize_json
+
+logging.basicConfig(level=logging.INFO)
+
+NUM_RECORDS = 10000
+RECORDS_PER_REQUEST = 100
+REPORT_RECORDS = 10000
+
+
+def make_records(numRecords):
+    '''Generates synthetic ESGF file records.'''
+
+    records = []
+    for i in range(numRecords):
+        dataset_id = ("cmip6.CMIP.NCAR.CESM2.historical.r%si1p1f1.Amon.tas."
+                      "gn.v20190308|esgf-data.ucar.edu" % (i // 10))
+        records.append({
+            "id": "%s.tas_Amon_%05d.nc|esgf-data.ucar.edu" % (
+                dataset_id.split('|')[0], i),
+            "dataset_id": dataset_id,
+            "type": "File",
+            "project": ["CMIP6"],
+            "experiment_id": ["historical"],
+            "variable": ["tas"],
+            "frequency": ["mon"],
+            "data_node": "esgf-data.ucar.edu",
+            "replica": False,
+            "latest": True,
+            "size": 123456789 + i,
+            "version": "20190308",
+            "checksum": ["%064x" % (i * 7919)],
+            "checksum_type": ["SHA256"],
+            "url": ["http://esgf-data.ucar.edu/thredds/fileServer/%05d.nc"
+                    "|application/netcdf|HTTPServer" % i],
+            "_timestamp": "2019-03-08T12:%02d:%02d.%03dZ" % (
+                (i // 60) % 60, i % 60, i % 1000),
+            "_version_": 1627000000000000000 + i,
+        })
+    return records
+
+
+def benchmark(name, records, batch, encode, decode):
+    '''
+    Encodes and decodes the records in batches, and returns
+    (name, raw bytes, gzip bytes, encode CPU seconds, decode CPU seconds).
+    '''
+
+    batches = [records[i:i + batch] for i in range(0, len(records), batch)]
+
+    t1 = time.process_time()
+    bodies = [encode(docs) for docs in batches]
+    encodeSeconds = time.process_time() - t1
+
+    t1 = time.process_time()
+    for body in bodies:
+        decode(body)
+    decodeSeconds = time.process_time() - t1
+
+    rawBytes = sum(len(body) for body in bodies)
+    gzipBytes = sum(len(gzip.compress(body)) for body in bodies)
+    return (name, rawBytes, gzipBytes, encodeSeconds, decodeSeconds)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark of the javabin "
+                                     "and JSON serializations of Solr records")
+    parser.add_argument('--records', dest='records', type=int,
+                        help="Number of synthetic records "
+                        "(default: %s)" % NUM_RECORDS,
+                        default=NUM_RECORDS)
+    parser.add_argument('--batch', dest='batch', type=int,
+                        help="Number of records per request "
+                        "(default: %s)" % RECORDS_PER_REQUEST,
+                        default=RECORDS_PER_REQUEST)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    results = [
+        benchmark("json", records, args.batch, serialize_json,
+                  lambda body: json.loads(body)),
+        benchmark("javabin", records, args.batch, javabin.dumps_update,
+                  javabin.loads_update),
+    ]
+
+    scale = float(REPORT_RECORDS) / args.records
+    logging.info("Per %s records, %s records per request:" % (
+        REPORT_RECORDS, args.batch))
+    logging.info("%-8s %12s %12s %12s %12s" % (
+        "format", "bytes", "gzip bytes", "encode CPU", "decode CPU"))
+    for (name, rawBytes, gzipBytes, encodeSeconds, decodeSeconds) in results:
+        logging.info("%-8s %12d %12d %11.3fs %11.3fs" % (
+            name, rawBytes * scale, gzipBytes * scale,
+            encodeSeconds * scale, decodeSeconds * scale))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,14 @@
 
 set -e
 
-# maximum number of records to migrate in one session
-MAX_RECORDS_PER_SESSION=10000
+# directory where the migration checkpoints are saved
+CHECKPOINT_DIR=${CHECKPOINT_DIR:-/tmp}
 
-# time to wait in seconds between session
-WAIT_SECONDS_BETWEEN_SESIONS=120
+# time to wait in seconds before resuming a failed session
+WAIT_SECONDS_BEFORE_RESUME=120
+
+# maximum number of sessions for each collection, before giving up
+MAX_SESSIONS=10
 
 # parse command line arguments
 solr_source_url=$1
@@ -33,15 +36,20 @@ do
   echo ""
   echo "Migrating collection=${collection} total number of records=$numTotal"
   
-  # migrate at most $maxRecords at a time, continue until all records have been migrated
-  startRecord=0
-  maxRecords=$MAX_RECORDS_PER_SESSION
-  while [ $startRecord -lt $numTotal ]; do
-     echo "	Starting record=$startRecord max records=$maxRecords"
-     python esgfpy/migrate/solr2solr.py ${solr_source_url} ${solr_target_url} --core ${collection} --start ${startRecord} --max ${maxRecords}
-     startRecord=$((startRecord + maxRecords))
-     # leave Solr time to issue a soft commit and perhaps a hard commit and optimization
-     sleep $WAIT_SECONDS_BETWEEN_SESIONS
+  # migrate all records, resuming from the last checkpoint until the migration completes
+  checkpoint="${CHECKPOINT_DIR}/solr_migrate_${collection}.checkpoint"
+  session=1
+  until python esgfpy/migrate/solr2solr.py ${solr_source_url} ${solr_target_url} --core ${collection} --checkpoint ${checkpoint} --resume --backpressure; do
+     if [ $session -ge $MAX_SESSIONS ]; then
+        echo "	Migration failed after $session sessions, giving up (checkpoint=${checkpoint})"
+        exit 1
+     fi
+     session=$((session + 1))
+     echo "	Migration interrupted, resuming from checkpoint=${checkpoint}"
+     sleep $WAIT_SECONDS_BEFORE_RESUME
   done
 
+  # the next run of this script migrates the collection again from the start
+  rm -f ${checkpoint} ${checkpoint}.*
+
 done
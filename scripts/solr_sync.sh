@@ -6,6 +6,9 @@
 
 set -e
 
+# directory where the synchronization state is saved
+STATE_DIR=${STATE_DIR:-/tmp}
+
 # parse command line arguments
 solr_source_url=$1
 solr_target_url=$2
@@ -17,4 +20,4 @@ SOURCE_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
 PARENT_DIR="$(dirname $SOURCE_DIR)"
 cd $PARENT_DIR
 
-python esgfpy/migrate/synchronizer.py "${solr_source_url}" "${solr_target_url}" --query=index_node:${index_node}
+python esgfpy/migrate/synchronizer.py "${solr_source_url}" "${solr_target_url}" --query=index_node:${index_node} --backpressure --facets --workers 4 --state ${STATE_DIR}/solr_sync.sqlite
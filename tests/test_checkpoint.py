@@ -0,0 +1,81 @@
+'''
+Tests of the migration checkpoints of esgfpy.migrate.checkpoint.
+'''
+
+import json
+
+import pytest
+
+from esgfpy.migrate.checkpoint import Checkpoint, is_complete
+
+
+def _checkpoint(tmp_path, core='files', query='*:*', fq=None):
+    return Checkpoint(str(tmp_path / 'checkpoint.json'), 'http://source',
+                      'http://target', core, query, fq or [])
+
+
+def _saved(checkpoint):
+    with open(checkpoint.path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def test_update_consecutive_pages(tmp_path):
+    checkpoint = _checkpoint(tmp_path)
+    checkpoint.update(0, 'mark0', 0, 10)
+    checkpoint.update(1, 'mark1', 0, 10)
+    state = _saved(checkpoint)
+    assert state['cursorMark'] == 'mark1'
+    assert state['numRecords'] == 20
+
+
+def test_update_out_of_order(tmp_path):
+    checkpoint = _checkpoint(tmp_path)
+    checkpoint.update(1, 'mark1', 0, 10)
+    checkpoint.update(2, 'mark2', 0, 10)
+    # pages 1 and 2 wait for page 0
+    assert checkpoint.get('cursorMark') is None
+    assert checkpoint.get('numRecords') == 0
+    checkpoint.update(0, 'mark0', 0, 10)
+    assert checkpoint.get('cursorMark') == 'mark2'
+    assert checkpoint.get('numRecords') == 30
+    checkpoint.update(4, 'mark4', 0, 5)
+    assert _saved(checkpoint)['cursorMark'] == 'mark2'
+    assert not checkpoint.complete()
+    assert not is_complete(checkpoint.path)
+    checkpoint.update(3, 'mark3', 0, 5)
+    state = _saved(checkpoint)
+    assert state['cursorMark'] == 'mark4'
+    assert state['numRecords'] == 40
+    assert checkpoint.complete()
+    assert is_complete(checkpoint.path)
+
+
+def test_update_start(tmp_path):
+    checkpoint = _checkpoint(tmp_path)
+    checkpoint.update(0, None, 100, 100)
+    checkpoint.update(2, None, 300, 100)
+    assert checkpoint.get('start') == 100
+    checkpoint.update(1, None, 200, 100)
+    assert checkpoint.get('start') == 300
+
+
+def test_load(tmp_path):
+    checkpoint = _checkpoint(tmp_path)
+    assert checkpoint.load() is None
+    checkpoint.update(0, 'mark0', 0, 10)
+    state = _checkpoint(tmp_path).load()
+    assert state['cursorMark'] == 'mark0'
+    assert state['numRecords'] == 10
+    assert not state['complete']
+
+
+def test_load_different_migration(tmp_path):
+    _checkpoint(tmp_path).update(0, 'mark0', 0, 10)
+    with pytest.raises(ValueError):
+        _checkpoint(tmp_path, core='datasets').load()
+    with pytest.raises(ValueError):
+        _checkpoint(tmp_path, fq=['project:CMIP6']).load()
+
+
+def test_is_complete_missing(tmp_path):
+    assert not is_complete(str(tmp_path / 'missing.json'))
@@ -0,0 +1,73 @@
+'''
+Tests of the digest trees of esgfpy.migrate.digests.
+'''
+
+from esgfpy.migrate.digests import DigestTree, _runs, _signature, diff_trees
+
+
+def _tree(tmp_path, hours):
+    tree = DigestTree('http://localhost:8983/solr', 'files', '*:*',
+                      str(tmp_path))
+    tree.hours = dict((key, list(hour)) for (key, hour) in hours.items())
+    return tree
+
+
+KEYS = ['2020-01-01T00', '2020-01-01T01', '2020-01-01T03',
+        '2020-01-01T04', '2020-01-02T00', '2020-02-01T10']
+
+
+def test_runs():
+    assert _runs(KEYS, set()) == []
+    assert _runs(KEYS, set(KEYS)) == [[KEYS[0], KEYS[-1]]]
+    # empty hours between non empty hours do not break a run
+    assert _runs(KEYS, set(KEYS[1:3])) == [[KEYS[1], KEYS[2]]]
+    assert _runs(KEYS, set([KEYS[0], KEYS[2], KEYS[3], KEYS[5]])) == [
+        [KEYS[0], KEYS[0]], [KEYS[2], KEYS[3]], [KEYS[5], KEYS[5]]]
+
+
+def test_signature():
+    assert _signature([3, 'abc']) == [3, None]
+    assert _signature([3, 'abc', '2020-01-01T00:59:00Z']) == [
+        3, '2020-01-01T00:59:00Z']
+
+
+def test_diff_trees_equal(tmp_path):
+    hours = dict((key, [1, key]) for key in KEYS)
+    assert diff_trees(_tree(tmp_path, hours), _tree(tmp_path, hours)) == []
+
+
+def test_diff_trees(tmp_path):
+    hours = dict((key, [1, key]) for key in KEYS)
+    tree1 = _tree(tmp_path, hours)
+    hours['2020-01-01T03'] = [1, 'other']
+    hours['2020-01-03T05'] = [2, 'new']
+    del hours['2020-02-01T10']
+    tree2 = _tree(tmp_path, hours)
+    assert diff_trees(tree1, tree2) == [
+        '2020-01-01T03', '2020-01-03T05', '2020-02-01T10']
+    assert diff_trees(tree2, tree1) == diff_trees(tree1, tree2)
+
+
+def test_diff_trees_ignores_latest_timestamp(tmp_path):
+    # only the number of records and the digest are compared
+    hours1 = dict((key, [1, key, '%s:00:00Z' % key]) for key in KEYS)
+    hours2 = dict((key, [1, key]) for key in KEYS)
+    assert diff_trees(_tree(tmp_path, hours1), _tree(tmp_path, hours2)) == []
+
+
+def test_levels(tmp_path):
+    tree = _tree(tmp_path, dict((key, [1, key]) for key in KEYS))
+    levels = tree.levels()
+    assert sorted(levels[0].keys()) == ['2020-01', '2020-02']
+    assert sorted(levels[1].keys()) == [
+        '2020-01-01', '2020-01-02', '2020-02-01']
+    assert levels[2] == dict((key, [1, key]) for key in KEYS)
+    assert levels[0]['2020-01'][0] == 5
+
+
+def test_save_load(tmp_path):
+    hours = dict((key, [1, key, None]) for key in KEYS)
+    _tree(tmp_path, hours).save()
+    tree = _tree(tmp_path, {})
+    tree.load()
+    assert tree.hours == hours
@@ -0,0 +1,100 @@
+'''
+Tests of the id scans of esgfpy.migrate.id_scan.
+'''
+
+import pytest
+
+from esgfpy.migrate.id_scan import (
+    ADD, DELETE, UPDATE, IdTimestamps, diff, merge_join, parse_millis
+    )
+
+# ids sorted by their UTF-8 bytes, as Solr sorts them
+IDS = ['A', 'Z', 'a', 'a.b', 'ab', 'z', u'é', u'☃', u'\U0001f600']
+
+
+def _id_timestamps(pairs):
+    ids = IdTimestamps()
+    for (record_id, timestamp) in pairs:
+        ids.append(record_id, timestamp)
+    return ids
+
+
+def test_ids_sort_as_utf8_bytes():
+    assert IDS == sorted(IDS, key=lambda i: i.encode('utf8'))
+    assert IDS == sorted(IDS)
+
+
+def test_id_timestamps():
+    ids = _id_timestamps((record_id, i) for (i, record_id) in enumerate(IDS))
+    assert len(ids) == len(IDS)
+    assert list(ids) == IDS
+    assert list(ids.items()) == [(record_id, i)
+                                 for (i, record_id) in enumerate(IDS)]
+    for (i, record_id) in enumerate(IDS):
+        assert record_id in ids
+        assert ids.find(record_id) == i
+        assert ids.get(record_id) == i
+    for record_id in ('', '0', 'aa', 'zz', u'ê'):
+        assert record_id not in ids
+        assert ids.get(record_id, -1) == -1
+
+
+def test_id_timestamps_parse():
+    ids = _id_timestamps([('a', '1970-01-01T00:00:01Z'),
+                          ('b', '1970-01-01T00:00:01.5Z')])
+    assert ids.timestamp(0) == 1000
+    assert ids.timestamp(1) == 1500
+
+
+@pytest.mark.parametrize('pairs', [
+    [('b', 0), ('a', 0)],
+    [('a', 0), ('a', 0)],
+    [(u'é', 0), ('z', 0)]])
+def test_id_timestamps_order(pairs):
+    with pytest.raises(ValueError):
+        _id_timestamps(pairs)
+
+
+def test_parse_millis():
+    assert parse_millis('1970-01-01T00:00:00Z') == 0
+    assert parse_millis('2020-01-01T00:00:00.1Z') == (
+        parse_millis('2020-01-01T00:00:00Z') + 100)
+    assert parse_millis('2020-01-01T00:00:00.123456Z') == (
+        parse_millis('2020-01-01T00:00:00Z') + 123)
+
+
+SOURCE = [('a', 1), ('b', 2), ('c', 3), (u'é', 5)]
+TARGET = [('b', 2), ('c', 4), ('d', 4), (u'é', 5), (u'☃', 6)]
+
+
+def test_merge_join():
+    actions = list(merge_join(iter(SOURCE), iter(TARGET)))
+    assert actions == [(ADD, 'a'), (UPDATE, 'c'), (DELETE, 'd'),
+                       (DELETE, u'☃')]
+
+
+def test_merge_join_empty():
+    assert list(merge_join(iter([]), iter([]))) == []
+    assert list(merge_join(iter(SOURCE), iter([]))) == [
+        (ADD, record_id) for (record_id, _) in SOURCE]
+    assert list(merge_join(iter([]), iter(TARGET))) == [
+        (DELETE, record_id) for (record_id, _) in TARGET]
+
+
+def test_diff():
+    (changed, removed) = diff(_id_timestamps(SOURCE),
+                              _id_timestamps(TARGET))
+    assert changed == ['a', 'c']
+    assert removed == ['d', u'☃']
+
+
+def test_diff_dict_fallback():
+    # ids out of order cannot be stored in IdTimestamps:
+    # dictionaries are compared by lookup instead
+    source = dict(reversed(SOURCE))
+    (changed, removed) = diff(source, _id_timestamps(TARGET))
+    assert changed == ['a', 'c']
+    assert removed == ['d', u'☃']
+    (changed, removed) = diff(source, dict(TARGET))
+    assert changed == ['a', 'c']
+    assert removed == ['d', u'☃']
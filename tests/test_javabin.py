@@ -0,0 +1,137 @@
+'''
+Tests of the javabin serialization (esgfpy.migrate.javabin).
+'''
+
+import datetime
+
+import pytest
+
+from esgfpy.migrate import javabin
+
+
+@pytest.mark.parametrize('value', [
+    None, True, False, 0, 1, 14, 15, 16, 300, (1 << 31) - 1, 1 << 31,
+    (1 << 56) - 1, 1 << 56, 1 << 62, -1, -15, -(1 << 31), -(1 << 31) - 1,
+    -(1 << 62), 1.5, -0.25, '', 'abc', u'café ☃', 'x' * 31,
+    'x' * 1000, b'\x00\x01\xff', [], [1, 'a', None], {'a': 1, 'b': [2, 3]},
+    {'nested': {'c': {'d': 'e'}}}])
+def test_round_trip(value):
+    assert javabin.loads(javabin.dumps(value)) == value
+
+
+def test_negative_ints_are_not_written_as_sint_or_slong():
+    # SINT and SLONG are only written for positive values: negative values
+    # are written as fixed length INT or LONG, and must decode as negative
+    for value in (-1, -16, -(1 << 40)):
+        data = javabin.dumps(value)
+        assert data[1] & 0xe0 not in (javabin.SINT, javabin.SLONG)
+        assert javabin.loads(data) == value
+
+
+def test_sint_slong_variable_length():
+    assert javabin.dumps(5) == bytes([javabin.VERSION, javabin.SINT | 5])
+    assert javabin.dumps(1 << 40)[1] & 0xe0 == javabin.SLONG
+    # a SINT tag with the 0x10 bit continues with a vint
+    data = bytes([javabin.VERSION, javabin.SINT | 0x10 | 0x01, 0x02])
+    assert javabin.loads(data) == 0x21
+
+
+def test_date():
+    date = datetime.datetime(2020, 1, 2, 3, 4, 5, 678000)
+    assert javabin.loads(javabin.dumps(date)) == '2020-01-02T03:04:05.678Z'
+    date = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    assert javabin.loads(javabin.dumps(date)) == '2020-01-02T03:04:05Z'
+
+
+def test_iterator():
+    data = javabin.dumps(iter([1, 'a', None]))
+    assert data[1] == javabin.ITERATOR
+    assert javabin.loads(data) == [1, 'a', None]
+
+
+def test_named_list():
+    value = javabin.NamedList([('a', 1), ('b', 'c')])
+    assert javabin.loads(javabin.dumps(value)) == {'a': 1, 'b': 'c'}
+
+
+def test_solr_input_document():
+    doc = javabin.InputDocument(id='d1', title='t', size=10)
+    value = javabin.loads(javabin.dumps(doc))
+    assert isinstance(value, javabin.InputDocument)
+    assert value == doc
+
+
+def test_solr_input_document_with_field_boost():
+    # old clients write a float boost before each field name
+    data = bytearray([javabin.VERSION, javabin.SOLRINPUTDOC, 1])
+    data += javabin.dumps(1.)[1:]
+    data += javabin.dumps(2.)[1:]
+    data += javabin.dumps('id')[1:]
+    data += javabin.dumps('d1')[1:]
+    assert javabin.loads(bytes(data)) == {'id': 'd1'}
+
+
+def test_update_round_trip():
+    docs = [{'id': 'd%s' % i, 'dataset_id': 'ds', 'version': i,
+             'variable': ['tas', 'pr']} for i in range(50)]
+    assert javabin.loads_update(javabin.dumps_update(docs)) == docs
+
+
+def test_extern_strings_are_written_once():
+    docs = [{'dataset_id': 'ds%s' % i} for i in range(10)]
+    data = javabin.dumps_update(docs)
+    assert data.count(b'dataset_id') == 1
+    assert javabin.loads_update(data) == docs
+
+
+def test_extern_string_reference():
+    data = bytes([javabin.VERSION, javabin.ARR | 2,
+                  javabin.EXTERN_STRING, javabin.STR | 2]) + b'ab' + bytes(
+                      [javabin.EXTERN_STRING | 1])
+    assert javabin.loads(data) == ['ab', 'ab']
+
+
+def test_long_string_size():
+    # sizes of 31 or more continue with a vint
+    value = 'y' * 200
+    data = javabin.dumps(value)
+    assert data[1] == javabin.STR | 0x1f
+    assert javabin.loads(data) == value
+
+
+def test_solr_document_list():
+    header = [3, 0, None]
+    docs = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+    data = bytes([javabin.VERSION, javabin.SOLRDOCLST]) + (
+        javabin.dumps(header)[1:] + javabin.dumps(docs)[1:])
+    assert javabin.loads(data) == {'numFound': 3, 'start': 0, 'docs': docs}
+
+
+@pytest.mark.parametrize('value', [
+    'abcdef', 1 << 40, -5, 1.5, [1, 2, 3], {'a': 'b'},
+    javabin.InputDocument(id='d1', title='t')])
+def test_truncated(value):
+    data = javabin.dumps(value)
+    for size in range(1, len(data)):
+        with pytest.raises(ValueError):
+            javabin.loads(data[:size])
+
+
+def test_unsupported_version():
+    with pytest.raises(ValueError):
+        javabin.loads(b'\x01' + javabin.dumps(1)[1:])
+
+
+def test_unknown_tag():
+    with pytest.raises(ValueError):
+        javabin.loads(bytes([javabin.VERSION, 31]))
+
+
+def test_unsupported_type():
+    with pytest.raises(TypeError):
+        javabin.dumps(object())
+
+
+def test_is_javabin():
+    assert javabin.is_javabin(javabin.dumps({'a': 1}))
+    assert not javabin.is_javabin(b'{"a": 1}')
@@ -0,0 +1,48 @@
+'''
+Tests of the record transformations of esgfpy.migrate.transforms.
+'''
+
+import re
+
+import pytest
+
+from esgfpy.migrate.transforms import (
+    ReplaceRule, TransformPipeline, _Matcher, _build_trie, _trie_regex
+    )
+
+
+def _regex(literals):
+    return re.compile(_trie_regex(_build_trie(literals)))
+
+
+@pytest.mark.parametrize('literals, value, matches', [
+    (['a', 'ab', 'abc'], 'abcd ab a', ['abc', 'ab', 'a']),
+    (['abc', 'ab', 'a'], 'xabx', ['ab']),
+    (['http://a', 'http://a.b', 'http://a.bc'], 'http://a.bc/x http://a.c',
+     ['http://a.bc', 'http://a']),
+    (['esgf', 'esgf-data', 'esgf-node'], 'esgf-node.llnl.gov esgf-index',
+     ['esgf-node', 'esgf']),
+    (['a.b', 'a+b', 'a*'], 'a.b a+b a* ab', ['a.b', 'a+b', 'a*'])])
+def test_trie_regex_longest_match(literals, value, matches):
+    assert _regex(literals).findall(value) == matches
+
+
+def test_trie_regex_factors_prefixes():
+    assert _trie_regex(_build_trie(['abc', 'abd'])) == 'ab(?:c|d)'
+    assert _trie_regex(_build_trie(['ab', 'abc'])) == 'ab(?:c)?'
+
+
+def test_matcher_overlapping_keys():
+    matcher = _Matcher({'esgf-node': 'NODE', 'esgf': 'ESGF', '': 'x'})
+    assert matcher
+    assert matcher.replace('esgf-node.gov esgf.gov') == 'NODE.gov ESGF.gov'
+    assert matcher.replace(3) == 3
+    assert not _Matcher({'': 'x'})
+
+
+def test_replace_rules_merged():
+    pipeline = TransformPipeline([
+        ReplaceRule({'a.b': 'A.B'}),
+        ReplaceRule({'a.b.c': 'C'}, fields=['url'])])
+    docs = pipeline([{'id': 'a.b.c', 'url': ['a.b.c', 'a.b'], 'size': 3}])
+    assert docs == [{'id': 'A.B.c', 'url': ['C', 'A.B'], 'size': 3}]
@@ -0,0 +1,75 @@
+'''
+Tests of the streaming JSON parser of esgfpy.migrate.utils.
+'''
+
+import io
+import json
+
+import pytest
+
+from esgfpy.migrate import utils
+
+
+class ChunkedStream(object):
+    '''Binary stream that returns at most 'chunkBytes' bytes per read.'''
+
+    def __init__(self, data, chunkBytes):
+        self._stream = io.BytesIO(data)
+        self.chunkBytes = chunkBytes
+
+    def read(self, amt=None):
+        return self._stream.read(self.chunkBytes)
+
+
+def _response(docs, **header):
+    response = {'numFound': len(docs), 'start': 0, 'docs': docs}
+    response.update(header)
+    return json.dumps({'responseHeader': {'status': 0, 'QTime': 3},
+                       'response': response}, indent=2,
+                      ensure_ascii=False).encode('utf8')
+
+
+DOCS = [{'id': 'd%s' % i, 'title': u'café ☃ [%s], {x}' % i,
+         'variable': ['tas', 'pr'], 'size': i} for i in range(20)]
+
+
+@pytest.mark.parametrize('chunkBytes', [1, 2, 3, 7, 64, 100000])
+def test_iter_json_docs_chunked(chunkBytes):
+    header = {}
+    stream = ChunkedStream(_response(DOCS), chunkBytes)
+    assert list(utils.iter_json_docs(stream, header)) == DOCS
+    assert header['numFound'] == len(DOCS)
+    assert header['start'] == 0
+
+
+def test_iter_json_docs_small_chunks(monkeypatch):
+    monkeypatch.setattr(utils, 'STREAM_CHUNK_BYTES', 5)
+    stream = io.BytesIO(_response(DOCS))
+    assert list(utils.iter_json_docs(stream)) == DOCS
+
+
+def test_iter_json_docs_compact():
+    data = json.dumps({'response': {'numFound': 2, 'docs': DOCS[:2]}},
+                      separators=(',', ':')).encode('utf8')
+    assert list(utils.iter_json_docs(ChunkedStream(data, 4))) == DOCS[:2]
+
+
+def test_iter_json_docs_empty():
+    header = {}
+    stream = ChunkedStream(_response([]), 3)
+    assert list(utils.iter_json_docs(stream, header)) == []
+    assert header['numFound'] == 0
+
+
+def test_iter_json_docs_no_docs():
+    stream = ChunkedStream(b'{"error": {"msg": "bad request"}}', 3)
+    assert list(utils.iter_json_docs(stream)) == []
+
+
+def test_iter_json_docs_truncated():
+    data = _response(DOCS)
+    stream = ChunkedStream(data[:len(data) // 2], 16)
+    docs = utils.iter_json_docs(stream)
+    with pytest.raises(ValueError):
+        for doc in docs:
+            assert doc in DOCS